@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of BIDS conversion and workflow construction on synthetic
+cohorts, using a stub dcm2niix.
+
+    python benchmarks/bench_conversion.py -sizes 1 10 50 -latency 0.05
+'''
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import warnings
+from contextlib import contextmanager, redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'mjxproc'))
+from utils import Subject  # noqa: E402
+
+
+# Series of a session, as named by each site
+UTD_SERIES = ['MPR', 'DTI', 'CAAT', 'CUE_RUN1', 'CUE_RUN2', 'NBACK', 'REST']
+NL_SERIES = ['T1w', 'dwi', 'task-CAAT', 'task-cue_run-1', 'task-cue_run-2',
+             'task-nback', 'task-rest']
+
+# Sequences looked up by Subject._find_seqs
+SEQS = {'UTD': UTD_SERIES,
+        'NL': ['T1w', 'dwi', 'CAAT', 'cue*run-1', 'cue*run-2', 'nback',
+               'rest']}
+
+STUB = '''#!{python}
+""" Stub dcm2niix: writes a fake nifti, gzipped with -z y, and json sidecar.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+
+args = sys.argv[1:]
+d_out = args[args.index('-o') + 1]
+f_out = args[args.index('-f') + 1]
+compress = '-z' in args and args[args.index('-z') + 1] == 'y'
+time.sleep(float(os.environ.get('STUB_DCM2NIIX_LATENCY', 0)))
+nii = gzip.open if compress else open
+with nii(f'{{d_out}}/{{f_out}}.nii' + ('.gz' if compress else ''), 'wb') as f:
+    f.write(bytes(int(os.environ.get('STUB_DCM2NIIX_BYTES', 352))))
+with open(f'{{d_out}}/{{f_out}}.json', 'w') as f:
+    json.dump({{'ConversionSoftware': 'stub', 'Source': args[-1]}}, f)
+'''
+
+# Audit events that touch the filesystem or spawn processes
+FS_EVENTS = ['open', 'os.listdir', 'os.scandir', 'os.mkdir', 'os.rename',
+             'os.remove', 'os.rmdir', 'glob.glob', 'shutil.rmtree',
+             'subprocess.Popen', 'sqlite3.connect']
+
+
+def make_stub(path):
+    """ Write the stub dcm2niix to path.
+    """
+    with open(path, 'w') as f:
+        f.write(STUB.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return path
+
+
+def make_cohort(raw_dir, site, n_subjects, n_sessions=2, n_files=20):
+    """ Create a synthetic raw tree for a cohort.
+
+    Parameters
+    ----------
+    raw_dir : str
+        directory the subjects are created in
+    site : str
+        UTD, <session>/<series>/<dicoms>, or NL, <session>/<series>.PAR
+    n_subjects : int
+        number of subjects
+    n_sessions : int
+        number of sessions per subject
+    n_files : int
+        number of dicoms per UTD series
+
+    Returns
+    -------
+    subj_dirs : list of str
+        raw data directory of each subject
+    """
+    subj_dirs = []
+    for idx in range(n_subjects):
+        if site == 'UTD':
+            subj_dir = f'{raw_dir}/M{idx:08d}'
+        else:
+            subj_dir = f'{raw_dir}/sub-{idx:04d}'
+        for ses in range(n_sessions):
+            if site == 'UTD':
+                date = 20190101 + ses * 10000
+                ses_dir = f'{subj_dir}/MJX_Study{date}at120000'
+                for seq in UTD_SERIES + [f'{seq}_TOP_UP' for seq in
+                                         UTD_SERIES[1:]]:
+                    series_dir = f'{ses_dir}/{seq}_{date}'
+                    os.makedirs(series_dir)
+                    for num in range(n_files):
+                        open(f'{series_dir}/IM{num:04d}.dcm', 'w').close()
+            else:
+                ses_dir = f'{subj_dir}/ses-{ses+1:02d}'
+                os.makedirs(ses_dir)
+                for seq in NL_SERIES + [f'topup_{seq}' for seq in
+                                        NL_SERIES[1:]]:
+                    for ext in ['PAR', 'REC']:
+                        open(f'{ses_dir}/{seq}.{ext}', 'w').close()
+        subj_dirs.append(subj_dir)
+    return subj_dirs
+
+
+class FsCounter:
+    """ Count filesystem calls and spawned processes in this process.
+    """
+    active = None
+
+    def __init__(self):
+        self.counts = {}
+
+    @classmethod
+    def install(cls):
+        sys.addaudithook(cls._audit)
+        for name in ['stat', 'lstat']:
+            setattr(os, name, cls._wrap(name, getattr(os, name)))
+
+    @classmethod
+    def _audit(cls, event, args):
+        if cls.active is not None and event in FS_EVENTS:
+            cls.active.add(event)
+
+    @classmethod
+    def _wrap(cls, name, func):
+        def counted(*args, **kwargs):
+            if cls.active is not None:
+                cls.active.add(f'os.{name}')
+            return func(*args, **kwargs)
+        return counted
+
+    def add(self, event):
+        self.counts[event] = self.counts.get(event, 0) + 1
+
+    @property
+    def total(self):
+        return sum(count for event, count in self.counts.items() if
+                   event != 'subprocess.Popen')
+
+
+@contextmanager
+def measure(results, site, size, stage, n_items):
+    """ Time a stage and count its filesystem calls.
+    """
+    counter = FsCounter()
+    FsCounter.active = counter
+    start = time.perf_counter()
+    try:
+        with redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        FsCounter.active = None
+
+    result = {'site': site, 'subjects': size, 'stage': stage,
+              'seconds': elapsed,
+              'per_sec': n_items / elapsed if elapsed > 0 else float('inf'),
+              'fs_calls': counter.total,
+              'fs_calls_per_subject': counter.total / size,
+              'processes': counter.counts.get('subprocess.Popen', 0),
+              'counts': counter.counts}
+    results.append(result)
+    print(f"{site:>4} {size:>6} {stage:<16} {elapsed:>9.3f} "
+          f"{result['per_sec']:>11.1f} "
+          f"{result['fs_calls_per_subject']:>10.1f} "
+          f"{result['processes']:>6}", flush=True)
+
+
+def bench_cohort(work_dir, site, size, args, results):
+    """ Run each benchmark stage on one synthetic cohort.
+    """
+    raw_dir = f'{work_dir}/{site}_{size}/raw'
+    bids_dir = f'{work_dir}/{site}_{size}/BIDS'
+    proc_dir = f'{work_dir}/{site}_{size}/PROC'
+    subj_dirs = make_cohort(raw_dir, site, size, args.sessions[0],
+                            args.dicoms[0])
+    os.makedirs(bids_dir)
+
+    with measure(results, site, size, 'Subject.__init__', size):
+        subjects = [Subject(subj_dir, bids_dir) for subj_dir in subj_dirs]
+
+    n_globs = size * len(SEQS[site]) * 2
+    with measure(results, site, size, '_seq_glob', n_globs):
+        for subject in subjects:
+            for seq in SEQS[site]:
+                for topup in [False, True]:
+                    subject._seq_glob(seq, topup)
+
+    with measure(results, site, size, 'to_bids', size):
+        for subject in subjects:
+            subject.to_bids(convert_jobs=args.convert_jobs[0],
+                            compress=args.compress)
+
+    with measure(results, site, size, 'to_bids (rerun)', size):
+        for subj_dir in subj_dirs:
+            Subject(subj_dir, bids_dir).to_bids(
+                convert_jobs=args.convert_jobs[0], compress=args.compress)
+
+    try:
+        from workflow import create_workflow
+    except ImportError as err:
+        print(f'Skipping create_workflow: {err}')
+        return
+
+    with measure(results, site, size, 'create_workflow', size):
+        for subject in subjects:
+            create_workflow(subject.subj_id, 'ses-01', bids_dir, proc_dir,
+                            raw_dir=subject.dir_path,
+                            compress=args.compress,
+                            name=f"wf_{subject.subj_id.replace('-', '_')}")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark BIDS conversion and workflow construction on '
+                    'synthetic cohorts.')
+    parser.add_argument('-sizes',
+                        default=[1, 10, 50],
+                        nargs='+',
+                        type=int,
+                        help='Cohort sizes, in subjects.\n')
+    parser.add_argument('-sites',
+                        default=['UTD', 'NL'],
+                        nargs='+',
+                        choices=['UTD', 'NL'],
+                        help='Raw data layouts to generate.\n')
+    parser.add_argument('-sessions',
+                        default=[2],
+                        nargs=1,
+                        type=int,
+                        help='Sessions per subject.\n')
+    parser.add_argument('-dicoms',
+                        default=[20],
+                        nargs=1,
+                        type=int,
+                        help='Dicoms per UTD series.\n')
+    parser.add_argument('-latency',
+                        default=[0.0],
+                        nargs=1,
+                        type=float,
+                        help='Seconds the stub dcm2niix sleeps per series.\n')
+    parser.add_argument('-nii_bytes',
+                        default=[352],
+                        nargs=1,
+                        type=int,
+                        help='Size of the fake nifti images.\n')
+    parser.add_argument('-convert_jobs',
+                        default=[1],
+                        nargs=1,
+                        type=int,
+                        help='Concurrent dcm2niix conversions per subject.\n')
+    parser.add_argument('-compress',
+                        action='store_true',
+                        help='Convert to .nii.gz images.\n')
+    parser.add_argument('-work_dir',
+                        default=[None],
+                        nargs=1,
+                        help='Directory for the synthetic trees, a '
+                             'temporary directory is used and removed if '
+                             'not given.\n')
+    parser.add_argument('-out',
+                        default=[None],
+                        nargs=1,
+                        help='Json file to write results to.\n')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    work_dir = args.work_dir[0]
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='mjxproc_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    os.environ['MJXPROC_DCM2NIIX'] = make_stub(f'{work_dir}/dcm2niix')
+    os.environ['STUB_DCM2NIIX_LATENCY'] = str(args.latency[0])
+    os.environ['STUB_DCM2NIIX_BYTES'] = str(args.nii_bytes[0])
+    FsCounter.install()
+    warnings.simplefilter('ignore')
+
+    print(f"{'site':>4} {'size':>6} {'stage':<16} {'seconds':>9} "
+          f"{'items/sec':>11} {'fs/subj':>10} {'procs':>6}")
+    results = []
+    try:
+        for site in args.sites:
+            for size in args.sizes:
+                bench_cohort(work_dir, site, size, args, results)
+    finally:
+        if args.work_dir[0] is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.out[0] is not None:
+        with open(args.out[0], 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f,
+                      indent='\t')
+
+
+if __name__ == '__main__':
+    main()
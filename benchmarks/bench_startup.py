@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''
+Startup time of the mjxproc subcommands, and the modules each one imports.
+Exits non-zero when a command is slower than -max_seconds, or when convert
+imports nipype.
+
+    python benchmarks/bench_startup.py -repeats 5 -max_seconds 1
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+MJXPROC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'mjxproc')
+
+# Commands timed, as arguments to mjxproc
+COMMANDS = {'help': ['--help'],
+            'convert --help': ['convert', '--help'],
+            'run --help': ['run', '--help'],
+            'batch --help': ['batch', '--help']}
+
+# Heavy modules that only workflow building paths may import
+HEAVY = ['nipype', 'networkx', 'traits', 'numpy']
+
+# Runs a subcommand in this interpreter and prints the heavy modules loaded
+PROBE = '''
+import sys
+import json
+sys.path.insert(0, {mjxproc!r})
+import mjxproc_run
+try:
+    mjxproc_run.main({argv!r})
+except SystemExit:
+    pass
+print(json.dumps([name for name in {heavy!r} if name in sys.modules]),
+      file=sys.stderr)
+'''
+
+
+def time_command(argv, repeats):
+    """ Seconds to run mjxproc with argv in a fresh interpreter.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, f'{MJXPROC}/mjxproc_run.py'] + argv,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def heavy_imports(argv):
+    """ Heavy modules imported by running mjxproc with argv.
+    """
+    code = PROBE.format(mjxproc=MJXPROC, argv=argv, heavy=HEAVY)
+    proc = subprocess.run([sys.executable, '-c', code],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    return json.loads(proc.stderr.strip().splitlines()[-1])
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark startup time of the mjxproc subcommands.')
+    parser.add_argument('-repeats',
+                        default=[5],
+                        nargs=1,
+                        type=int,
+                        help='Runs of each command, the median is reported.\n')
+    parser.add_argument('-max_seconds',
+                        default=[None],
+                        nargs=1,
+                        type=float,
+                        help='Fail when help or convert --help take longer '
+                             'than this.\n')
+    parser.add_argument('-out',
+                        default=[None],
+                        nargs=1,
+                        help='Json file to write results to.\n')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    print(f"{'command':<16} {'median_s':>9} {'min_s':>9}  heavy imports")
+    results = []
+    for name, command in COMMANDS.items():
+        times = time_command(command, args.repeats[0])
+        heavy = heavy_imports(command)
+        results.append({'command': name, 'median_s': statistics.median(times),
+                        'min_s': min(times), 'times': times, 'heavy': heavy})
+        print(f"{name:<16} {results[-1]['median_s']:>9.3f} "
+              f"{results[-1]['min_s']:>9.3f}  {' '.join(heavy) or '-'}",
+              flush=True)
+
+    if args.out[0] is not None:
+        with open(args.out[0], 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f,
+                      indent='\t')
+
+    failed = []
+    for result in results:
+        if result['command'] not in ['help', 'convert --help']:
+            continue
+        if 'nipype' in result['heavy']:
+            failed.append(f"{result['command']} imports nipype")
+        if args.max_seconds[0] is not None and \
+                result['median_s'] > args.max_seconds[0]:
+            failed.append(f"{result['command']} took "
+                          f"{result['median_s']:.3f}s")
+    for message in failed:
+        print(f'FAIL: {message}')
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
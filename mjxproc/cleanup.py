@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+'''
+Created on Sun March 10 15:44:46 2020
+@author: Ryan Hammonds (ryanhammonds)
+'''
+import os
+import glob
+import gzip
+import shutil
+import fnmatch
+
+# What is kept of each subject's outputs, by retention policy:
+#   ants: intermediates of antsCorticalThickness.sh, keep, compress or
+#       remove. Compress gzips .nii images and removes intermediate images
+#       that are already gzipped, the script's default, as recompressing
+#       them reclaims next to nothing. Other files are kept.
+#   freesurfer: recon-all tmp and trash directories, keep or remove
+#   work: mriqc/fmriprep work directories outside proc_dir, keep or remove
+#   workflows: nipype node directories of finished nodes, keep or remove.
+#       Their stdout/stderr logs are moved to <wf_dir>/node_logs first.
+RETENTION = {
+    'all': {'ants': 'keep', 'freesurfer': 'keep', 'work': 'keep',
+            'workflows': 'keep'},
+    'final': {'ants': 'compress', 'freesurfer': 'remove', 'work': 'keep',
+              'workflows': 'remove'},
+    'minimal': {'ants': 'remove', 'freesurfer': 'remove', 'work': 'remove',
+                'workflows': 'remove'}
+}
+
+# Final derivatives of antsCorticalThickness.sh, after the output prefix
+ANTS_FINAL = ['BrainExtractionMask.nii*', 'BrainSegmentation.nii*',
+              'BrainSegmentation0N4.nii*', 'BrainSegmentationPosteriors*.nii*',
+              'CorticalThickness.nii*',
+              'CorticalThicknessNormalizedToTemplate.nii*',
+              'ExtractedBrain0N4.nii*', 'BrainNormalizedToTemplate.nii*',
+              'SubjectToTemplate*', 'TemplateToSubject*',
+              '*TiledMosaic.png', 'ACTStage*Complete.txt', 'brainvols.csv']
+
+# Node logs kept when node directories are pruned, under the workflow
+NODE_LOGS = 'node_logs'
+
+# Recon-all directories of intermediates, relative to the subject
+FS_INTERMEDIATES = ['tmp', 'trash']
+
+
+def path_bytes(path):
+    """ Size (bytes) of a file, or of the files under a directory.
+    """
+    if os.path.islink(path) or not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if not os.path.islink(f'{root}/{name}'):
+                total += os.path.getsize(f'{root}/{name}')
+    return total
+
+
+def remove(path):
+    """ Remove a file or directory.
+
+    Returns
+    -------
+    reclaimed : int
+        bytes freed
+    """
+    reclaimed = path_bytes(path)
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+    return reclaimed
+
+
+def compress(path):
+    """ Gzip a .nii image in place, or remove a .nii.gz intermediate, other
+        files are left as they are.
+
+    Returns
+    -------
+    reclaimed : int
+        bytes freed
+    """
+    if path.endswith('.nii.gz'):
+        return remove(path)
+    if not path.endswith('.nii') or not os.path.isfile(path):
+        return 0
+    size = os.path.getsize(path)
+    tmp = f'{os.path.dirname(path)}/.{os.path.basename(path)}.gz.tmp'
+    with open(path, 'rb') as f_in, gzip.open(tmp, 'wb', compresslevel=6) as \
+            f_out:
+        shutil.copyfileobj(f_in, f_out)
+    shutil.copystat(path, tmp)
+    os.replace(tmp, f'{path}.gz')
+    os.remove(path)
+    return size - os.path.getsize(f'{path}.gz')
+
+
+def keep_logs(node_dir, log_dir):
+    """ Move the stdout/stderr logs of a node, and their rotations, out of
+        its directory.
+
+    Parameters
+    ----------
+    node_dir : str
+        nipype node directory, logs are read from its _report directory
+    log_dir : str
+        directory the logs are moved to
+    """
+    logs = glob.glob(f'{node_dir}/_report/std*.log*')
+    if len(logs) > 0:
+        os.makedirs(log_dir, exist_ok=True)
+    for log in logs:
+        os.replace(log, f'{log_dir}/{os.path.basename(log)}')
+
+
+def ants_intermediates(prefix):
+    """ Outputs of antsCorticalThickness.sh that are not final derivatives.
+
+    Parameters
+    ----------
+    prefix : str
+        output prefix the script was run with, ex: PROC/ants/sub-1234/ants
+
+    Returns
+    -------
+    paths : list of str
+        files and directories starting with the prefix
+    """
+    name = os.path.basename(prefix)
+    paths = []
+    for path in sorted(glob.glob(f'{prefix}*')):
+        suffix = os.path.basename(path)[len(name):]
+        if not any(fnmatch.fnmatch(suffix, final) for final in ANTS_FINAL):
+            paths.append(path)
+    return paths
+
+
+def clean_subject(policy, proc_dir, ants_outs=(), fs_dirs=(), work_dirs=(),
+                  wf_dir=None, keep_nodes=()):
+    """ Apply a retention policy to the outputs of a subject.
+
+    Parameters
+    ----------
+    policy : str or dict
+        name of a RETENTION policy, or its actions
+    proc_dir : str
+        directory of processed outputs
+    ants_outs : list of str
+        antsCorticalThickness.sh output prefixes, relative to proc_dir
+    fs_dirs : list of str
+        recon-all subject directories, relative to proc_dir
+    work_dirs : list of str
+        mriqc and fmriprep work directories
+    wf_dir : str
+        nipype directory of the subject's workflow, whose node directories
+        are removed, reports at its root and node logs, moved to
+        <wf_dir>/node_logs/<node>, are kept
+    keep_nodes : list of str
+        node directories of wf_dir kept, ex: the running cleanup node
+
+    Returns
+    -------
+    reclaimed : dict
+        bytes freed for ants, freesurfer, work and workflows, and their total
+    """
+    actions = RETENTION[policy] if isinstance(policy, str) else policy
+    reclaimed = {category: 0 for category in RETENTION['all']}
+
+    for ants_out in ants_outs:
+        for path in ants_intermediates(f'{proc_dir}/{ants_out}'):
+            if actions['ants'] == 'remove':
+                reclaimed['ants'] += remove(path)
+            elif actions['ants'] == 'compress':
+                reclaimed['ants'] += compress(path)
+
+    if actions['freesurfer'] == 'remove':
+        for fs_dir in fs_dirs:
+            for name in FS_INTERMEDIATES:
+                reclaimed['freesurfer'] += remove(
+                    f'{proc_dir}/{fs_dir}/{name}')
+
+    if actions['work'] == 'remove':
+        for work_dir in work_dirs:
+            reclaimed['work'] += remove(work_dir)
+
+    if actions['workflows'] == 'remove' and wf_dir is not None and \
+            os.path.isdir(wf_dir):
+        for entry in os.scandir(wf_dir):
+            if entry.is_dir(follow_symlinks=False) and \
+                    entry.name not in list(keep_nodes) + [NODE_LOGS]:
+                keep_logs(entry.path, f'{wf_dir}/{NODE_LOGS}/{entry.name}')
+                reclaimed['workflows'] += remove(entry.path)
+
+    reclaimed['total'] = sum(reclaimed.values())
+    return reclaimed
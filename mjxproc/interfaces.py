@@ -3,13 +3,418 @@
 Created on Sun March 10 15:44:46 2020
 @author: Ryan Hammonds (ryanhammonds)
 '''
+import os
+import glob
+import json
+import fcntl
+import hashlib
+import tempfile
+import subprocess
+from nipype import logging
 from nipype.interfaces.base import (
-    CommandLine, CommandLineInputSpec,
-    File, TraitedSpec, traits
+    CommandLine, CommandLineInputSpec, SimpleInterface,
+    BaseInterfaceInputSpec, File, TraitedSpec, traits, InputMultiObject,
+    isdefined
 )
+from utils import Subject, nifti_mvox
+from profiler import profile_children
+from cleanup import RETENTION, clean_subject
+from streams import run_logged
 
+logger = logging.getLogger('nipype.interface')
 
-class MriqcInfoInputSpec(CommandLineInputSpec):
+
+class SingularityInputSpec(CommandLineInputSpec):
+    """ Options shared by all singularity interfaces
+    """
+    skip_complete = traits.Bool(
+        True,
+        usedefault=True,
+        nohash=True,
+        desc='skip the command if its results are found on disk'
+    )
+    instance_prefix = traits.Str(
+        nohash=True,
+        desc='run in a singularity instance named with this prefix, started '
+             'once per image and binds, instead of a new container'
+    )
+    log_max_mb = traits.Float(
+        nohash=True,
+        desc='stream stdout and stderr to stdout.log and stderr.log in the '
+             'node\'s _report directory, rotated at this size (MB), keeping '
+             'only their tail in memory and in the node result'
+    )
+    log_backups = traits.Int(
+        2,
+        usedefault=True,
+        nohash=True,
+        desc='rotated logs kept of each stream'
+    )
+
+
+def instance_prefix():
+    """ Prefix of the singularity instances started by this process's run.
+    """
+    return f'mjx{os.getpid()}'
+
+
+def list_instances(prefix=''):
+    """ Names of running singularity instances.
+
+    Parameters
+    ----------
+    prefix : str
+        only return instances whose name starts with prefix
+
+    Returns
+    -------
+    names : list of str
+        instance names
+    """
+    try:
+        output = subprocess.run(['singularity', 'instance', 'list'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout
+    except OSError:
+        return []
+    names = [line.split()[0] for line in output.splitlines()[1:] if
+             len(line.split()) > 0]
+    return [name for name in names if name.startswith(prefix)]
+
+
+def stop_instances(prefix):
+    """ Stop the singularity instances started with a prefix.
+
+    Parameters
+    ----------
+    prefix : str
+        instance_prefix the instances were started with
+    """
+    for name in list_instances(f'{prefix}_'):
+        subprocess.run(['singularity', 'instance', 'stop', name],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for ext in ['json', 'lock']:
+        if os.path.isfile(f'{tempfile.gettempdir()}/{prefix}.{ext}'):
+            os.remove(f'{tempfile.gettempdir()}/{prefix}.{ext}')
+
+
+class SingularityCommandLine(CommandLine):
+    """ Call a singularity container, unless a previous run completed.
+
+    Subclasses define is_complete and list the inputs it needs in
+    _complete_inputs, may set variables in the container with
+    _container_env, and list the images sizing their memory in _images. A
+    bind_work input moves work_dir from /PROC to /WORK, a bind_templateflow
+    input sets TEMPLATEFLOW_HOME. Resources used by the container's process
+    tree are kept in runtime.profile. With log_max_mb, output goes to
+    rotating logs in the node's _report directory rather than memory.
+
+    With instance_prefix, nodes sharing an image run in one singularity
+    instance, started by the first of them. Binds are given when the
+    instance starts, so a node reuses an instance of its image whose binds
+    include its own, otherwise it starts one. Commands then use singularity
+    run instance://<name>, not exec, as the images rely on their runscript.
+    A node whose instance fails to start runs the image on its own.
+    """
+    _cmd = 'singularity'
+    _complete_inputs = []
+    _instance = None
+
+    def _format_arg(self, name, spec, value):
+        if self._instance is not None:
+            if name.startswith('bind_'):
+                return None
+            if name == 'container':
+                return f'instance://{self._instance}'
+        if name == 'work_dir' and self._bound('bind_work'):
+            return spec.argstr.replace('/PROC/', '/WORK/') % value
+        return super(SingularityCommandLine, self)._format_arg(name, spec,
+                                                               value)
+
+    def _bound(self, name):
+        """ Whether the interface has, and was given, a bind input.
+        """
+        return name in self.inputs.copyable_trait_names() and \
+            isdefined(getattr(self.inputs, name))
+
+    def _start_instance(self):
+        """ Find, or start, an instance for this node's image and binds.
+
+        Instances of a prefix are recorded in <tmpdir>/<prefix>.json.
+
+        Returns
+        -------
+        name : str or None
+            instance name, None if the instance failed to start
+        """
+        binds = [super(SingularityCommandLine, self)._format_arg(
+            name, self.inputs.trait(name), getattr(self.inputs, name)) for
+            name in sorted(self.inputs.copyable_trait_names()) if
+            name.startswith('bind_') and isdefined(getattr(self.inputs,
+                                                           name))]
+        env = self.inputs.env if isdefined(self.inputs.env) else ''
+        container = os.path.realpath(self.inputs.container)
+        prefix = self.inputs.instance_prefix
+        registry = f'{tempfile.gettempdir()}/{prefix}.json'
+
+        # Nodes may start at once, in other processes
+        with open(f'{tempfile.gettempdir()}/{prefix}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            instances = {}
+            if os.path.isfile(registry):
+                with open(registry, 'r') as f:
+                    instances = json.load(f)
+
+            running = list_instances(f'{prefix}_')
+            for name, spec in instances.items():
+                if name in running and spec['container'] == container and \
+                        spec['env'] == env and \
+                        set(binds).issubset(spec['binds']):
+                    return name
+
+            key = hashlib.sha1(' '.join([container, env] + binds).encode())
+            name = f'{prefix}_{key.hexdigest()[:10]}'
+            cmd = ' '.join(['singularity instance start', env] + binds +
+                           [container, name])
+            output = subprocess.run(cmd, shell=True,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+            if output.returncode != 0:
+                logger.warning('Instance %s failed to start, running '
+                               'without it:\n%s', name,
+                               output.stderr.strip())
+                return None
+
+            instances[name] = {'container': container, 'env': env,
+                               'binds': binds}
+            with open(registry, 'w') as f:
+                json.dump(instances, f, indent='\t')
+        return name
+
+    def is_complete(self):
+        """ Whether results of a previous run exist on disk.
+        """
+        return False
+
+    def _images(self):
+        """ Input images on the host, for each datatype the node reads.
+        """
+        return {}
+
+    def image_mvox(self):
+        """ Megavoxels of the largest input image of each datatype read, None
+            for datatypes without readable images yet.
+        """
+        mvox = {}
+        for datatype, images in self._images().items():
+            sizes = [size for size in map(nifti_mvox, images) if size is not
+                     None]
+            mvox[datatype] = max(sizes) if len(sizes) > 0 else None
+        return mvox
+
+    def _container_env(self):
+        """ Variables set inside the container, TemplateFlow's home when a
+            cache is bound.
+        """
+        if self._bound('bind_templateflow'):
+            return {'TEMPLATEFLOW_HOME': '/TEMPLATEFLOW'}
+        return {}
+
+    def _get_environ(self):
+        # --cleanenv drops host variables, except those prefixed with
+        #   SINGULARITYENV_, which are set in the container without it.
+        environ = dict(super(SingularityCommandLine, self)._get_environ())
+        environ.update({f'SINGULARITYENV_{name}': str(value) for name, value
+                        in self._container_env().items()})
+        return environ
+
+    def _run_logged(self, runtime, correct_return_codes=(0,)):
+        """ Run the command with its output streamed to rotating logs, only
+            their tail is kept in runtime. Logs go to _report, which nipype
+            keeps when it cleans the node directory.
+        """
+        log_dir = f'{runtime.cwd}/_report'
+        runtime.environ.update(self._get_environ())
+        runtime.cmdline = self.cmdline
+        runtime.success_codes = correct_return_codes
+        runtime.returncode, runtime.stdout, runtime.stderr = run_logged(
+            runtime.cmdline, runtime.cwd,
+            env={name: str(value) for name, value in runtime.environ.items()},
+            log_dir=log_dir,
+            max_bytes=int(self.inputs.log_max_mb * 2**20),
+            backups=self.inputs.log_backups)
+        if runtime.returncode not in correct_return_codes:
+            runtime.stderr += f"\nFull output: {log_dir}/stdout.log, " \
+                              f"{log_dir}/stderr.log"
+            self.raise_exception(runtime)
+        return runtime
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        ready = all(isdefined(getattr(self.inputs, name)) for name in
+                    self._complete_inputs)
+        if self.inputs.skip_complete and ready and self.is_complete():
+            runtime.stdout = 'Results found on disk, skipping.'
+            runtime.stderr = ''
+            runtime.cmdline = self.cmdline
+            runtime.returncode = 0
+            runtime.success_codes = correct_return_codes
+            return runtime
+        if isdefined(self.inputs.instance_prefix):
+            self._instance = self._start_instance()
+
+        run = super(SingularityCommandLine, self)._run_interface
+        if isdefined(self.inputs.log_max_mb):
+            run = self._run_logged
+
+        record = {'name': 'singularity', 'kind': 'singularity'}
+        try:
+            with profile_children(record):
+                runtime = run(runtime, correct_return_codes)
+        finally:
+            self._instance = None
+        record['status'] = 'done' if runtime.returncode in \
+            correct_return_codes else 'failed'
+        runtime.profile = [record]
+        return runtime
+
+
+class BidsConvertInputSpec(BaseInterfaceInputSpec):
+    """ Arguments for converting one sequence class of a session to BIDS
+    """
+    raw_dir = traits.Directory(
+        desc='top level subject raw data directory',
+        exists=True,
+        mandatory=True
+    )
+    bids_dir = traits.Directory(
+        desc='bids directory to convert raw data to',
+        mandatory=True
+    )
+    img_type = traits.Enum(
+        'anat', 'func', 'dwi', 'fmap',
+        desc='sequence class to convert',
+        mandatory=True
+    )
+    session = traits.Str(
+        desc='session to convert, either ses-01 or ses-02',
+        mandatory=True
+    )
+    convert_jobs = traits.Int(
+        1,
+        usedefault=True,
+        nohash=True,
+        desc='number of concurrent dcm2niix conversions'
+    )
+    compress = traits.Bool(
+        False,
+        usedefault=True,
+        desc='write .nii.gz images rather than .nii'
+    )
+    target_files = InputMultiObject(
+        traits.Str,
+        desc='converted images the fmaps are intended for, orders fmap '
+             'conversion after their targets'
+    )
+
+
+class BidsConvertOutputSpec(TraitedSpec):
+    bids_dir = traits.Directory(desc="bids directory", exists=True)
+    out_files = traits.List(traits.Str, desc="converted nifti images")
+
+
+class BidsConvert(SimpleInterface):
+    """ Convert one sequence class of a session with dcm2niix.
+    """
+    input_spec = BidsConvertInputSpec
+    output_spec = BidsConvertOutputSpec
+
+    def _run_interface(self, runtime):
+        subject = Subject(self.inputs.raw_dir, self.inputs.bids_dir)
+        self._results['out_files'] = subject.convert(
+            img_types=[self.inputs.img_type],
+            sessions=[self.inputs.session],
+            convert_jobs=self.inputs.convert_jobs,
+            compress=self.inputs.compress
+        )
+        self._results['bids_dir'] = self.inputs.bids_dir
+        runtime.profile = subject.profile
+        return runtime
+
+
+class CleanupInputSpec(BaseInterfaceInputSpec):
+    """ Outputs of a subject a retention policy is applied to
+    """
+    policy = traits.Enum(
+        *sorted(RETENTION),
+        desc='retention policy, see cleanup.RETENTION',
+        mandatory=True
+    )
+    proc_dir = traits.Directory(
+        desc='directory of processed outputs',
+        exists=True,
+        mandatory=True
+    )
+    subj_id = traits.Str(
+        desc='subject as in bids_dir ex: sub-1234',
+        mandatory=True
+    )
+    ants_outs = traits.List(
+        traits.Str,
+        desc='antsCorticalThickness.sh output prefixes, relative to proc_dir'
+    )
+    fs_dirs = traits.List(
+        traits.Str,
+        desc='recon-all subject directories, relative to proc_dir'
+    )
+    work_dirs = traits.List(
+        traits.Str,
+        desc='mriqc and fmriprep work directories'
+    )
+    finished = traits.List(
+        traits.Any,
+        desc='outputs of the nodes cleaned up after, orders this node last'
+    )
+
+
+class CleanupOutputSpec(TraitedSpec):
+    reclaimed = traits.Dict(desc="bytes freed, per category and in total")
+    report = File(desc="json report of the bytes freed", exists=True)
+
+
+class Cleanup(SimpleInterface):
+    """ Remove or compress intermediates of a subject once its other nodes
+        have finished, and prune their nipype node directories.
+
+    The bytes reclaimed are written to cleanup_report.json, next to the
+    run's profile, node logs are kept in node_logs.
+    """
+    input_spec = CleanupInputSpec
+    output_spec = CleanupOutputSpec
+
+    def _run_interface(self, runtime):
+        # Node directories are siblings of this node's
+        wf_dir = os.path.dirname(runtime.cwd)
+        reclaimed = clean_subject(
+            self.inputs.policy, self.inputs.proc_dir,
+            ants_outs=self.inputs.ants_outs, fs_dirs=self.inputs.fs_dirs,
+            work_dirs=self.inputs.work_dirs, wf_dir=wf_dir,
+            keep_nodes=[os.path.basename(runtime.cwd)]
+        )
+        report = f"{wf_dir}/cleanup_report.json"
+        with open(report, 'w') as f:
+            json.dump({'subject': self.inputs.subj_id,
+                       'policy': self.inputs.policy,
+                       'reclaimed_bytes': reclaimed}, f, indent='\t')
+        logger.info('%s: %.2f GB reclaimed (%s)', self.inputs.subj_id,
+                    reclaimed['total'] / 2**30, self.inputs.policy)
+        self._results['reclaimed'] = reclaimed
+        self._results['report'] = report
+        return runtime
+
+
+class MriqcInfoInputSpec(SingularityInputSpec):
     """ Command line arguments/options for mriqc
     """
     # singularity arguments
@@ -39,45 +444,76 @@ class MriqcInfoInputSpec(CommandLineInputSpec):
         mandatory=True,
         position=3
     )
+    bind_work = traits.Directory(
+        argstr='-B %s:/WORK',
+        desc='persistent work directory, ex: on local scratch, reused by '
+             'repeat runs',
+        exists=True,
+        nohash=True,
+        position=4
+    )
+    bind_templateflow = traits.Directory(
+        argstr='-B %s:/TEMPLATEFLOW:ro',
+        desc='pre-populated TemplateFlow cache, mounted read-only',
+        exists=True,
+        nohash=True,
+        position=5
+    )
     container = File(
         argstr='%s',
         desc='path to singularity image',
         exists=True,
         mandatory=True,
-        position=4
+        position=6
     )
     # mriqc arguments
     io_partic = traits.Bool(
         argstr='/BIDS /PROC/mriqc participant',
         desc='required positional arguments',
         mandatory=True,
-        position=5
+        position=7
     )
-    partic_lab = traits.Str(
+    partic_lab = InputMultiObject(
+        traits.Str,
         argstr='--participant_label %s',
-        desc='subject id/ursi',
+        desc='subject id/ursi, or several run in one call',
         mandatory=True,
-        position=6
+        position=8
     )
     ncpus = traits.Int(
         argstr='--n_cpus %i',
         desc='number of cpus',
         mandatory=True,
-        position=7
+        nohash=True,
+        position=9
     )
     ants_threads = traits.Int(
         argstr='--ants-nthreads %i',
         desc=f"cpus per ants: requires cpus/2 since ants threads typically\n"
              f"require 4GB per cpu and our cpus have 2GB per cpu.",
         mandatory=True,
-        position=8
+        nohash=True,
+        position=10
     )
     mem = traits.Int(
         argstr='--mem_gb %i',
-        desc=f"memory required, based on cpus, for cases when all cpus on a\n"
-             f"node are in use.",
+        desc=f"memory limit, from the memory model of the threads and\n"
+             f"image sizes, for cases when all cpus on a node are in use.",
         mandatory=True,
-        position=9
+        nohash=True,
+        position=11
+    )
+    modalities = traits.Str(
+        argstr='--modalities %s',
+        desc='limit to T1w and/or bold, space separated',
+        position=12
+    )
+    work_dir = traits.Str(
+        argstr='-w /PROC/%s',
+        desc='work directory relative to bind_work, or to bind_out when no '
+             'work directory is bound, shared by the participants of a call',
+        nohash=True,
+        position=13
     )
 
 
@@ -85,13 +521,70 @@ class MriqcInfoOutputSpec(TraitedSpec):
     qc_dir = traits.Directory(desc="mriqc directory", exists=False)
 
 
-class Mriqc(CommandLine):
+class Mriqc(SingularityCommandLine):
     """ Call mriqc from singularity container.
+
+    Several participants run in one call, sharing the startup and template
+    loading of mriqc, and its work_dir. Only participants missing reports
+    are passed to mriqc.
     """
     input_spec = MriqcInfoInputSpec
     output_spec = MriqcInfoOutputSpec
     _cmd = 'singularity'
-    #_cmd = 'echo'
+    _complete_inputs = ['bind_in', 'bind_out', 'partic_lab']
+
+    def is_complete(self):
+        """ A report exists for every image of the participants' modalities.
+        """
+        return len(self._pending()) == 0
+
+    def _pending(self):
+        """ Participants missing a report for any of their images.
+        """
+        pending = []
+        for label in self.inputs.partic_lab:
+            images = sum(self._label_images(label).values(), [])
+            reports = [f"{self.inputs.bind_out}/mriqc/"
+                       f"{os.path.basename(img).split('.')[0]}.html" for img
+                       in images]
+            if len(reports) == 0 or not all(os.path.isfile(report) for
+                                            report in reports):
+                pending.append(label)
+        return pending
+
+    def _datatypes(self):
+        """ Modalities checked, paired with their BIDS datatype.
+        """
+        modalities = ['T1w', 'bold']
+        if isdefined(self.inputs.modalities):
+            modalities = self.inputs.modalities.split()
+        return {modality: 'anat' if modality == 'T1w' else 'func' for
+                modality in modalities}
+
+    def _label_images(self, label):
+        """ Images of a participant, per datatype of the modalities.
+        """
+        return {datatype: glob.glob(f"{self.inputs.bind_in}/sub-{label}/*/"
+                                    f"{datatype}/*_{modality}.nii*") for
+                modality, datatype in self._datatypes().items()}
+
+    def _images(self):
+        images = {datatype: [] for datatype in self._datatypes().values()}
+        if not isdefined(self.inputs.partic_lab) or \
+                not isdefined(self.inputs.bind_in):
+            return images
+        for label in self.inputs.partic_lab:
+            for datatype, paths in self._label_images(label).items():
+                images[datatype] += paths
+        return images
+
+    def _format_arg(self, name, spec, value):
+        # Participants of a cohort whose reports exist are left out
+        if name == 'partic_lab' and self.inputs.skip_complete and \
+                all(isdefined(getattr(self.inputs, field)) for field in
+                    self._complete_inputs):
+            value = self._pending() or value
+        return super(Mriqc, self)._format_arg(name, spec, value)
 
     def _list_outputs(self):
         outputs = {}
@@ -99,7 +592,127 @@ class Mriqc(CommandLine):
         return outputs
 
 
-class AntsCorticalThicknessInfoInputSpec(CommandLineInputSpec):
+class MriqcGroupInputSpec(SingularityInputSpec):
+    """ Command line arguments/options for group level mriqc
+    """
+    # singularity arguments
+    mode = traits.Str(
+        argstr="%s",
+        desc="singularity mode",
+        mandatory=True,
+        position=0
+    )
+    env = traits.Str(
+        argstr="%s",
+        desc="clear host env variables",
+        mandatory=True,
+        position=1
+    )
+    bind_in = traits.Directory(
+        argstr='-B %s:/BIDS',
+        desc='bids directory',
+        exists=True,
+        mandatory=True,
+        position=2
+    )
+    bind_out = traits.Directory(
+        argstr='-B %s:/PROC',
+        desc='parent direct to outputs',
+        exists=True,
+        mandatory=True,
+        position=3
+    )
+    bind_work = traits.Directory(
+        argstr='-B %s:/WORK',
+        desc='persistent work directory, ex: on local scratch, reused by '
+             'repeat runs',
+        exists=True,
+        nohash=True,
+        position=4
+    )
+    bind_templateflow = traits.Directory(
+        argstr='-B %s:/TEMPLATEFLOW:ro',
+        desc='pre-populated TemplateFlow cache, mounted read-only',
+        exists=True,
+        nohash=True,
+        position=5
+    )
+    container = File(
+        argstr='%s',
+        desc='path to singularity image',
+        exists=True,
+        mandatory=True,
+        position=6
+    )
+    # mriqc arguments
+    io_group = traits.Bool(
+        argstr='/BIDS /PROC/mriqc group',
+        desc='required positional arguments',
+        mandatory=True,
+        position=7
+    )
+    modalities = traits.Str(
+        argstr='--modalities %s',
+        desc='limit to T1w and/or bold, space separated',
+        position=8
+    )
+    work_dir = traits.Str(
+        argstr='-w /PROC/%s',
+        desc='work directory relative to bind_work, or to bind_out when no '
+             'work directory is bound',
+        nohash=True,
+        position=9
+    )
+    qc_dir = traits.Str(
+        desc='mriqc directory of the participant runs, used to order nodes'
+    )
+
+
+class MriqcGroupOutputSpec(TraitedSpec):
+    group_tsvs = traits.List(File(exists=False),
+                             desc="image quality metrics of all participants")
+
+
+class MriqcGroup(SingularityCommandLine):
+    """ Aggregate the image quality metrics of all participants in mriqc's
+        group tables and reports.
+    """
+    input_spec = MriqcGroupInputSpec
+    output_spec = MriqcGroupOutputSpec
+    _cmd = 'singularity'
+    _complete_inputs = ['bind_out']
+
+    def _modalities(self):
+        if isdefined(self.inputs.modalities):
+            return self.inputs.modalities.split()
+        return ['T1w', 'bold']
+
+    def is_complete(self):
+        """ Group tables are newer than the metrics of every participant.
+        """
+        qc_dir = f"{self.inputs.bind_out}/mriqc"
+        n_iqms = 0
+        for modality in self._modalities():
+            iqms = glob.glob(f"{qc_dir}/sub-*/**/*_{modality}.json",
+                             recursive=True)
+            if len(iqms) == 0:
+                continue
+            n_iqms += len(iqms)
+            tsv = f"{qc_dir}/group_{modality}.tsv"
+            if not os.path.isfile(tsv) or os.stat(tsv).st_mtime < \
+                    max(os.stat(iqm).st_mtime for iqm in iqms):
+                return False
+        return n_iqms > 0
+
+    def _list_outputs(self):
+        outputs = {}
+        outputs['group_tsvs'] = [f"{self.inputs.bind_out}/mriqc/group_"
+                                 f"{modality}.tsv" for modality in
+                                 self._modalities()]
+        return outputs
+
+
+class AntsCorticalThicknessInfoInputSpec(SingularityInputSpec):
     """ Command line arguments/options for antsCorticalThickness.sh
     """
     # singularity arguments
@@ -217,19 +830,43 @@ class AntsCorticalThicknessInfoInputSpec(CommandLineInputSpec):
         mandatory=True,
         position=15
     )
+    num_threads = traits.Int(
+        desc="threads of ITK, set in the container environment",
+        nohash=True
+    )
 
 
 class AntsCorticalThicknessInfoOutputSpec(TraitedSpec):
     seg_file = traits.Directory(desc="ANTs segmentation file", exists=False)
 
 
-class AntsCorticalThickness(CommandLine):
+class AntsCorticalThickness(SingularityCommandLine):
     """ Call antsCorticalThickness.sh from Mindboggle container.
     """
     input_spec = AntsCorticalThicknessInfoInputSpec
     output_spec = AntsCorticalThicknessInfoOutputSpec
     _cmd = 'singularity'
-    #_cmd = 'echo'
+    _complete_inputs = ['bind_out', 'out']
+
+    def is_complete(self):
+        """ The segmentation and thickness images exist.
+        """
+        prefix = f"{self.inputs.bind_out}/{self.inputs.out}"
+        return all(os.path.isfile(f"{prefix}{suffix}") for suffix in
+                   ['BrainSegmentation.nii.gz', 'CorticalThickness.nii.gz'])
+
+    def _images(self):
+        if isdefined(self.inputs.bind_in) and isdefined(self.inputs.in_img):
+            return {'anat': [f"{self.inputs.bind_in}/{self.inputs.in_img}"]}
+        return {'anat': []}
+
+    def _container_env(self):
+        # antsCorticalThickness.sh has no thread option, its ANTs and ITK
+        #   programs read the thread count from the environment.
+        if isdefined(self.inputs.num_threads):
+            return {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS':
+                    self.inputs.num_threads}
+        return {}
 
     def _list_outputs(self):
         outputs = {}
@@ -237,7 +874,7 @@ class AntsCorticalThickness(CommandLine):
         return outputs
 
 
-class FreesurferMBInfoInputSpec(CommandLineInputSpec):
+class FreesurferMBInfoInputSpec(SingularityInputSpec):
     """ Command line arguments/options for recon-all
     """
     # singularity arguments
@@ -287,10 +924,14 @@ class FreesurferMBInfoInputSpec(CommandLineInputSpec):
         mandatory=True,
         position=6
     )
+    stage = traits.Enum(
+        'all', 'autorecon1', 'autorecon2', 'autorecon3',
+        usedefault=True,
+        desc='recon-all stage run by fs_cmd, sets the completion check'
+    )
     in_img = traits.Str(
         argstr="-i /BIDS/%s",
-        desc="anatomical image",
-        mandatory=True,
+        desc="anatomical image, imported by all or autorecon1",
         position=7
     )
     fs_id = traits.Str(
@@ -315,21 +956,112 @@ class FreesurferMBInfoInputSpec(CommandLineInputSpec):
         argstr="-openmp %i",
         desc='number of cpus',
         mandatory=True,
+        nohash=True,
         position=11
     )
+    prev_recon_dir = traits.Str(
+        desc='recon_dir of the previous stage, runs this stage after it'
+    )
 
 
 class FreesurferMBInfoOutputSpec(TraitedSpec):
     recon_dir = traits.Directory(desc="recon-all dir", exists=False)
 
 
-class FreesurferMB(CommandLine):
+class FreesurferMB(SingularityCommandLine):
     """ Run recon-all from mindboggle singularity image
+
+    recon-all may run as a whole, or one autorecon stage per node so a run
+    killed at the walltime resumes at the last finished stage. Stages are
+    complete when their last outputs are newer than any recon-all.error,
+    and no run of them, or of an earlier stage, was left unfinished.
+
+    While a stage runs, scripts/IsRunning.mjxproc_<stage> marks it. Runs
+    killed at the walltime leave the marker behind, as recon-all does with
+    its own IsRunning files, which -no-isrunning stage runs do not write.
     """
     input_spec = FreesurferMBInfoInputSpec
     output_spec = FreesurferMBInfoOutputSpec
     _cmd = 'singularity'
-    #_cmd = 'echo'
+    _complete_inputs = ['bind_out', 'fs_sd', 'fs_id']
+
+    # Last outputs of each stage, relative to the subject directory:
+    #   skull stripping, white surfaces and the second inflation (sulc),
+    #   then the segmentation and parcellation stats
+    stage_outputs = {
+        'autorecon1': ['mri/brainmask.mgz'],
+        'autorecon2': ['surf/lh.white', 'surf/rh.white', 'surf/lh.sulc',
+                       'surf/rh.sulc'],
+        'autorecon3': ['stats/aseg.stats', 'stats/wmparc.stats',
+                       'stats/lh.aparc.stats', 'stats/rh.aparc.stats']
+    }
+    stage_outputs['all'] = stage_outputs['autorecon3']
+
+    # Stages in the order recon-all runs them
+    stages = ['autorecon1', 'autorecon2', 'autorecon3']
+
+    def _subj_dir(self):
+        return (f"{self.inputs.bind_out}/{self.inputs.fs_sd}/"
+                f"{self.inputs.fs_id}")
+
+    def _format_arg(self, name, spec, value):
+        # A subject is imported once, reruns resume from its directory
+        if name == 'in_img' and os.path.isfile(
+                f"{self._subj_dir()}/mri/orig/001.mgz"):
+            return None
+        return super(FreesurferMB, self)._format_arg(name, spec, value)
+
+    def _images(self):
+        # Later stages read the conformed image imported by autorecon1
+        if isdefined(self.inputs.bind_in) and isdefined(self.inputs.in_img):
+            return {'anat': [f"{self.inputs.bind_in}/{self.inputs.in_img}"]}
+        return {'anat': []}
+
+    def _unfinished(self):
+        """ Stages a killed run may have left unfinished, from the stage it
+            was running onwards. IsRunning files of recon-all itself, or of
+            a whole run, mark every stage.
+        """
+        first = len(self.stages)
+        for marker in glob.glob(f"{self._subj_dir()}/scripts/IsRunning*"):
+            stage = os.path.basename(marker).replace('IsRunning.mjxproc_', '')
+            first = min(first, self.stages.index(stage) if stage in
+                        self.stages else 0)
+        return self.stages[first:]
+
+    def is_complete(self):
+        """ The stage's outputs were written, and not followed by an error or
+            a killed run.
+        """
+        subj_dir = self._subj_dir()
+        outputs = [f"{subj_dir}/{out}" for out in
+                   self.stage_outputs[self.inputs.stage]]
+        if not all(os.path.isfile(out) for out in outputs):
+            return False
+        stage = 'autorecon3' if self.inputs.stage == 'all' else \
+            self.inputs.stage
+        if stage in self._unfinished():
+            return False
+        error = f"{subj_dir}/scripts/recon-all.error"
+        return not os.path.isfile(error) or os.path.getmtime(error) < min(
+            os.path.getmtime(out) for out in outputs)
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        # Subjects are created by recon-all -i, markers are only written in
+        #   existing subject directories
+        subj_dir = self._subj_dir()
+        marker = f"{subj_dir}/scripts/IsRunning.mjxproc_{self.inputs.stage}"
+        if os.path.isdir(subj_dir) and not (self.inputs.skip_complete and
+                                            self.is_complete()):
+            os.makedirs(os.path.dirname(marker), exist_ok=True)
+            open(marker, 'w').close()
+        try:
+            return super(FreesurferMB, self)._run_interface(
+                runtime, correct_return_codes)
+        finally:
+            # Reached unless the run is killed, errors leave recon-all.error
+            if os.path.isfile(marker):
+                os.remove(marker)
 
     def _list_outputs(self):
         outputs = {}
@@ -337,7 +1069,7 @@ class FreesurferMB(CommandLine):
         return outputs
 
 
-class MindboggleInfoInputSpec(CommandLineInputSpec):
+class MindboggleInfoInputSpec(SingularityInputSpec):
     """ Command line arguments/options for mindboggle
     """
     # singularity arguments
@@ -403,6 +1135,7 @@ class MindboggleInfoInputSpec(CommandLineInputSpec):
         argstr='--cpus %i',
         desc='number of cpus',
         mandatory=True,
+        nohash=True,
         position=9
     )
 
@@ -411,13 +1144,20 @@ class MindboggleInfoOutputSpec(TraitedSpec):
     mb_dir = traits.Directory(desc="mindboggle dir", exists=False)
 
 
-class Mindboggle(CommandLine):
+class Mindboggle(SingularityCommandLine):
     """ Run mindboggle from singularity image
     """
     input_spec = MindboggleInfoInputSpec
     output_spec = MindboggleInfoOutputSpec
     _cmd = 'singularity'
-    #_cmd = 'echo'
+    _complete_inputs = ['bind_in', 'out', 'fs_dir']
+
+    def is_complete(self):
+        """ Shape tables were written for the subject.
+        """
+        tables = (f"{self.inputs.bind_in}/{self.inputs.out}/"
+                  f"{os.path.basename(self.inputs.fs_dir)}/tables")
+        return os.path.isdir(tables) and len(os.listdir(tables)) > 0
 
     def _list_outputs(self):
         outputs = {}
@@ -425,7 +1165,7 @@ class Mindboggle(CommandLine):
         return outputs
 
 
-class FmriprepInfoInputSpec(CommandLineInputSpec):
+class FmriprepInfoInputSpec(SingularityInputSpec):
     """ Command line arguments/options for fmriprep
     """
     # singularity arguments
@@ -461,61 +1201,122 @@ class FmriprepInfoInputSpec(CommandLineInputSpec):
         mandatory=True,
         position=4
     )
+    bind_work = traits.Directory(
+        argstr='-B %s:/WORK',
+        desc='persistent work directory, ex: on local scratch, reused by '
+             'repeat runs',
+        exists=True,
+        nohash=True,
+        position=5
+    )
+    bind_templateflow = traits.Directory(
+        argstr='-B %s:/TEMPLATEFLOW:ro',
+        desc='pre-populated TemplateFlow cache, mounted read-only',
+        exists=True,
+        nohash=True,
+        position=6
+    )
     container = File(
         argstr='%s',
         desc='path to singularity image',
         exists=True,
         mandatory=True,
-        position=5
+        position=7
     )
     # fmriprep arguments
     io_partic = traits.Bool(
         argstr='/BIDS /PROC participant',
         mandatory=True,
-        position=6
+        position=8
+    )
+    out_dir = traits.Str(
+        desc='output directory relative to bind_out, bind_out by default, '
+             'fmriprep writes to its fmriprep sub-directory'
     )
     skip_validation = traits.Bool(
         argstr='--skip_bids_validation',
         desc='skip bids validation',
         mandatory=True,
-        position=7
+        position=9
     )
     partic_lab = traits.Str(
         argstr='--participant_label %s',
         desc='subject id',
         mandatory=True,
-        position=8
+        position=10
     )
     nthreads = traits.Int(
         argstr='--omp-nthreads %i',
         desc='number of cpus',
         mandatory=True,
-        position=9
+        nohash=True,
+        position=11
     )
     aroma = traits.Bool(
         argstr='--use-aroma',
         dec='ICA motion artifact denoising',
         mandatory=True,
-        position=10
+        position=12
     )
     out_space = traits.Str(
         argstr='--output-spaces %s',
         desc='define output space(s) of results, space separated',
         mandatory=True,
-        position=11
+        position=13
     )
     recon_dir = traits.Str(
         argstr='--fs-subjects-dir /PROC/%s',
         desc='path to recon-all parent directory',
         exists=True,
         mandatory=True,
-        position=12
+        position=14
     )
     fs_license = traits.Bool(
         argstr='--fs-license-file /FREESURFER_HOME/license.txt',
         desc='path to freesurfer license',
         mandatory=True,
-        position=13
+        position=15
+    )
+    nprocs = traits.Int(
+        argstr='--nthreads %i',
+        desc='maximum number of threads across all processes',
+        nohash=True,
+        position=16
+    )
+    anat_only = traits.Bool(
+        argstr='--anat-only',
+        desc='run the anatomical workflows only',
+        position=17
+    )
+    task_id = traits.Str(
+        argstr='--task-id %s',
+        desc='process the bold runs of a single task',
+        position=18
+    )
+    anat_derivatives = traits.Str(
+        argstr='--anat-derivatives /PROC/%s',
+        desc='fmriprep derivatives of an anatomical pass to reuse, relative '
+             'to bind_out, requires fmriprep 20.1 or later',
+        position=19
+    )
+    session = traits.Str(
+        argstr='--bids-filter-file /PROC/%s',
+        desc='process the bold runs of a single session, ex: ses-01, with a '
+             'bids filter file written to bind_out',
+        position=20
+    )
+    work_dir = traits.Str(
+        argstr='-w /PROC/%s',
+        desc='work directory relative to bind_work, or to bind_out when no '
+             'work directory is bound',
+        nohash=True,
+        position=21
+    )
+    mem_mb = traits.Int(
+        argstr='--mem-mb %i',
+        desc='memory limit of fmriprep processes, from the memory model',
+        nohash=True,
+        position=22
     )
 
 
@@ -523,15 +1324,92 @@ class FmriprepInfoOutputSpec(TraitedSpec):
     fmri_dir = traits.Str(desc="freesurfer dir")
 
 
-class Fmriprep(CommandLine):
+class Fmriprep(SingularityCommandLine):
     """ Run fmriprep from singularity image
     """
     input_spec = FmriprepInfoInputSpec
     output_spec = FmriprepInfoOutputSpec
     _cmd = 'singularity'
-    #_cmd = 'echo'
+    _complete_inputs = ['bind_out', 'partic_lab']
+
+    def is_complete(self):
+        """ The participant's html report was written, or for a single
+            task, session or anatomical pass, its preprocessed images.
+        """
+        subj_dir = f"{self.inputs.bind_out}/{self._fmri_dir()}"
+        func_dir = subj_dir
+        if isdefined(self.inputs.session):
+            func_dir = f"{subj_dir}/{self.inputs.session}"
+        if isdefined(self.inputs.task_id):
+            return len(glob.glob(f"{func_dir}/**/func/*_task-"
+                                 f"{self.inputs.task_id}_*desc-preproc_"
+                                 f"bold.nii*", recursive=True)) > 0
+        if isdefined(self.inputs.session):
+            return len(glob.glob(f"{func_dir}/func/*desc-preproc_"
+                                 f"bold.nii*")) > 0
+        if isdefined(self.inputs.anat_only) and self.inputs.anat_only:
+            return len(glob.glob(f"{subj_dir}/**/anat/*desc-preproc_"
+                                 f"T1w.nii*", recursive=True)) > 0
+        return os.path.isfile(f"{subj_dir}.html")
+
+    def _label(self):
+        label = self.inputs.partic_lab
+        return label if label.startswith('sub-') else f'sub-{label}'
+
+    def _fmri_dir(self, label=None):
+        """ Derivatives of the participant, relative to bind_out.
+        """
+        label = self._label() if label is None else label
+        if isdefined(self.inputs.out_dir):
+            return f"{self.inputs.out_dir}/fmriprep/{label}"
+        return f"fmriprep/{label}"
+
+    def _images(self):
+        images = {'anat': []}
+        if not (isdefined(self.inputs.anat_only) and self.inputs.anat_only):
+            images['func'] = []
+        if not isdefined(self.inputs.bind_in) or \
+                not isdefined(self.inputs.partic_lab):
+            return images
+
+        subj_dir = f"{self.inputs.bind_in}/{self._label()}"
+        images['anat'] = glob.glob(f"{subj_dir}/*/anat/*_T1w.nii*")
+        if 'func' in images:
+            ses = self.inputs.session if isdefined(self.inputs.session) \
+                else '*'
+            task = f"*_task-{self.inputs.task_id}_" if \
+                isdefined(self.inputs.task_id) else ''
+            images['func'] = glob.glob(f"{subj_dir}/{ses}/func/{task}*_"
+                                       f"bold.nii*")
+        return images
+
+    def _filter_file(self):
+        """ Bids filter file of the session, and task, relative to bind_out.
+        """
+        task = f"_task-{self.inputs.task_id}" if \
+            isdefined(self.inputs.task_id) else ''
+        return f"workflows/{self._label()}/bids_filter_{self.inputs.session}" \
+               f"{task}.json"
+
+    def _format_arg(self, name, spec, value):
+        if name == 'session':
+            return spec.argstr % self._filter_file()
+        if name == 'io_partic' and isdefined(self.inputs.out_dir):
+            return f"/BIDS /PROC/{self.inputs.out_dir} participant"
+        return super(Fmriprep, self)._format_arg(name, spec, value)
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        if isdefined(self.inputs.session):
+            # Bold runs of the session, other queries are left as they are
+            path = f"{self.inputs.bind_out}/{self._filter_file()}"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump({'bold': {'session': self.inputs.session[4:]}}, f,
+                          indent='\t')
+        return super(Fmriprep, self)._run_interface(runtime,
+                                                    correct_return_codes)
 
     def _list_outputs(self):
         outputs = {}
-        outputs['fmri_dir'] = f"fmriprep/{self.inputs.partic_lab}"
+        outputs['fmri_dir'] = self._fmri_dir(self.inputs.partic_lab)
         return outputs
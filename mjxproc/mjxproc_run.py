@@ -3,12 +3,147 @@
 Created on Sun March 10 15:44:46 2020
 @author: Ryan Hammonds (ryanhammonds)
 '''
-from workflow import create_workflow
-from utils import Subject
+import os
+import sys
+from utils import Subject, BidsIndex, find_subjects
 import warnings
 warnings.filterwarnings("ignore")
 
 
+def add_common_args(parser):
+    """ Options shared by single subject and batch runs.
+    """
+    parser.add_argument('-qc_simg',
+                        default=['/mnt/Filbey/common/Studies/MJXProcessing/singularity/mriqc0.15.2rc1.simg'],
+                        nargs=1,
+                        required=False,
+                        help='Path to mriqc singularity image.\n')
+    parser.add_argument('-mb_simg',
+                        default=['/mnt/Filbey/common/Studies/MJXProcessing/singularity/mindboggle.simg'],
+                        nargs=1,
+                        required=False,
+                        help='Path to mindboggle singularity image.\n')
+    parser.add_argument('-fs_simg',
+                        default=['/mnt/Filbey/common/Studies/MJXProcessing/singularity/mindboggle.simg'],
+                        nargs=1,
+                        required=False,
+                        help='Path to freesurfer singularity image.\n')
+    parser.add_argument('-fmri_simg',
+                        default=['/mnt/Filbey/common/Studies/MJXProcessing/singularity/fmriprep-20.0.5.simg'],
+                        nargs=1,
+                        required=False,
+                        help='Path to fmriprep singularity image.\n')
+    parser.add_argument('-ncpus',
+                        default=[6],
+                        nargs=1,
+                        type=int,
+                        required=False,
+                        help='Number of cpus for parallel processing.\n')
+    parser.add_argument('-plugin',
+                        default=['CriticalPath'],
+                        nargs=1,
+                        type=str,
+                        required=False,
+                        help=f"Nipype execution plugin. CriticalPath (MultiProc "
+                             f"with threads sized by each node's remaining "
+                             f"path), MultiProc or Linear.\n")
+    parser.add_argument('-convert_jobs',
+                        default=[1],
+                        nargs=1,
+                        type=int,
+                        required=False,
+                        help='Number of concurrent dcm2niix conversions.\n')
+    parser.add_argument('-compress',
+                        action='store_true',
+                        required=False,
+                        help='Write gzipped .nii.gz images, compressed by '
+                             'pigz when on the PATH.\n')
+    parser.add_argument('-split_fmriprep',
+                        action='store_true',
+                        required=False,
+                        help='Run fmriprep as an anatomical pass, then one '
+                             'node per bold task. Requires fmriprep 20.1 '
+                             'or later.\n')
+    parser.add_argument('-dry_run', '--dry-run',
+                        action='store_true',
+                        required=False,
+                        help='Print the commands, node graph, binds and '
+                             'cpu/memory split of the run, with its '
+                             'estimated wall time, without running it.\n')
+    parser.add_argument('-instances',
+                        action='store_true',
+                        required=False,
+                        help='Run nodes sharing a container image in one '
+                             'singularity instance, stopped when the run '
+                             'ends.\n')
+    parser.add_argument('-scratch_dir',
+                        default=[None],
+                        nargs=1,
+                        type=str,
+                        required=False,
+                        help='Node-local directory, ex: $TMPDIR. Images, '
+                             'BIDS inputs and derivatives are staged there '
+                             'and final derivatives synced back.\n')
+    parser.add_argument('-image_cache',
+                        default=[None],
+                        nargs=1,
+                        type=str,
+                        required=False,
+                        help='Local image cache shared by jobs on a node, '
+                             'defaults to scratch_dir/images.\n')
+    parser.add_argument('-image_cache_gb',
+                        default=[50],
+                        nargs=1,
+                        type=float,
+                        required=False,
+                        help='Size the image cache is evicted down to, least '
+                             'recently used first.\n')
+    parser.add_argument('-work_dir',
+                        default=[None],
+                        nargs=1,
+                        type=str,
+                        required=False,
+                        help='Persistent work directory of mriqc and fmriprep, '
+                             'ex: on local scratch, reused by repeat runs. '
+                             'Not staged or removed with -scratch_dir.\n')
+    parser.add_argument('-log_max_mb',
+                        default=[None],
+                        nargs=1,
+                        type=float,
+                        required=False,
+                        help=f"Stream container output to rotating "
+                             f"stdout.log/stderr.log files of this size (MB) "
+                             f"in each node's _report directory, rather than "
+                             f"memory.\n")
+    parser.add_argument('-retention',
+                        default=['all'],
+                        nargs=1,
+                        choices=['all', 'final', 'minimal'],
+                        required=False,
+                        help=f"Outputs kept once a subject finishes. all: "
+                             f"everything. final: ANTs intermediate images "
+                             f"removed (or gzipped if uncompressed), "
+                             f"recon-all tmp and nipype node directories "
+                             f"removed, node logs kept. minimal: ANTs "
+                             f"intermediates and work directories removed "
+                             f"too.\n")
+    parser.add_argument('-templateflow_dir',
+                        default=[None],
+                        nargs=1,
+                        type=str,
+                        required=False,
+                        help='Pre-populated TemplateFlow cache, mounted '
+                             'read-only into mriqc and fmriprep, for nodes '
+                             'without internet access.\n')
+    parser.add_argument('-run_nodes',
+                        default=['mriqc', 'ants', 'freesurfer', 'mindboggle', 'fmriprep'],
+                        nargs='+',
+                        required=False,
+                        help=f"List of nodes to run: \n" \
+                             f"mriqc, ants, freesurfer, mindboggle, and/or fmriprep")
+    return parser
+
+
 def get_parser():
     import argparse
     desc = 'An Automated Workflow MJX Data Processing.'
@@ -20,9 +155,11 @@ def get_parser():
                         help='Subject ID (i.e. sub-1234)\n')
     parser.add_argument('session',
                         default=None,
-                        nargs=1,
-                        type=str,
-                        help='Subject session, either ses-01 or ses-01.\n')
+                        nargs='+',
+                        choices=['ses-01', 'ses-02'],
+                        help='Subject session(s), ses-01 and/or ses-02. '
+                             'Sessions are processed side by side in one '
+                             'workflow.\n')
     parser.add_argument('raw_dir',
                         default=None,
                         nargs=1,
@@ -38,75 +175,363 @@ def get_parser():
                         nargs=1,
                         type=str,
                         help='Path to write process outputs.\n')
-    parser.add_argument('-qc_simg',
-                        default='/mnt/Filbey/common/Studies/MJXProcessing/singularity/mriqc0.15.2rc1.simg',
+    return add_common_args(parser)
+
+
+def get_batch_parser():
+    import argparse
+    desc = 'Convert and process a cohort of subjects in a single job.'
+    parser = argparse.ArgumentParser(prog='mjxproc batch', description=desc)
+    parser.add_argument('subjects',
+                        default=None,
+                        nargs=1,
+                        type=str,
+                        help=f"Subject list file, one raw data folder per "
+                             f"line, or a raw root folder of subjects.\n")
+    parser.add_argument('bids_dir',
+                        default=None,
+                        nargs=1,
+                        type=str,
+                        help='Path to BIDS parent folder.\n')
+    parser.add_argument('proc_dir',
+                        default=None,
                         nargs=1,
+                        type=str,
+                        help='Path to write process outputs.\n')
+    parser.add_argument('-session',
+                        default=['ses-01'],
+                        nargs='+',
+                        choices=['ses-01', 'ses-02'],
                         required=False,
-                        help='Path to mriqc singularity image.\n')
-    parser.add_argument('-mb_simg',
-                        default='/mnt/Filbey/common/Studies/MJXProcessing/singularity/mindboggle.simg',
+                        help='Session(s) to process, ses-01 and/or ses-02. '
+                             'Subjects missing a session are skipped.\n')
+    parser.add_argument('-total_cpus',
+                        default=[None],
                         nargs=1,
+                        type=int,
                         required=False,
-                        help='Path to mindboggle singularity image.\n')
-    parser.add_argument('-fs_simg',
-                        default='/mnt/Filbey/common/Studies/MJXProcessing/singularity/mindboggle.simg',
+                        help=f"Cpus shared by all subjects, defaults to all "
+                             f"cpus on the node.\n")
+    parser.add_argument('-total_mem_gb',
+                        default=[None],
                         nargs=1,
+                        type=float,
                         required=False,
-                        help='Path to freesurfer singularity image.\n')
-    parser.add_argument('-fmri_simg',
-                        default='/mnt/Filbey/common/Studies/MJXProcessing/singularity/fmriprep-20.0.5.simg',
+                        help=f"Memory (GB) shared by all subjects, defaults "
+                             f"to 90%% of the node's memory.\n")
+    parser.add_argument('-cohort_mriqc',
+                        action='store_true',
+                        required=False,
+                        help='Run mriqc once for all subjects missing '
+                             'reports, then aggregate their metrics at the '
+                             'group level. With -scratch_dir, group tables '
+                             'only cover the staged subjects and are not '
+                             'synced back.\n')
+    return add_common_args(parser)
+
+
+def stage_run(args, subj_ids, bids_dir, proc_dir):
+    """ Stage images and subjects to scratch_dir, if given.
+
+    Returns
+    -------
+    stage : staging.Staging or None
+        staged run, None without scratch_dir
+    paths : dict
+        bids_dir, proc_dir and container images to run from
+    """
+    paths = {'bids_dir': bids_dir, 'proc_dir': proc_dir}
+    for simg in ['qc_simg', 'mb_simg', 'fs_simg', 'fmri_simg']:
+        paths[simg] = args[simg][0]
+    if args['scratch_dir'][0] is None:
+        return None, paths
+
+    from staging import Staging
+
+    stage = Staging(args['scratch_dir'][0], bids_dir, proc_dir,
+                    image_cache=args['image_cache'][0],
+                    cache_gb=args['image_cache_gb'][0])
+    for subj_id in subj_ids:
+        stage.add_subject(subj_id)
+    paths['bids_dir'] = stage.local_bids
+    paths['proc_dir'] = stage.local_proc
+    for simg in ['qc_simg', 'mb_simg', 'fs_simg', 'fmri_simg']:
+        if os.path.isfile(paths[simg]):
+            paths[simg] = stage.image(paths[simg])
+    return stage, paths
+
+
+def batch(argv=None):
+    # Get arguments
+    args = get_batch_parser().parse_args(argv)
+    args = vars(args)
+
+    # Workflow imports are slow, load them once arguments are valid
+    from workflow import create_batch_workflow, run_workflow
+    from profiler import write_timeline
+
+    # Nodes run from their own directories, resolve relative paths
+    bids_dir = os.path.abspath(args['bids_dir'][0])
+    proc_dir = os.path.abspath(args['proc_dir'][0])
+    for simg in ['qc_simg', 'mb_simg', 'fs_simg', 'fmri_simg']:
+        args[simg] = [os.path.abspath(args[simg][0])]
+    ses = sorted(set(args['session']))
+
+    # Dry runs index the BIDS tree in memory, nothing is written
+    BidsIndex.in_memory = args['dry_run']
+
+    # Convert every subject to BIDS, skipping those that fail
+    subj_ids = []
+    for raw_dir in find_subjects(args['subjects'][0]):
+        raw_dir = os.path.abspath(raw_dir)
+        try:
+            subject = Subject(raw_dir, bids_dir)
+        except IOError as err:
+            print(f'Skipping {raw_dir}:\n{err}')
+            continue
+        if args['dry_run']:
+            for job in subject.convert_jobs(compress=args['compress']):
+                if not job['done']:
+                    print(f"$ {job['cmd']}")
+            if set(ses).issubset(subject.bids_sessions()):
+                subj_ids.append(subject.subj_id)
+            continue
+        try:
+            subject.to_bids(convert_jobs=args['convert_jobs'][0],
+                            compress=args['compress'])
+        except (IOError, RuntimeError) as err:
+            print(f'Skipping {raw_dir}:\n{err}')
+            continue
+        finally:
+            # Profile of each dcm2niix call
+            if len(subject.profile) > 0:
+                write_timeline(subject.profile, f'{proc_dir}/workflows/'
+                                                f'{subject.subj_id}',
+                               prefix='convert')
+        missing = [session for session in ses if not os.path.isdir(
+            f'{bids_dir}/{subject.subj_id}/{session}')]
+        if len(missing) > 0:
+            print(f"Skipping {subject.subj_id}: {' '.join(missing)} not in "
+                  f"BIDS.")
+            continue
+        subj_ids.append(subject.subj_id)
+
+    if len(subj_ids) == 0:
+        print('No subjects to process.')
+        return
+
+    plugin_args = {}
+    if args['total_cpus'][0] is not None:
+        plugin_args['n_procs'] = args['total_cpus'][0]
+    if args['total_mem_gb'][0] is not None:
+        plugin_args['memory_gb'] = args['total_mem_gb'][0]
+
+    if args['dry_run']:
+        from plan import plan_workflow, format_plan
+        wf = create_batch_workflow(subj_ids, ses, bids_dir, proc_dir,
+                                   qc_simg=args['qc_simg'][0],
+                                   mb_simg=args['mb_simg'][0],
+                                   fs_simg=args['fs_simg'][0],
+                                   fmri_simg=args['fmri_simg'][0],
+                                   ncpus=args['ncpus'][0],
+                                   run_nodes=args['run_nodes'],
+                                   compress=args['compress'],
+                                   split_fmriprep=args['split_fmriprep'],
+                                   cohort_mriqc=args['cohort_mriqc'],
+                                   work_dir=args['work_dir'][0],
+                                   templateflow_dir=args['templateflow_dir'][0],
+                                   retention=args['retention'][0],
+                                   log_max_mb=args['log_max_mb'][0],
+                                   dry_run=True)
+        print(format_plan(plan_workflow(wf, plugin_args,
+                                        f'{proc_dir}/workflows')))
+        return
+
+    # Run all subject workflows under one cpu/memory budget
+    stage, paths = stage_run(args, subj_ids, bids_dir, proc_dir)
+    try:
+        wf = create_batch_workflow(subj_ids, ses, paths['bids_dir'],
+                                   paths['proc_dir'],
+                                   qc_simg=paths['qc_simg'],
+                                   mb_simg=paths['mb_simg'],
+                                   fs_simg=paths['fs_simg'],
+                                   fmri_simg=paths['fmri_simg'],
+                                   ncpus=args['ncpus'][0],
+                                   run_nodes=args['run_nodes'],
+                                   compress=args['compress'],
+                                   split_fmriprep=args['split_fmriprep'],
+                                   cohort_mriqc=args['cohort_mriqc'],
+                                   instances=args['instances'],
+                                   work_dir=args['work_dir'][0],
+                                   templateflow_dir=args['templateflow_dir'][0],
+                                   retention=args['retention'][0],
+                                   log_max_mb=args['log_max_mb'][0])
+        run_workflow(wf, args['plugin'][0], plugin_args)
+    finally:
+        if stage is not None:
+            stage.sync()
+            stage.cleanup()
+
+
+def get_convert_parser():
+    import argparse
+    desc = 'Convert a subject\'s raw data to BIDS, without nipype.'
+    parser = argparse.ArgumentParser(prog='mjxproc convert', description=desc)
+    parser.add_argument('raw_dir',
+                        default=None,
                         nargs=1,
+                        type=str,
+                        help='Path to single subject raw data folder.\n')
+    parser.add_argument('bids_dir',
+                        default=None,
+                        nargs=1,
+                        type=str,
+                        help='Path to BIDS parent folder.\n')
+    parser.add_argument('-session',
+                        default=None,
+                        nargs='+',
+                        choices=['ses-01', 'ses-02'],
                         required=False,
-                        help='Path to fmriprep singularity image.\n')
-    parser.add_argument('-ncpus',
-                        default=6,
+                        help='Sessions to convert, ses-01 and/or ses-02. '
+                             'Defaults to all sessions with raw data.\n')
+    parser.add_argument('-convert_jobs',
+                        default=[1],
                         nargs=1,
                         type=int,
                         required=False,
-                        help='Number of cpus for parallel processing.\n')
-    parser.add_argument('-run_nodes',
-                        default=['mriqc', 'ants', 'freesurfer', 'mindboggle', 'fmriprep'],
-                        nargs='+',
+                        help='Number of concurrent dcm2niix conversions.\n')
+    parser.add_argument('-compress',
+                        action='store_true',
                         required=False,
-                        help=f"List of nodes to run: \n" \
-                             f"mriqc, ants, freesurfer, mindboggle, and/or fmriprep")
+                        help='Write gzipped .nii.gz images, compressed by '
+                             'pigz when on the PATH.\n')
+    parser.add_argument('-dry_run', '--dry-run',
+                        action='store_true',
+                        required=False,
+                        help='Print the dcm2niix commands without running '
+                             'them.\n')
     return parser
 
 
-def main():
+def convert(argv=None):
     # Get arguments
-    args = get_parser().parse_args()
+    args = get_convert_parser().parse_args(argv)
     args = vars(args)
 
+    # Dry runs index the BIDS tree in memory, nothing is written
+    BidsIndex.in_memory = args['dry_run']
+    subject = Subject(args['raw_dir'][0], args['bids_dir'][0])
+    if args['dry_run']:
+        for job in subject.convert_jobs(sessions=args['session'],
+                                        compress=args['compress']):
+            if not job['done']:
+                print(f"$ {job['cmd']}")
+        return
+    os.makedirs(f"{subject.bids_path}/{subject.subj_id}", exist_ok=True)
+    out_files = subject.convert(sessions=args['session'],
+                                convert_jobs=args['convert_jobs'][0],
+                                compress=args['compress'])
+    print(f'{subject.subj_id}: {len(out_files)} images in BIDS, '
+          f'{len(subject.profile)} converted.')
+
+
+def run(argv=None):
+    # Get arguments
+    args = get_parser().parse_args(argv)
+    args = vars(args)
+
+    # Workflow imports are slow, load them once arguments are valid
+    from workflow import create_workflow, run_workflow
+    from scheduler import mem_calc
+
     args['subject'] = args['subject'][0]
-    args['session'] = args['session'][0]
-    args['raw_dir'] = args['raw_dir'][0]
-    args['bids_dir'] = args['bids_dir'][0]
-    args['proc_dir'] = args['proc_dir'][0]
+    # Nodes run from their own directories, resolve relative paths
+    args['raw_dir'] = os.path.abspath(args['raw_dir'][0])
+    args['bids_dir'] = os.path.abspath(args['bids_dir'][0])
+    args['proc_dir'] = os.path.abspath(args['proc_dir'][0])
+    for simg in ['qc_simg', 'mb_simg', 'fs_simg', 'fmri_simg']:
+        args[simg] = [os.path.abspath(args[simg][0])]
 
-    # Convert to BIDS
+    # Run entire preprocessing worflow, BIDS conversion included.
     raw_dir = args['raw_dir']
-    bids_dir = args['bids_dir']
-    subject = Subject(raw_dir, bids_dir)
-    subject.to_bids()
-
-    # Run entire preprocessing worflow.
     subj_id = args['subject']
-    ses = args['session']
+    ses = sorted(set(args['session']))
     bids_dir = args['bids_dir']
     proc_dir = args['proc_dir']
-    qc_simg = args['qc_simg']
-    mb_simg = args['mb_simg']
-    fs_simg = args['fs_simg']
-    fmri_simg = args['fmri_simg']
     ncpus = args['ncpus'][0]
     run_nodes = args['run_nodes']
-    wf = create_workflow(subj_id, ses, bids_dir, proc_dir, qc_simg, mb_simg,
-                         fs_simg, fmri_simg, ncpus, run_nodes)
-    wf.run()
+    plugin_args = {'n_procs': ncpus, 'memory_gb': mem_calc(ncpus)}
+
+    if args['dry_run']:
+        from plan import plan_workflow, format_plan
+        # Index the BIDS tree in memory, nothing is written
+        BidsIndex.in_memory = True
+        wf = create_workflow(subj_id, ses, bids_dir, proc_dir,
+                             args['qc_simg'][0], args['mb_simg'][0],
+                             args['fs_simg'][0], args['fmri_simg'][0],
+                             ncpus, run_nodes, raw_dir=raw_dir,
+                             convert_jobs=args['convert_jobs'][0],
+                             compress=args['compress'],
+                             split_fmriprep=args['split_fmriprep'],
+                             work_dir=args['work_dir'][0],
+                             templateflow_dir=args['templateflow_dir'][0],
+                             retention=args['retention'][0],
+                             log_max_mb=args['log_max_mb'][0],
+                             dry_run=True)
+        print(format_plan(plan_workflow(wf, plugin_args,
+                                        f'{proc_dir}/workflows')))
+        return
+
+    # Optionally run from node-local scratch
+    stage, paths = stage_run(args, [subj_id], bids_dir, proc_dir)
+    try:
+        wf = create_workflow(subj_id, ses, paths['bids_dir'],
+                             paths['proc_dir'], paths['qc_simg'],
+                             paths['mb_simg'], paths['fs_simg'],
+                             paths['fmri_simg'], ncpus, run_nodes,
+                             raw_dir=raw_dir,
+                             convert_jobs=args['convert_jobs'][0],
+                             compress=args['compress'],
+                             split_fmriprep=args['split_fmriprep'],
+                             instances=args['instances'],
+                             work_dir=args['work_dir'][0],
+                             templateflow_dir=args['templateflow_dir'][0],
+                             retention=args['retention'][0],
+                             log_max_mb=args['log_max_mb'][0])
+        run_workflow(wf, args['plugin'][0], plugin_args)
+    finally:
+        if stage is not None:
+            stage.sync()
+            stage.cleanup()
+
+
+SUBCOMMANDS = {'convert': convert, 'run': run, 'batch': batch}
+
+USAGE = """usage: mjxproc {convert,run,batch} ...
+
+An Automated Workflow MJX Data Processing.
+
+subcommands:
+  convert   convert a subject's raw data to BIDS, without nipype
+  run       convert and process a subject session (the default)
+  batch     convert and process a cohort of subjects in a single job
+
+See mjxproc <subcommand> -h for arguments."""
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 0 or argv[0] in ['-h', '--help']:
+        print(USAGE)
+        return
+    if argv[0] in SUBCOMMANDS:
+        SUBCOMMANDS[argv[0]](argv[1:])
+    else:
+        # mjxproc <subject> <session> ..., as before subcommands
+        run(argv)
 
 
 if __name__ == '__main__':
     import warnings
     warnings.filterwarnings("ignore")
-    main()
\ No newline at end of file
+    main()
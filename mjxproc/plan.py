@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+'''
+Created on Sun March 10 15:44:46 2020
+@author: Ryan Hammonds (ryanhammonds)
+'''
+import os
+import copy
+import glob
+import json
+import math
+import statistics
+import networkx as nx
+from traits.api import TraitError
+from nipype.interfaces.base import isdefined
+from nipype.pipeline.engine.utils import evaluate_connect_function
+from interfaces import SingularityCommandLine, BidsConvert
+from scheduler import node_hours, critical_path
+from utils import Subject
+
+
+def node_history(history_dir):
+    """ Median wall time of nodes, and of dcm2niix calls, in past runs.
+
+    Parameters
+    ----------
+    history_dir : str
+        directory searched for profile_timeline.json files
+
+    Returns
+    -------
+    history : dict
+        node names, and dcm2niix, paired with their median wall time (s)
+    """
+    walls = {}
+    for path in glob.glob(f'{history_dir}/**/profile_timeline.json',
+                          recursive=True):
+        try:
+            with open(path, 'r') as f:
+                rows = json.load(f)
+        except (IOError, ValueError):
+            continue
+        for row in rows:
+            # Nodes skipped as complete ran no commands and have no cpu time
+            if row['status'] != 'done' or row['cpu_s'] is None:
+                continue
+            if row['kind'] == 'node':
+                name = row['name'].split('.')[-1]
+            elif row['kind'] == 'dcm2niix':
+                name = 'dcm2niix'
+            else:
+                continue
+            walls.setdefault(name, []).append(row['wall_s'])
+    return {name: statistics.median(wall) for name, wall in walls.items()}
+
+
+def _skip_exists(node):
+    """ Drop the existence checks of a node's path inputs. Directories the
+        run creates, ex: proc_dir on a first run, are missing when planned.
+
+    Nodes of a flat graph are copies, the workflow's nodes are unchanged.
+    """
+    for name in node.inputs.copyable_trait_names():
+        trait_type = node.inputs.trait(name).trait_type
+        if not getattr(trait_type, 'exists', False):
+            continue
+        value = getattr(node.inputs, name)
+        trait_type = copy.copy(trait_type)
+        trait_type.exists = False
+        node.inputs.add_trait(name, trait_type)
+        if isdefined(value):
+            setattr(node.inputs, name, value)
+
+
+def _set_inputs(graph, node, outputs):
+    """ Set the inputs of a node from the predicted outputs of its parents.
+
+    Returns
+    -------
+    issues : list of str
+        inputs that could not be set
+    """
+    issues = []
+    for parent, _, data in graph.in_edges(node, data=True):
+        for src, dest in data['connect']:
+            name = src[0] if isinstance(src, tuple) else src
+            value = outputs.get(parent, {}).get(name)
+            if value is None or not isdefined(value):
+                issues.append(f'{dest}: unknown until {parent.name} runs')
+                continue
+            if isinstance(src, tuple):
+                value = evaluate_connect_function(src[1], src[2], value)
+            try:
+                setattr(node.inputs, dest, value)
+            except TraitError as err:
+                issues.append(f'{dest}: {str(err).splitlines()[0]}')
+    return issues
+
+
+def plan_workflow(wf, plugin_args=None, history_dir=None):
+    """ Render the commands, graph and cpu/memory split of a workflow, and
+        estimate its runtime, without running anything.
+
+    Inputs passed between nodes are predicted from the outputs each
+    interface lists, paths are not required to exist yet. Node wall times
+    are the median of past runs found in history_dir, or NODE_HOURS
+    without history, and zero for nodes whose results are on disk. The
+    estimated wall time of the run is the longer of its critical path and
+    its core time spread over n_procs.
+
+    Parameters
+    ----------
+    wf : nipype.pipeline.engine.workflows.Workflow
+        nipype workflow
+    plugin_args : dict
+        arguments the workflow would be run with, n_procs and memory_gb
+    history_dir : str
+        directory of past runs' profiles, defaults to wf.base_dir
+
+    Returns
+    -------
+    plan : dict
+        nodes, in the order they may run, with their parents, commands,
+        binds, container environment, threads, memory and estimated wall
+        time, and the critical path and estimated wall time of the run
+    """
+    plugin_args = {} if plugin_args is None else plugin_args
+    n_procs = plugin_args.get('n_procs', os.cpu_count())
+    history = node_history(wf.base_dir if history_dir is None else
+                           history_dir)
+
+    # Flat copy of the graph, nodes of sub-workflows included
+    graph = wf._create_flat_graph()
+
+    outputs = {}
+    nodes = []
+    for node in nx.topological_sort(graph):
+        _skip_exists(node)
+        interface = node.interface
+        record = {'name': node.fullname,
+                  'interface': type(interface).__name__,
+                  'parents': [parent.fullname for parent in
+                              graph.predecessors(node)],
+                  'threads': node.n_procs,
+                  'mem_gb': node.mem_gb,
+                  'commands': [],
+                  'binds': [],
+                  'env': {},
+                  'complete': False,
+                  'issues': _set_inputs(graph, node, outputs)}
+
+        wall_s, source = None, 'none'
+        if isinstance(interface, BidsConvert):
+            inputs = node.inputs
+            try:
+                jobs = Subject(inputs.raw_dir, inputs.bids_dir).convert_jobs(
+                    [inputs.img_type], [inputs.session], inputs.compress)
+            except (IOError, IndexError, ValueError) as err:
+                jobs = []
+                record['issues'].append(str(err))
+            pending = [job for job in jobs if not job['done']]
+            record['commands'] = [job['cmd'] for job in pending]
+            record['complete'] = len(pending) == 0
+            ext = '.nii.gz' if inputs.compress else '.nii'
+            outputs[node] = {'bids_dir': inputs.bids_dir,
+                             'out_files': [f"{job['d_out']}/{job['f_out']}"
+                                           f"{ext}" for job in jobs]}
+            # Pending series, rather than the node's past runs
+            if 'dcm2niix' in history:
+                wall_s, source = history['dcm2niix'] * math.ceil(
+                    len(pending) / inputs.convert_jobs), 'history'
+        elif isinstance(interface, SingularityCommandLine):
+            for name in sorted(node.inputs.copyable_trait_names()):
+                value = getattr(node.inputs, name)
+                if name.startswith('bind_') and isdefined(value):
+                    record['binds'].append(
+                        node.inputs.trait(name).argstr % value)
+            record['env'] = {name: value for name, value in
+                             interface._get_environ().items() if
+                             name.startswith('SINGULARITYENV_')}
+            try:
+                record['commands'] = [interface.cmdline]
+            except (ValueError, TraitError) as err:
+                record['issues'].append(str(err).splitlines()[0])
+            ready = all(isdefined(getattr(node.inputs, name)) for name in
+                        interface._complete_inputs)
+            record['complete'] = node.inputs.skip_complete and ready and \
+                interface.is_complete()
+            outputs[node] = interface._list_outputs()
+        else:
+            try:
+                outputs[node] = interface._list_outputs()
+            except (ValueError, AttributeError, TypeError):
+                outputs[node] = {}
+
+        if record['complete']:
+            wall_s, source = 0, 'complete'
+        elif wall_s is None and node.name in history:
+            wall_s, source = history[node.name], 'history'
+        elif wall_s is None and node_hours(node.name) > 0:
+            wall_s, source = node_hours(node.name) * 3600, 'default'
+        record['wall_s'] = 0 if wall_s is None else wall_s
+        record['estimate'] = source
+        nodes.append(record)
+
+    children = {record['name']: [] for record in nodes}
+    for record in nodes:
+        for parent in record['parents']:
+            children[parent].append(record['name'])
+    wall = {record['name']: record['wall_s'] for record in nodes}
+    path = [name for name in critical_path(children, wall) if wall[name] > 0]
+    core_s = sum(record['wall_s'] * record['threads'] for record in nodes)
+
+    return {'n_procs': n_procs,
+            'memory_gb': plugin_args.get('memory_gb'),
+            'nodes': nodes,
+            'critical_path': path,
+            'critical_path_s': sum(wall[name] for name in path),
+            'core_s': core_s,
+            'wall_s': max(sum(wall[name] for name in path),
+                          core_s / n_procs)}
+
+
+def format_plan(plan):
+    """ Readable summary of a plan from plan_workflow.
+    """
+    memory = '' if plan['memory_gb'] is None else \
+        f", {plan['memory_gb']} GB"
+    lines = [f"Dry run: {len(plan['nodes'])} nodes, {plan['n_procs']} "
+             f"cpus{memory}", '']
+    for record in plan['nodes']:
+        status = 'complete, skipped' if record['complete'] else \
+            f"~{record['wall_s']/3600:.2f} h ({record['estimate']})"
+        lines.append(f"{record['name']} [{record['interface']}, "
+                     f"{record['threads']} cpus, {record['mem_gb']} GB] "
+                     f"{status}")
+        if len(record['parents']) > 0:
+            lines.append(f"  after: {', '.join(record['parents'])}")
+        for bind in record['binds']:
+            lines.append(f"  bind: {bind}")
+        for name, value in record['env'].items():
+            lines.append(f"  env: {name}={value}")
+        for cmd in record['commands']:
+            lines.append(f"  $ {cmd}")
+        for issue in record['issues']:
+            lines.append(f"  ! {issue}")
+    lines += ['',
+              f"Critical path: {' > '.join(plan['critical_path'])} "
+              f"({plan['critical_path_s']/3600:.2f} h)",
+              f"Core time: {plan['core_s']/3600:.2f} core-h, "
+              f"estimated wall time: {plan['wall_s']/3600:.2f} h"]
+    return '\n'.join(lines)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+'''
+Created on Sun March 10 15:44:46 2020
+@author: Ryan Hammonds (ryanhammonds)
+'''
+import os
+import json
+import pickle
+from datetime import datetime
+import numpy as np
+import networkx as nx
+from nipype import logging
+from nipype.pipeline.plugins import MultiProcPlugin
+from scheduler import (
+    node_hours, path_weights, critical_path, split_cpus, set_threads,
+    available_gb
+)
+from profiler import tree_rss
+
+logger = logging.getLogger('nipype.workflow')
+
+
+class CriticalPathPlugin(MultiProcPlugin):
+    """ MultiProc execution that sizes the threads of each node when it is
+        submitted, rather than when the workflow is built.
+
+    Free cpus are split between ready nodes by the length of their remaining
+    path through the graph, so freesurfer and fmriprep receive more threads
+    than mriqc and ants. Cpus freed by finished nodes are handed to the next
+    nodes submitted. Nodes whose expensive ancestors have finished, and that
+    only wait on short nodes such as BIDS conversion, keep their share free.
+
+    Memory of each node follows its tool's memory model, sized by the
+    images it reads once its inputs are known. Nodes are admitted when they
+    fit the memory_gb budget, and the memory available on the host, less
+    what running nodes reserved but do not use yet.
+
+    Additional plugin_args:
+
+    - allocation_file: json file the chosen split is written to.
+    - host_memory: admit nodes against /proc/meminfo, default True.
+    """
+
+    def __init__(self, plugin_args=None):
+        super(CriticalPathPlugin, self).__init__(plugin_args=plugin_args)
+        self._allocation_file = self.plugin_args.get('allocation_file')
+        self._host_memory = self.plugin_args.get('host_memory', True)
+        self._allocation = {'n_procs': self.processors,
+                            'memory_gb': self.memory_gb,
+                            'critical_path': [], 'nodes': []}
+        self._heavy = set()
+        self._heavy_ancestors = {}
+        self._weights = {}
+        self._path_hours = {}
+        self._jobids = None
+
+    def _prerun_check(self, graph):
+        children = {node: list(graph.successors(node)) for node in
+                    graph.nodes()}
+        hours = {node: node_hours(node.name) for node in graph.nodes()}
+        self._heavy = set(node for node in hours if hours[node] > 0)
+        self._heavy_ancestors = {
+            node: self._heavy.intersection(nx.ancestors(graph, node)) for
+            node in self._heavy
+        }
+        self._weights = path_weights(children, hours)
+        self._path_hours = {node.fullname: weight for node, weight in
+                            self._weights.items()}
+        self._allocation['critical_path'] = [
+            node.fullname for node in critical_path(children, hours) if
+            hours[node] > 0
+        ]
+        for node in self._heavy:
+            set_threads(node, min(node.n_procs, self.processors),
+                        max_gb=self.memory_gb)
+        super(CriticalPathPlugin, self)._prerun_check(graph)
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        if self._jobids is None:
+            self._jobids = {node: jobid for jobid, node in
+                            enumerate(self.procs)}
+
+        waiting = np.asarray(self.depidx.sum(axis=0)).ravel()
+        jobids = np.flatnonzero(~self.proc_done & (waiting == 0))
+        ready = [jobid for jobid in jobids if self.procs[jobid] in self._heavy]
+
+        # Nodes that will soon be ready, only short nodes are left upstream
+        finished = self.proc_done & ~self.proc_pending
+        upcoming = [
+            jobid for jobid in np.flatnonzero(~self.proc_done & (waiting > 0))
+            if self.procs[jobid] in self._heavy and
+            all(finished[self._jobids[node]] for node in
+                self._heavy_ancestors[self.procs[jobid]])
+        ]
+
+        if len(ready) > 0:
+            _, free_processors = self._check_resources(self.pending_tasks)
+            weights = [self._weights[self.procs[jobid]] for jobid in
+                       ready + upcoming]
+            threads = split_cpus(free_processors, weights)[:len(ready)]
+            for jobid, n_threads in zip(ready, threads):
+                # Inputs of finished parents, the images sizing memory.
+                #   Unreadable results leave memory to the default sizes.
+                try:
+                    self.procs[jobid]._get_inputs()
+                except (OSError, EOFError, pickle.UnpicklingError,
+                        RuntimeError) as err:
+                    logger.warning('[CriticalPath] Inputs of %s not loaded, '
+                                   'sizing its memory without them: %s',
+                                   self.procs[jobid].fullname, err)
+                set_threads(self.procs[jobid], n_threads,
+                            max_gb=self.memory_gb)
+
+        super(CriticalPathPlugin, self)._send_procs_to_workers(
+            updatehash=updatehash, graph=graph)
+
+    def _check_resources(self, running_tasks):
+        free_memory_gb, free_processors = super(
+            CriticalPathPlugin, self)._check_resources(running_tasks)
+        # Nothing running, admit the next node rather than wait forever
+        if not self._host_memory or len(running_tasks) == 0:
+            return free_memory_gb, free_processors
+
+        available = available_gb()
+        if available is not None:
+            reserved = sum(self.procs[jobid].mem_gb for _, jobid in
+                           running_tasks)
+            unused = max(0, reserved - tree_rss(os.getpid()) / 2**30)
+            free_memory_gb = max(0, min(free_memory_gb, available - unused))
+        return free_memory_gb, free_processors
+
+    def _submit_job(self, node, updatehash=False):
+        self._allocation['nodes'].append({
+            'node': node.fullname,
+            'threads': node.n_procs,
+            'mem_gb': node.mem_gb,
+            'path_hours': self._path_hours.get(node.fullname, 0),
+            'submitted': datetime.now().isoformat(timespec='seconds')
+        })
+        self._write_allocation()
+        return super(CriticalPathPlugin, self)._submit_job(
+            node, updatehash=updatehash)
+
+    def _write_allocation(self):
+        if self._allocation_file is None:
+            return
+        os.makedirs(os.path.dirname(self._allocation_file), exist_ok=True)
+        with open(self._allocation_file, 'w') as f:
+            json.dump(self._allocation, f, indent='\t')
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+'''
+Created on Sun March 10 15:44:46 2020
+@author: Ryan Hammonds (ryanhammonds)
+'''
+import os
+import csv
+import json
+import time
+import resource
+import threading
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from scheduler import critical_path
+
+# Columns of the timeline csv
+TIMELINE_FIELDS = ['name', 'kind', 'status', 'threads', 'start', 'start_s',
+                   'end_s', 'wall_s', 'cpu_s', 'peak_rss_mb', 'read_bytes',
+                   'write_bytes']
+
+_PAGE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def tree_rss(pid):
+    """ Resident memory (bytes) of all descendants of a process.
+
+    Parameters
+    ----------
+    pid : int
+        process whose children, grandchildren, etc. are summed
+
+    Returns
+    -------
+    rss : int
+        summed resident set size, zero if /proc is unavailable
+    """
+    parents = {}
+    rss = {}
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return 0
+    for proc in pids:
+        try:
+            with open(f'/proc/{proc}/stat', 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        parents.setdefault(int(fields[1]), []).append(proc)
+        rss[proc] = int(fields[21]) * _PAGE
+
+    total = 0
+    procs = list(parents.get(pid, []))
+    while len(procs) > 0:
+        proc = procs.pop()
+        total += rss.get(proc, 0)
+        procs.extend(parents.get(proc, []))
+    return total
+
+
+class TreeMonitor(threading.Thread):
+    """ Sample the memory of a process tree until stopped, keeping the peak.
+    """
+
+    def __init__(self, pid=None, interval=1):
+        super(TreeMonitor, self).__init__(daemon=True)
+        self.pid = os.getpid() if pid is None else pid
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, tree_rss(self.pid))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def usage_record(start, end, before, after, peak_rss):
+    """ Resources used by child processes between two getrusage calls.
+
+    Parameters
+    ----------
+    start, end : float
+        epoch times the children ran between
+    before, after : resource.struct_rusage
+        usage of the children before and after they ran
+    peak_rss : int
+        sampled peak resident memory (bytes) of the process tree. The
+        ru_maxrss of children is not used, it includes the memory of this
+        process copied when they were forked.
+
+    Returns
+    -------
+    record : dict
+        timeline fields of the children
+    """
+    return {'start_ts': start,
+            'end_ts': end,
+            'wall_s': end - start,
+            'cpu_s': (after.ru_utime + after.ru_stime) -
+                     (before.ru_utime + before.ru_stime),
+            'peak_rss_mb': peak_rss / 2**20,
+            'read_bytes': (after.ru_inblock - before.ru_inblock) * 512,
+            'write_bytes': (after.ru_oublock - before.ru_oublock) * 512}
+
+
+@contextmanager
+def profile_children(record, interval=1):
+    """ Profile the child processes started and waited for in a block.
+
+    Children are measured together, so blocks must not run concurrently in
+    the same process. Commands run concurrently, as dcm2niix is by Subject,
+    are measured one at a time with os.wait4 instead.
+
+    Parameters
+    ----------
+    record : dict
+        updated with the timeline fields of the children
+    interval : float
+        seconds between memory samples of the process tree
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    monitor = TreeMonitor(interval=interval)
+    monitor.start()
+    start = time.time()
+    try:
+        yield record
+    finally:
+        end = time.time()
+        monitor.stop()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record.update(usage_record(start, end, before, after, monitor.peak))
+
+
+def write_timeline(records, out_dir, prefix='profile'):
+    """ Write records as a json and csv timeline.
+
+    Parameters
+    ----------
+    records : list of dict
+        timeline records, with start_ts and end_ts epoch times
+    out_dir : str
+        directory to write {prefix}_timeline.json and .csv to
+    prefix : str
+        prefix of the file names
+
+    Returns
+    -------
+    timeline : list of dict
+        records sorted by start, with times relative to the first start
+    """
+    records = sorted(records, key=lambda record: record['start_ts'])
+    origin = records[0]['start_ts'] if len(records) > 0 else 0
+
+    timeline = []
+    for record in records:
+        row = {field: record.get(field) for field in TIMELINE_FIELDS}
+        row['start'] = datetime.fromtimestamp(
+            record['start_ts']).isoformat(timespec='seconds')
+        row['start_s'] = record['start_ts'] - origin
+        row['end_s'] = record['end_ts'] - origin
+        timeline.append(row)
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(f'{out_dir}/{prefix}_timeline.json', 'w') as f:
+        json.dump(timeline, f, indent='\t')
+    with open(f'{out_dir}/{prefix}_timeline.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=TIMELINE_FIELDS)
+        writer.writeheader()
+        writer.writerows(timeline)
+    return timeline
+
+
+def summarize(timeline, n_procs, children=None):
+    """ Summarize the nodes of a timeline.
+
+    Parameters
+    ----------
+    timeline : list of dict
+        rows returned by write_timeline
+    n_procs : int
+        number of cpus available to the run
+    children : dict
+        node names paired with a list of their child node names, used to
+        find the critical path
+
+    Returns
+    -------
+    summary : dict
+        makespan, critical path by measured wall time, and core time that
+        was idle (not given to a node) or unused (given but not busy)
+    """
+    nodes = [row for row in timeline if row['kind'] == 'node']
+    makespan = max([row['end_s'] for row in nodes], default=0)
+    core_s = n_procs * makespan
+    alloc_s = sum(row['wall_s'] * (row['threads'] or 1) for row in nodes)
+    cpu_s = sum(row['cpu_s'] or 0 for row in nodes)
+
+    path = []
+    if children is not None:
+        wall = {name: 0 for name in children}
+        wall.update({row['name']: row['wall_s'] for row in nodes if
+                     row['name'] in wall})
+        path = [name for name in critical_path(children, wall) if
+                wall[name] > 0]
+    wall = {row['name']: row['wall_s'] for row in nodes}
+
+    return {'n_procs': n_procs,
+            'makespan_s': makespan,
+            'critical_path': path,
+            'critical_path_s': sum(wall[name] for name in path),
+            'node_wall_s': wall,
+            'core_s': core_s,
+            'idle_core_s': max(0, core_s - alloc_s),
+            'unused_cpu_s': max(0, core_s - cpu_s)}
+
+
+def _utc_ts(iso):
+    """ Epoch time of a nipype runtime timestamp, which is in utc.
+    """
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in iso else '%Y-%m-%dT%H:%M:%S'
+    return datetime.strptime(iso, fmt).replace(
+        tzinfo=timezone.utc).timestamp()
+
+
+class ProfileCallback:
+    """ Nipype status_callback that records a timeline of executed nodes.
+
+    Interfaces may list the child processes they ran as timeline records in
+    runtime.profile, these are summed into the node and kept as rows of
+    their own. Nodes found in the cache are not recorded.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._started = {}
+
+    def __call__(self, node, status):
+        if status == 'start':
+            self._started[node.fullname] = time.time()
+            return
+        if node.fullname not in self._started:
+            return
+
+        record = {'name': node.fullname,
+                  'kind': 'node',
+                  'status': 'done' if status == 'end' else 'failed',
+                  'threads': node.n_procs,
+                  'start_ts': self._started.pop(node.fullname),
+                  'end_ts': time.time()}
+
+        runtime = None
+        if status == 'end':
+            try:
+                runtime = node.result.runtime
+            except (AttributeError, OSError, EOFError):
+                runtime = None
+
+        # Times of the interface itself, the callback lags the scheduler
+        try:
+            record['start_ts'] = _utc_ts(runtime.startTime)
+            record['end_ts'] = _utc_ts(runtime.endTime)
+        except (AttributeError, TypeError, ValueError):
+            pass
+        record['wall_s'] = record['end_ts'] - record['start_ts']
+
+        profile = getattr(runtime, 'profile', None) or []
+        if len(profile) > 0:
+            record['cpu_s'] = sum(child['cpu_s'] for child in profile)
+            record['peak_rss_mb'] = max(child['peak_rss_mb'] for child in
+                                        profile)
+            for field in ['read_bytes', 'write_bytes']:
+                record[field] = sum(child[field] for child in profile)
+
+        self.records.append(record)
+        for child in profile:
+            self.records.append(dict(child, name=f"{node.fullname}:"
+                                                 f"{child['name']}"))
+
+    def write(self, out_dir, n_procs, children=None):
+        """ Write the timeline and a summary of the run.
+
+        Parameters
+        ----------
+        out_dir : str
+            directory the profile_timeline and profile_summary files are
+            written to
+        n_procs : int
+            number of cpus available to the run
+        children : dict
+            node names paired with a list of their child node names
+
+        Returns
+        -------
+        summary : dict
+            summary of the run, from summarize
+        """
+        timeline = write_timeline(self.records, out_dir)
+        summary = summarize(timeline, n_procs, children)
+        with open(f'{out_dir}/profile_summary.json', 'w') as f:
+            json.dump(summary, f, indent='\t')
+        return summary
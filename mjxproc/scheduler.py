@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+'''
+Created on Sun March 10 15:44:46 2020
+@author: Ryan Hammonds (ryanhammonds)
+'''
+
+# Typical single subject runtimes (hours), used to find the critical path
+NODE_HOURS = {'mriqc': 1, 'mriqc_anat': 0.5, 'mriqc_func': 0.5,
+              'mriqc_group': 0.1, 'ants': 3,
+              'freesurfer_autorecon1': 1, 'freesurfer_autorecon2': 4.5,
+              'freesurfer_autorecon3': 2.5, 'mindboggle': 1.5,
+              'fmriprep': 6, 'fmriprep_anat': 2, 'fmriprep_func': 1}
+
+# Fmriprep nodes running recon-all themselves, rather than after freesurfer
+#   nodes, take as long as both
+_RECON_HOURS = sum(hours for name, hours in NODE_HOURS.items() if
+                   name.startswith('freesurfer_'))
+NODE_HOURS['fmriprep_recon'] = NODE_HOURS['fmriprep'] + _RECON_HOURS
+NODE_HOURS['fmriprep_anat_recon'] = NODE_HOURS['fmriprep_anat'] + _RECON_HOURS
+
+# Interface inputs that set the number of threads of a node
+THREAD_INPUTS = {'Mriqc': ['ncpus'], 'AntsCorticalThickness': ['num_threads'],
+                 'FreesurferMB': ['fs_mp'], 'Mindboggle': ['ncpus'],
+                 'Fmriprep': ['nthreads', 'nprocs']}
+
+# Peak memory (GB) of each tool: a base, per thread, and per megavoxel of its
+#   largest anatomical and functional (voxels x volumes) image
+MEM_MODELS = {
+    'Mriqc': {'base': 1, 'thread': 0.5, 'anat': 0.1, 'func': 0.04},
+    'MriqcGroup': {'base': 1, 'thread': 0, 'anat': 0, 'func': 0},
+    'AntsCorticalThickness': {'base': 1, 'thread': 0.25, 'anat': 0.25,
+                              'func': 0},
+    'FreesurferMB': {'base': 1, 'thread': 0.25, 'anat': 0.1, 'func': 0},
+    'Mindboggle': {'base': 2, 'thread': 0.5, 'anat': 0, 'func': 0},
+    'Fmriprep': {'base': 2, 'thread': 0.5, 'anat': 0.1, 'func': 0.08}
+}
+
+# Megavoxels of images not converted yet: 1mm T1w, 300 volume bold run
+DEFAULT_MVOX = {'anat': 11.5, 'func': 49}
+
+# Interface inputs that limit the memory of a tool, and their unit (GB)
+MEM_INPUTS = {'Mriqc': [('mem', 1)], 'Fmriprep': [('mem_mb', 1/1024)]}
+
+
+def node_hours(name):
+    """ Typical runtime of a node, nodes named <entry>_<task>_<session>
+        share the hours of their NODE_HOURS entry.
+    """
+    parts = name.split('_')
+    for idx in range(len(parts), 0, -1):
+        if '_'.join(parts[:idx]) in NODE_HOURS:
+            return NODE_HOURS['_'.join(parts[:idx])]
+    return 0
+
+
+def mem_calc(ncpus):
+    """ Memory (GB) for a number of cpus, our nodes have 2GB per cpu.
+    """
+    return int(ncpus*2)
+
+
+def mem_model(interface, threads, mvox=None):
+    """ Expected peak memory (GB) of a tool.
+
+    Parameters
+    ----------
+    interface : str
+        interface name, ex: Fmriprep. Interfaces without a model are
+        given mem_calc(threads).
+    threads : int
+        number of threads
+    mvox : dict
+        datatypes the node reads, anat and/or func, paired with megavoxels
+        of their largest image, or None if not converted yet
+
+    Returns
+    -------
+    mem_gb : float
+        memory to reserve for the node
+    """
+    if interface not in MEM_MODELS:
+        return mem_calc(threads)
+    model = MEM_MODELS[interface]
+    mvox = {} if mvox is None else mvox
+    mem_gb = model['base'] + model['thread'] * threads
+    for datatype, size in mvox.items():
+        size = DEFAULT_MVOX[datatype] if size is None else size
+        mem_gb += model[datatype] * size
+    return round(mem_gb, 1)
+
+
+def available_gb(meminfo='/proc/meminfo'):
+    """ Memory (GB) the kernel can give new processes, None if unknown.
+    """
+    try:
+        with open(meminfo, 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 2**20
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def path_weights(children, hours):
+    """ Longest remaining path from each node to the end of the graph.
+
+    Parameters
+    ----------
+    children : dict
+        nodes paired with a list of their child nodes
+    hours : dict
+        nodes paired with their expected runtime
+
+    Returns
+    -------
+    weights : dict
+        nodes paired with their runtime plus their longest downstream path
+    """
+    weights = {}
+
+    def weight(node):
+        if node not in weights:
+            downstream = [weight(child) for child in children[node]]
+            weights[node] = hours[node] + max(downstream, default=0)
+        return weights[node]
+
+    for node in children:
+        weight(node)
+    return weights
+
+
+def critical_path(children, hours):
+    """ Nodes on the longest path through the graph, in order.
+
+    Parameters
+    ----------
+    children : dict
+        nodes paired with a list of their child nodes
+    hours : dict
+        nodes paired with their expected runtime
+
+    Returns
+    -------
+    path : list
+        nodes on the critical path
+    """
+    weights = path_weights(children, hours)
+    parents = set(child for node in children for child in children[node])
+    path = []
+    nodes = [node for node in children if node not in parents]
+    while len(nodes) > 0:
+        node = max(nodes, key=lambda node: weights[node])
+        path.append(node)
+        nodes = children[node]
+    return path
+
+
+def split_cpus(ncpus, weights):
+    """ Split cpus in proportion to weights, with at least one cpu each.
+
+    Parameters
+    ----------
+    ncpus : int
+        number of cpus to split
+    weights : list of float
+        relative share of each node
+
+    Returns
+    -------
+    cpus : list of int
+        number of cpus for each weight
+    """
+    if len(weights) == 0:
+        return []
+    spare = ncpus - len(weights)
+    if spare <= 0 or sum(weights) == 0:
+        return [1] * len(weights)
+
+    # Largest remainder, after reserving one cpu per node
+    shares = [spare * weight / sum(weights) for weight in weights]
+    cpus = [1 + int(share) for share in shares]
+    order = sorted(range(len(weights)), key=lambda idx: int(shares[idx]) -
+                   shares[idx])
+    for idx in order[:ncpus - sum(cpus)]:
+        cpus[idx] += 1
+    return cpus
+
+
+def plan_cpus(children, hours, ncpus):
+    """ Static split of cpus, before the graph is run.
+
+    Nodes at the same depth of the graph may run at the same time and share
+    ncpus, nodes with longer remaining paths receive larger shares. Only
+    nodes with hours count towards depth.
+
+    Parameters
+    ----------
+    children : dict
+        nodes paired with a list of their child nodes
+    hours : dict
+        nodes paired with their expected runtime, nodes with zero hours are
+        not given cpus
+    ncpus : int
+        number of cpus shared by the graph
+
+    Returns
+    -------
+    cpus : dict
+        nodes paired with their number of threads
+    """
+    weights = path_weights(children, hours)
+
+    depths = {}
+
+    def depth(node):
+        if node not in depths:
+            parents = [parent for parent in children if node in
+                       children[parent]]
+            depths[node] = max([depth(parent) + int(hours[parent] > 0) for
+                                parent in parents], default=0)
+        return depths[node]
+
+    cpus = {}
+    for level in set(depth(node) for node in children):
+        nodes = [node for node in children if depths[node] == level and
+                 hours[node] > 0]
+        cpus.update(zip(nodes, split_cpus(ncpus, [weights[node] for node in
+                                                  nodes])))
+    return cpus
+
+
+def set_threads(node, threads, max_gb=None):
+    """ Set the threads and memory of a node and its interface inputs.
+
+    Memory follows the interface's MEM_MODELS entry, sized by the images
+    it reads, and is passed to tools that take a limit.
+
+    Parameters
+    ----------
+    node : nipype.pipeline.engine.Node
+        node to update
+    threads : int
+        number of threads
+    max_gb : float
+        memory of the run, larger estimates are capped to it
+    """
+    interface = type(node.interface).__name__
+    mvox = None
+    if hasattr(node.interface, 'image_mvox'):
+        mvox = node.interface.image_mvox()
+    mem_gb = mem_model(interface, threads, mvox)
+    if max_gb is not None:
+        mem_gb = min(mem_gb, max_gb)
+
+    node.n_procs = threads
+    node._mem_gb = mem_gb
+
+    for name in THREAD_INPUTS.get(interface, []):
+        setattr(node.inputs, name, threads)
+    for name, unit in MEM_INPUTS.get(interface, []):
+        setattr(node.inputs, name, max(1, int(mem_gb / unit)))
+    if interface == 'Mriqc':
+        node.inputs.ants_threads = max(1, int(threads/2))
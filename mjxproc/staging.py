@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+'''
+Created on Sun March 10 15:44:46 2020
+@author: Ryan Hammonds (ryanhammonds)
+'''
+import os
+import glob
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+# Derivatives of a subject, relative to proc_dir
+DERIVATIVES = ['mriqc/{subj_id}*', 'ants/{subj_id}', 'freesurfer/{subj_id}',
+               'freesurfer/{subj_id}_ses-*', 'mindboggled/{subj_id}',
+               'mindboggled/{subj_id}_ses-*', 'fmriprep/{subj_id}*']
+
+# Reports written by run_workflow and cleanup, anywhere under
+#   proc_dir/workflows
+REPORTS = ['cpu_allocation.json', 'profile_timeline.json',
+           'profile_timeline.csv', 'profile_summary.json',
+           'convert_timeline.json', 'convert_timeline.csv',
+           'cleanup_report.json', 'node_logs']
+
+
+def link_or_copy(src, dst, link=True):
+    """ Hard-link a file, or copy it when on another filesystem.
+
+    Parameters
+    ----------
+    src : str
+        file to stage
+    dst : str
+        destination, replaced if it exists
+    link : bool
+        try a hard link first
+    """
+    tmp = f'{os.path.dirname(dst)}/.{os.path.basename(dst)}.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), tmp)
+    else:
+        try:
+            if not link:
+                raise OSError
+            os.link(src, tmp)
+        except OSError:
+            shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def sync_tree(src, dst, link=False):
+    """ Copy files of src missing or changed in dst.
+
+    Files are unchanged when their size and mtime match, or when they are
+    the same file. Symlinks are copied as symlinks.
+
+    Parameters
+    ----------
+    src : str
+        file or directory to copy
+    dst : str
+        destination file or directory
+    link : bool
+        hard-link files when on the same filesystem
+
+    Returns
+    -------
+    n_files : int
+        number of files copied
+    """
+    if not os.path.isdir(src) or os.path.islink(src):
+        pairs = [(src, dst)]
+    else:
+        pairs = []
+        for root, dirs, files in os.walk(src):
+            out = dst + root[len(src):]
+            os.makedirs(out, exist_ok=True)
+            # Symlinked directories are copied as links, not walked
+            links = [name for name in dirs if
+                     os.path.islink(f'{root}/{name}')]
+            dirs[:] = [name for name in dirs if name not in links]
+            pairs += [(f'{root}/{name}', f'{out}/{name}') for name in
+                      files + links]
+
+    n_files = 0
+    for src_file, dst_file in pairs:
+        if os.path.isfile(dst_file) and not os.path.islink(src_file):
+            src_stat = os.stat(src_file)
+            dst_stat = os.stat(dst_file)
+            if (src_stat.st_ino, src_stat.st_dev) == \
+                    (dst_stat.st_ino, dst_stat.st_dev) or \
+                    (src_stat.st_size == dst_stat.st_size and
+                     int(src_stat.st_mtime) == int(dst_stat.st_mtime)):
+                continue
+        elif os.path.islink(dst_file) and \
+                os.readlink(dst_file) == os.readlink(src_file):
+            continue
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+        link_or_copy(src_file, dst_file, link=link)
+        n_files += 1
+    return n_files
+
+
+class ImageCache:
+    """ Container images staged to a local directory, shared by the jobs of
+        a node and evicted least recently used first.
+
+    Parameters
+    ----------
+    cache_dir : str
+        local directory of the cache
+    max_gb : float
+        size the cache is evicted down to after an image is staged
+
+    Attributes
+    ----------
+    in_use : dict
+        staged images paired with the file holding their shared lock, images
+        locked by any job are never evicted
+    """
+
+    def __init__(self, cache_dir, max_gb=50):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_gb * 2**30
+        self.in_use = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def stage(self, image):
+        """ Local copy of an image, staged if not already cached.
+
+        Parameters
+        ----------
+        image : str
+            path to the singularity image
+
+        Returns
+        -------
+        cached : str
+            path to the cached image, locked until release
+        """
+        image = os.path.realpath(image)
+        stat = os.stat(image)
+        key = hashlib.sha1(f'{image}:{stat.st_size}:{stat.st_mtime_ns}'
+                           .encode()).hexdigest()[:12]
+        cached = f'{self.cache_dir}/{key}_{os.path.basename(image)}'
+
+        with open(f'{self.cache_dir}/.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if cached not in self.in_use:
+                self.in_use[cached] = open(f'{cached}.lock', 'w')
+                fcntl.flock(self.in_use[cached], fcntl.LOCK_SH)
+            if not os.path.isfile(cached):
+                link_or_copy(image, cached)
+            # Last use, for eviction. Not the image's mtime, which a hard
+            #   link shares with the original.
+            os.utime(f'{cached}.lock')
+            self._evict()
+        return cached
+
+    def release(self):
+        """ Release the images staged by this cache, allowing eviction.
+        """
+        for lock in self.in_use.values():
+            lock.close()
+        self.in_use = {}
+
+    def _evict(self):
+        """ Remove least recently used images, until under max_bytes.
+        """
+        images = [entry for entry in os.scandir(self.cache_dir) if
+                  entry.is_file() and not entry.name.startswith('.') and
+                  not entry.name.endswith('.lock')]
+
+        def last_use(entry):
+            if os.path.isfile(f'{entry.path}.lock'):
+                return os.stat(f'{entry.path}.lock').st_mtime
+            return 0
+
+        images.sort(key=last_use)
+        total = sum(entry.stat().st_size for entry in images)
+
+        for entry in images:
+            if total <= self.max_bytes:
+                break
+            with open(f'{entry.path}.lock', 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Used by a running job
+                    continue
+                total -= entry.stat().st_size
+                os.remove(entry.path)
+                os.remove(f'{entry.path}.lock')
+
+
+class Staging:
+    """ Run a workflow from local scratch: images, BIDS inputs and
+        derivatives are staged in, final derivatives are synced back.
+
+    Parameters
+    ----------
+    scratch_dir : str
+        local directory, ex: $TMPDIR
+    bids_dir : str
+        shared bids directory
+    proc_dir : str
+        shared directory of processed outputs
+    image_cache : str
+        image cache directory, shared by jobs on the node, defaults to
+        {scratch_dir}/images
+    cache_gb : float
+        maximum size of the image cache
+
+    Attributes
+    ----------
+    run_dir : str
+        local directory of this run, removed by cleanup
+    local_bids : str
+        local bids directory
+    local_proc : str
+        local directory of processed outputs
+    subj_ids : list of str
+        subjects staged
+    """
+
+    def __init__(self, scratch_dir, bids_dir, proc_dir, image_cache=None,
+                 cache_gb=50):
+        os.makedirs(scratch_dir, exist_ok=True)
+        self.bids_dir = bids_dir
+        self.proc_dir = proc_dir
+        self.run_dir = tempfile.mkdtemp(prefix='mjxproc_', dir=scratch_dir)
+        self.local_bids = f'{self.run_dir}/BIDS'
+        self.local_proc = f'{self.run_dir}/PROC'
+        os.makedirs(self.local_bids)
+        os.makedirs(self.local_proc)
+        if image_cache is None:
+            image_cache = f'{scratch_dir}/images'
+        self.cache = ImageCache(image_cache, cache_gb)
+        self.subj_ids = []
+
+    def image(self, path):
+        """ Local copy of a container image.
+        """
+        return self.cache.stage(path)
+
+    def add_subject(self, subj_id):
+        """ Stage the BIDS subtree and existing derivatives of a subject.
+
+        BIDS files are hard-linked when on the same filesystem, derivatives
+        are copied since nodes may rewrite them.
+
+        Parameters
+        ----------
+        subj_id : str
+            subject as in bids_dir ex: sub-1234
+        """
+        self.subj_ids.append(subj_id)
+        if os.path.isdir(self.bids_dir):
+            # Hidden files, ex: the BIDS index, are kept per tree
+            for entry in os.scandir(self.bids_dir):
+                if entry.is_file() and not entry.name.startswith('.'):
+                    sync_tree(entry.path, f'{self.local_bids}/{entry.name}',
+                              link=True)
+        if os.path.isdir(f'{self.bids_dir}/{subj_id}'):
+            sync_tree(f'{self.bids_dir}/{subj_id}',
+                      f'{self.local_bids}/{subj_id}', link=True)
+
+        for path in self._derivatives(self.proc_dir, subj_id):
+            sync_tree(path, self.local_proc + path[len(self.proc_dir):])
+
+    def sync(self):
+        """ Copy new BIDS files, derivatives and run reports back.
+
+        Returns
+        -------
+        n_files : int
+            number of files copied back
+        """
+        n_files = 0
+        for entry in os.scandir(self.local_bids):
+            if entry.is_file() and not entry.name.startswith('.') and \
+                    not os.path.exists(f'{self.bids_dir}/{entry.name}'):
+                n_files += sync_tree(entry.path,
+                                     f'{self.bids_dir}/{entry.name}')
+        for subj_id in self.subj_ids:
+            if os.path.isdir(f'{self.local_bids}/{subj_id}'):
+                n_files += sync_tree(f'{self.local_bids}/{subj_id}',
+                                     f'{self.bids_dir}/{subj_id}')
+            for path in self._derivatives(self.local_proc, subj_id):
+                n_files += sync_tree(path,
+                                     self.proc_dir + path[len(
+                                         self.local_proc):])
+
+        for report in REPORTS:
+            for path in glob.glob(f'{self.local_proc}/workflows/**/{report}',
+                                  recursive=True):
+                n_files += sync_tree(path, self.proc_dir + path[len(
+                    self.local_proc):])
+        return n_files
+
+    def cleanup(self):
+        """ Remove the local run directory and release staged images.
+        """
+        self.cache.release()
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    @staticmethod
+    def _derivatives(proc_dir, subj_id):
+        """ Derivatives of a subject found in proc_dir.
+        """
+        paths = []
+        for pattern in DERIVATIVES:
+            paths += glob.glob(f'{proc_dir}/{pattern.format(subj_id=subj_id)}')
+        return sorted(paths)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+'''
+Created on Sun March 10 15:44:46 2020
+@author: Ryan Hammonds (ryanhammonds)
+'''
+import os
+import glob
+import threading
+import subprocess
+from collections import deque
+
+# Lines of each stream kept in memory, for error reports
+LOG_TAIL = 100
+
+# Longest line read at once, longer lines are split
+_CHUNK = 65536
+
+
+class RotatingLog:
+    """ Log file rolled over to <path>.1, <path>.2, ... once it reaches
+        max_bytes, keeping the last lines written in memory.
+
+    Parameters
+    ----------
+    path : str
+        log file, replaced along with its previous rotations
+    max_bytes : int
+        size a log reaches before it is rotated, 0 to never rotate
+    backups : int
+        rotated logs kept, older ones are removed
+    tail : int
+        lines kept in memory
+    """
+
+    def __init__(self, path, max_bytes, backups=2, tail=LOG_TAIL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.tail = deque(maxlen=tail)
+        for old in glob.glob(f'{glob.escape(path)}.*'):
+            if old[len(path) + 1:].isdigit():
+                os.remove(old)
+        self._file = open(path, 'wb')
+        self._size = 0
+
+    def write(self, line):
+        if self.max_bytes > 0 and self._size > 0 and \
+                self._size + len(line) > self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+        self._size += len(line)
+        self.tail.append(line)
+
+    def _rotate(self):
+        self._file.close()
+        for idx in range(self.backups, 0, -1):
+            src = self.path if idx == 1 else f'{self.path}.{idx-1}'
+            if os.path.isfile(src):
+                os.replace(src, f'{self.path}.{idx}')
+        self._file = open(self.path, 'wb')
+        self._size = 0
+
+    def close(self):
+        self._file.close()
+
+    def text(self):
+        """ Tail of the log, as text.
+        """
+        return b''.join(self.tail).decode(errors='replace')
+
+
+def _drain(pipe, log):
+    with pipe:
+        for line in iter(lambda: pipe.readline(_CHUNK), b''):
+            log.write(line)
+    log.close()
+
+
+def run_logged(cmdline, cwd, env=None, log_dir=None, max_bytes=0,
+               backups=2, tail=LOG_TAIL):
+    """ Run a shell command, streaming stdout and stderr to rotating
+        stdout.log and stderr.log.
+
+    Parameters
+    ----------
+    cmdline : str
+        shell command
+    cwd : str
+        working directory
+    env : dict
+        environment of the command
+    log_dir : str
+        directory logs are written to, cwd by default
+    max_bytes : int
+        size of each log before it is rotated, 0 to never rotate
+    backups : int
+        rotated logs kept of each stream
+    tail : int
+        lines of each stream returned
+
+    Returns
+    -------
+    returncode : int
+        exit status of the command
+    stdout, stderr : str
+        last lines of each stream
+    """
+    log_dir = cwd if log_dir is None else log_dir
+    os.makedirs(log_dir, exist_ok=True)
+    proc = subprocess.Popen(cmdline, shell=True, cwd=cwd, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    logs = []
+    threads = []
+    for name, pipe in [('stdout', proc.stdout), ('stderr', proc.stderr)]:
+        log = RotatingLog(f'{log_dir}/{name}.log', max_bytes, backups, tail)
+        thread = threading.Thread(target=_drain, args=(pipe, log),
+                                  daemon=True)
+        thread.start()
+        logs.append(log)
+        threads.append(thread)
+    returncode = proc.wait()
+    for thread in threads:
+        thread.join()
+    return returncode, logs[0].text(), logs[1].text()
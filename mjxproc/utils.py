@@ -6,9 +6,308 @@ Created on Sun March 10 15:44:46 2020
 import os
 import re
 import glob
+import gzip
+import time
+import fcntl
+import struct
+import shutil
+import fnmatch
+import hashlib
 import warnings
 import subprocess
 import json
+import sqlite3
+from datetime import datetime
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Index of a BIDS tree, kept at its root
+INDEX_FILE = '.mjxproc_index.sqlite'
+
+# Directories modified this close (ns) to their last scan are scanned again,
+#   a change in the same mtime tick would otherwise go unnoticed.
+RACY_NS = 2 * 10**9
+
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER,
+    scanned_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT,
+    subject TEXT,
+    session TEXT,
+    datatype TEXT,
+    name TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject, session);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+'''
+
+
+class BidsIndex:
+    """
+    Persistent index of a BIDS tree: subjects, sessions, datatypes, files and
+    json sidecar metadata, in a SQLite database at the root of the tree.
+
+    Queries refresh the subtrees they read. A directory is scanned again only
+    when its mtime changed, which renames and new or removed files do, so an
+    unchanged subject costs a stat per directory rather than a glob. Files
+    rewritten in place, without a rename, are not noticed.
+
+    With BidsIndex.in_memory set, ex: by dry runs, which must not write to
+    disk, indexes are kept in memory for the life of the process instead.
+
+    Parameters
+    ----------
+    bids_dir : str
+        bids directory
+    db_path : str
+        index database, defaults to {bids_dir}/.mjxproc_index.sqlite
+    """
+
+    in_memory = False
+    # In-memory databases, by uri, held open so connections share them
+    _memory = {}
+
+    def __init__(self, bids_dir, db_path=None):
+        self.bids_dir = bids_dir[:-1] if bids_dir.endswith('/') else bids_dir
+        self.db_path = f'{self.bids_dir}/{INDEX_FILE}' if db_path is None \
+            else db_path
+        if db_path is None and BidsIndex.in_memory:
+            key = hashlib.sha1(self.bids_dir.encode()).hexdigest()[:16]
+            self.db_path = f'file:mjxproc_index_{key}?mode=memory&cache=shared'
+            if self.db_path not in BidsIndex._memory:
+                BidsIndex._memory[self.db_path] = self._connect()
+
+    def _connect(self):
+        # Connections are not shared, conversions query from threads and
+        #   processes. Rollback journals, rather than wal, work over NFS.
+        conn = sqlite3.connect(self.db_path, timeout=60,
+                               uri=self.db_path.startswith('file:'))
+        conn.row_factory = sqlite3.Row
+        conn.executescript(INDEX_SCHEMA)
+        return conn
+
+    def _exists(self):
+        """ Whether the index database was created.
+        """
+        return self.db_path in BidsIndex._memory or \
+            os.path.isfile(self.db_path)
+
+    def refresh(self, subj_id=None, recursive=True):
+        """ Scan directories changed since they were last indexed.
+
+        Arguments
+        ---------
+        subj_id : str
+            subject to refresh, ex: sub-1234, defaults to the whole tree
+        recursive : bool
+            refresh the directories below it, otherwise the top only
+        """
+        if not os.path.isdir(self.bids_dir):
+            return
+        with closing(self._connect()) as conn, conn:
+            # Writers are serialized up front, upgrading a read lock may fail
+            conn.execute('BEGIN IMMEDIATE')
+            self._refresh_dir(conn, '' if subj_id is None else subj_id,
+                              recursive)
+
+    def _refresh_dir(self, conn, rel, recursive=True):
+        """ Rescan a directory if it changed, then its subdirectories.
+
+        Subjects are the only directories indexed at the root, and only
+        subject/session/datatype levels below them.
+        """
+        path = f'{self.bids_dir}/{rel}' if rel != '' else self.bids_dir
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._forget(conn, rel)
+            return
+
+        row = conn.execute('SELECT mtime_ns, scanned_ns FROM dirs WHERE '
+                           'path = ?', (rel,)).fetchone()
+        if row is not None and row['mtime_ns'] == mtime and \
+                row['scanned_ns'] - mtime > RACY_NS:
+            subdirs = [sub['path'] for sub in conn.execute(
+                'SELECT path FROM dirs WHERE parent = ?', (rel,))]
+        else:
+            subdirs = self._scan_dir(conn, rel, path, mtime)
+
+        if recursive:
+            for subdir in subdirs:
+                self._refresh_dir(conn, subdir)
+
+    def _scan_dir(self, conn, rel, path, mtime):
+        """ Index the files of a directory, keeping the metadata of those
+            unchanged, and return its subdirectories.
+        """
+        depth = 0 if rel == '' else rel.count('/') + 1
+        scanned = time.time_ns()
+        known = {row['path']: row for row in conn.execute(
+            'SELECT path, size, mtime_ns FROM files WHERE dir = ?', (rel,))}
+
+        files = []
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                entry_rel = f'{rel}/{entry.name}' if rel != '' else \
+                    entry.name
+                if entry.is_dir():
+                    if depth < 3 and (depth > 0 or
+                                      entry.name.startswith('sub-')):
+                        subdirs.append(entry_rel)
+                elif entry.is_file():
+                    files.append((entry_rel, entry.stat()))
+
+        for entry_rel, stat in files:
+            old = known.pop(entry_rel, None)
+            if old is not None and old['size'] == stat.st_size and \
+                    old['mtime_ns'] == stat.st_mtime_ns:
+                continue
+            conn.execute('INSERT OR REPLACE INTO files VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (entry_rel, rel) + self._entities(entry_rel) +
+                         (os.path.basename(entry_rel), stat.st_size,
+                          stat.st_mtime_ns, self._read_metadata(
+                              f'{self.bids_dir}/{entry_rel}')))
+        conn.executemany('DELETE FROM files WHERE path = ?',
+                         [(gone,) for gone in known])
+
+        # Subdirectories removed since the last scan
+        for old in conn.execute('SELECT path FROM dirs WHERE parent = ?',
+                                (rel,)).fetchall():
+            if old['path'] not in subdirs:
+                self._forget(conn, old['path'])
+        conn.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, 0, 0)',
+                         [(subdir, rel) for subdir in subdirs])
+        conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                     (rel, os.path.dirname(rel) if rel != '' else None,
+                      mtime, scanned))
+        return subdirs
+
+    @staticmethod
+    def _forget(conn, rel):
+        """ Drop a directory and everything indexed below it.
+        """
+        prefix = f'{rel}/'
+        conn.execute('DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) '
+                     '= ?', (rel, len(prefix), prefix))
+        conn.execute('DELETE FROM files WHERE substr(path, 1, ?) = ?',
+                     (len(prefix), prefix))
+
+    @staticmethod
+    def _entities(rel):
+        """ Subject, session and datatype of a file, from its path.
+        """
+        parts = rel.split('/')[:-1]
+        subject = parts[0] if len(parts) > 0 else None
+        session = parts[1] if len(parts) > 1 and \
+            parts[1].startswith('ses-') else None
+        datatype = None
+        if session is not None and len(parts) > 2:
+            datatype = parts[2]
+        elif session is None and len(parts) > 1:
+            datatype = parts[1]
+        return subject, session, datatype
+
+    @staticmethod
+    def _read_metadata(path):
+        """ Contents of a json sidecar, as stored in the index.
+        """
+        if not path.endswith('.json'):
+            return None
+        try:
+            with open(path, 'r') as f:
+                return json.dumps(json.load(f))
+        except (IOError, ValueError):
+            return None
+
+    def sessions(self, subj_id):
+        """ Sessions of a subject.
+
+        Returns
+        -------
+        sessions : list of str
+            session labels, ex: ses-01
+        """
+        self.refresh(subj_id, recursive=False)
+        if not self._exists():
+            return []
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT path FROM dirs WHERE parent = ?',
+                                (subj_id,)).fetchall()
+        return sorted(os.path.basename(row['path']) for row in rows if
+                      os.path.basename(row['path']).startswith('ses-'))
+
+    def files(self, subj_id, session=None, datatype=None, pattern='*'):
+        """ Files of a subject, optionally of a session and datatype.
+
+        Arguments
+        ---------
+        subj_id : str
+            subject, ex: sub-1234
+        session : str
+            session, ex: ses-01
+        datatype : str
+            anat, func, dwi or fmap
+        pattern : str
+            shell pattern the file name matches
+
+        Returns
+        -------
+        files : list of dict
+            path (relative to bids_dir), name, session, datatype, size and
+            mtime_ns of each file, sorted by path
+        """
+        self.refresh(subj_id)
+        if not self._exists():
+            return []
+        query = 'SELECT * FROM files WHERE subject = ?'
+        args = [subj_id]
+        for column, value in [('session', session), ('datatype', datatype)]:
+            if value is not None:
+                query += f' AND {column} = ?'
+                args.append(value)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(query + ' ORDER BY path', args).fetchall()
+        return [{key: row[key] for key in ['path', 'name', 'session',
+                                           'datatype', 'size', 'mtime_ns']}
+                for row in rows if fnmatch.fnmatchcase(row['name'], pattern)]
+
+    def sidecar(self, path):
+        """ Metadata of the json sidecar of an image.
+
+        Arguments
+        ---------
+        path : str
+            image, relative to bids_dir
+
+        Returns
+        -------
+        metadata : dict
+            sidecar contents, empty if it has none
+        """
+        stem = re.sub(r'\.nii(\.gz)?$', '', path)
+        self.refresh(path.split('/')[0])
+        if not self._exists():
+            return {}
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT metadata FROM files WHERE path = ?',
+                               (f'{stem}.json',)).fetchone()
+        if row is None or row['metadata'] is None:
+            return {}
+        return json.loads(row['metadata'])
 
 
 class Subject:
@@ -33,11 +332,22 @@ class Subject:
         ursi of participant run based on dir_path
     site : str
         expected format of raw data (NL or UTD)
+    bids_index : BidsIndex
+        index of bids_path, shared by the subjects of a cohort
     bids_complete : list
         list of sessions that have been previously ran and marks
         to skip conversion and preprocessing
     seqs : dict
         anat, task and dwi keys paired with raw image paths
+    raw_sessions : list of tuples
+        raw session directory names paired with their scan date (UTD only)
+    raw_index : list of dicts
+        one entry per raw series with path, series, session, date, topup
+        and site keys, built in a single pass over dir_path
+    manifest : str
+        json file recording the source and outputs of each converted series
+    profile : list of dicts
+        wall time, cpu time, peak memory and I/O of each dcm2niix call
     """
 
     def __init__(self, dir_path, bids_path):
@@ -52,7 +362,7 @@ class Subject:
         # Check arguments
         if not os.path.isdir(self.dir_path):
             raise IOError(f'Raw data directory missing: {self.dir_path}')
-        if not os.path.isdir(self.bids_path):
+        if not os.path.isdir(self.bids_path) and not BidsIndex.in_memory:
             os.mkdir(self.bids_path)
 
         # Determine if NL or UTD data
@@ -64,17 +374,73 @@ class Subject:
             self.subj_id = 'sub-' + self.subj_id
 
         # Determine sessions that have already been converted
-        self.bids_complete = []
-        for ses in glob.glob(f'{self.bids_path}/{self.subj_id}/*'):
-            if "ses-01" in ses:
-                self.bids_complete.append("ses-01")
-            elif "ses-02" in ses:
-                self.bids_complete.append("ses-02")
-
-        self.raw_sess = len(glob.glob(f'{dir_path}/*'))
+        self.bids_index = BidsIndex(self.bids_path)
+        self.bids_complete = [ses for ses in self.bids_index.sessions(
+            self.subj_id) if ses in ['ses-01', 'ses-02']]
+
+        # Index the raw tree once, all sequence lookups are served from it
+        self.raw_sessions, self.raw_index = self._index_raw()
+        self.raw_sess = len(self.raw_sessions)
         self.seqs = {'anat': [], 'func': [], 'dwi': [], 'fmap': []}
+        self.manifest = f'{self.bids_path}/{self.subj_id}/.manifest.json'
+        self.profile = []
+
+    def _index_raw(self):
+        """ Walk the raw data directory a single time.
 
-    def _seq_glob(self, seq, topup):
+        UTD data is laid out as <session>/<series>/<dicoms> and NL data as
+        <session>/<series>.PAR. Hidden entries are skipped, as with glob.
+
+        Returns
+        -------
+        raw_sessions : list of tuples
+            (session directory name, scan date) pairs, sorted by name
+        raw_index : list of dicts
+            one entry per series, sorted by path
+        """
+        topup_tag = 'TOP_UP' if self.site == 'UTD' else 'topup'
+
+        raw_sessions = []
+        raw_index = []
+        with os.scandir(self.dir_path) as sess_entries:
+            sess_entries = sorted((entry for entry in sess_entries if not
+                                   entry.name.startswith('.')),
+                                  key=lambda entry: entry.name)
+        for sess in sess_entries:
+            date = re.sub("at.*", "", re.sub(".*Study", "", sess.name))
+            date = int(date) if date.isdigit() else None
+            raw_sessions.append((sess.name, date))
+            if not sess.is_dir():
+                continue
+
+            with os.scandir(sess.path) as series_entries:
+                series_entries = [entry for entry in series_entries if not
+                                  entry.name.startswith('.')]
+            for series in series_entries:
+                if self.site == 'UTD' and series.is_dir():
+                    # Only the first file is needed to point dcm2niix
+                    with os.scandir(series.path) as files:
+                        files = sorted(entry.name for entry in files if not
+                                       entry.name.startswith('.'))
+                    if len(files) == 0:
+                        continue
+                    path = f'{series.path}/{files[0]}'
+                elif self.site == 'NL' and series.name.endswith('.PAR'):
+                    path = series.path
+                else:
+                    continue
+                rel_path = path[len(self.dir_path)+1:]
+                raw_index.append({'path': path,
+                                  'series': series.name,
+                                  'session': sess.name,
+                                  'date': date,
+                                  'topup': topup_tag in rel_path,
+                                  'site': self.site})
+
+        raw_index.sort(key=lambda entry: entry['path'])
+        return raw_sessions, raw_index
+
+    def _seq_glob(self, seq, topup, tag=None):
         """
         Arguments
         ---------
@@ -82,6 +448,8 @@ class Subject:
             name of sequence to match
         topup : bool
             is seq a field map
+        tag : str
+            session tag the path must contain, ex: a UTD date or ses-01
 
         Returns
         -------
@@ -89,22 +457,15 @@ class Subject:
             globbed paths to raw images
         """
         if self.site == 'UTD':
-            pattern = f'{self.dir_path}/*/*{seq}*/*'
+            pattern = f'*{seq}*'
         elif self.site == 'NL':
-            pattern = f'{self.dir_path}/*/*{seq}*.PAR'
+            pattern = f'*{seq}*.PAR'
 
-        if self.site == 'UTD' and not topup:
-            seq_match = [img for img in glob.glob(pattern) if "TOP_UP" not in
-                         img]
-        elif self.site == 'UTD' and topup:
-            seq_match = [img for img in glob.glob(pattern) if "TOP_UP" in img]
-        elif self.site == "NL" and not topup:
-            seq_match = [img for img in glob.glob(pattern) if "topup" not in
-                         img]
-        elif self.site == "NL" and topup:
-            seq_match = [img for img in glob.glob(pattern) if "topup" in img]
-
-        seq_match.sort()
+        # Index is sorted by path, so matches are too
+        seq_match = [entry['path'] for entry in self.raw_index if
+                     entry['topup'] == topup and
+                     fnmatch.fnmatchcase(entry['series'], pattern) and
+                     (tag is None or tag in entry['path'])]
 
         try:
             seq_match = seq_match[0]
@@ -116,136 +477,600 @@ class Subject:
 
         return seq_match
 
-    def to_bids(self):
+    def to_bids(self, convert_jobs=1, compress=False):
         """ Converts all raw sequences to nifti.
+
+        Series already recorded in the manifest, with unchanged raw data, are
+        skipped. Interrupted or newly delivered series are converted.
+
+        Arguments
+        ---------
+        convert_jobs : int
+            number of dcm2niix conversions to run concurrently
+        compress : bool
+            write .nii.gz images rather than .nii
         """
+        os.makedirs(f"{self.bids_path}/{self.subj_id}", exist_ok=True)
 
-        # Skip conversion if pre-existing BIDS directory exists.
-        base_out = f"{self.bids_path}/{self.subj_id}"
-        if os.path.isdir(base_out):
-            warnings.warn(f"BIDS directory for {self.subj_id} exists.\n"
-                          f"Skipping dicom to nifti conversion.")
-            return
-        else:
-            os.mkdir(base_out)
+        print('Converting to nifti...')
+        self.convert(convert_jobs=convert_jobs, compress=compress)
+        print('Conversion complete')
+
+    def bids_sessions(self):
+        """ BIDS labels of the sessions with raw data.
+
+        Returns
+        -------
+        sessions : list of str
+            ses-01 and/or ses-02
+        """
+        return ['ses-01', 'ses-02'][:self.raw_sess]
+
+    def _find_seqs(self, tag=None):
+        """ Find raw images of each sequence class.
+
+        Arguments
+        ---------
+        tag : str
+            session tag of the images, defaults to the first match
 
+        Returns
+        -------
+        sess_regex : list
+            session tags found in raw image paths, in scan date order, so
+            ses-01 is the earliest scan
+        dcm2niix : str
+            path to the site's dcm2niix, or to $MJXPROC_DCM2NIIX if set
+        """
         pwd = os.path.dirname(__file__)
         if self.site == 'UTD':
             # Get T1w and diffusions sequences
-            self.seqs['anat'] = [self._seq_glob('MPR', topup=False)]
-            self.seqs['dwi'] = [self._seq_glob('DTI', topup=False)]
+            self.seqs['anat'] = [self._seq_glob('MPR', topup=False, tag=tag)]
+            self.seqs['dwi'] = [self._seq_glob('DTI', topup=False, tag=tag)]
             # Get all funcational sequences
             seq_match = ['CAAT', 'CUE_RUN1', 'CUE_RUN2', 'NBACK', 'REST']
-            self.seqs['func'] = [self._seq_glob(seq, topup=False) for seq in
-                                 seq_match]
+            self.seqs['func'] = [self._seq_glob(seq, topup=False, tag=tag)
+                                 for seq in seq_match]
             # Get all topup sequences
             seq_match.append('DTI')
-            self.seqs['fmap'] = [self._seq_glob(seq, topup=True) for seq in
-                                 seq_match]
-            # Expression to search that specifies session
-            sess_regex = glob.glob(f'{self.dir_path}/*')
-            dates = [int(re.sub("at.*", "", re.sub(".*Study", "", sess))) for
-                     sess in sess_regex]
-            # Session paths keys and date pairs, sorted by date
-            sess_regex = dict(zip(sess_regex, dates))
-            sess_regex = {k: v for k, v in sorted(sess_regex.items(),
-                                                  key=lambda x: x[1],
-                                                  reverse=True)}
-            sess_regex = list(sess_regex.values())
+            self.seqs['fmap'] = [self._seq_glob(seq, topup=True, tag=tag)
+                                 for seq in seq_match]
+            # Session dates, from the raw index, earliest first so a later
+            #   delivery never renumbers converted sessions
+            sess_regex = sorted([date for _, date in self.raw_sessions if
+                                 date is not None])
             # Which dcm2niix to use
             dcm2niix = f'{pwd}/dcm2niix/dcm2niix'
         elif self.site == 'NL':
-            self.seqs['anat'] = [self._seq_glob('T1w', topup=False)]
-            self.seqs['dwi'] = [self._seq_glob('dwi', topup=False)]
+            self.seqs['anat'] = [self._seq_glob('T1w', topup=False, tag=tag)]
+            self.seqs['dwi'] = [self._seq_glob('dwi', topup=False, tag=tag)]
             seq_match = ['CAAT', 'cue*run-1', 'cue*run-2', 'nback', 'rest']
-            self.seqs['func'] = [self._seq_glob(seq, topup=False) for seq in
-                                 seq_match]
+            self.seqs['func'] = [self._seq_glob(seq, topup=False, tag=tag)
+                                 for seq in seq_match]
             seq_match.append('dwi')
-            self.seqs['fmap'] = [self._seq_glob(seq, topup=True) for seq in
-                                 seq_match]
+            self.seqs['fmap'] = [self._seq_glob(seq, topup=True, tag=tag)
+                                 for seq in seq_match]
             sess_regex = ['ses-01', 'ses-02']
             dcm2niix = f'{pwd}/dcm2niix/dcm2niix_NL'
 
-        # Create convert cmd strings and execute
+        dcm2niix = os.environ.get('MJXPROC_DCM2NIIX', dcm2niix)
+
+        return [str(sess) for sess in sess_regex], dcm2niix
+
+    def convert_jobs(self, img_types=None, sessions=None, compress=False):
+        """ Plan the dcm2niix conversions of some classes and sessions,
+            without running them.
+
+        Arguments
+        ---------
+        img_types : list of str
+            sequence classes to convert: anat, func, dwi and/or fmap,
+            defaults to all
+        sessions : list of str
+            ses-01 and/or ses-02, defaults to all sessions with raw data
+        compress : bool
+            convert to .nii.gz images rather than .nii
+
+        Returns
+        -------
+        jobs : list of dict
+            one job per series, with its dcm2niix command (cmd) and whether
+            it is already converted from unchanged raw data (done)
+        """
+        if img_types is None:
+            img_types = list(self.seqs.keys())
+        if sessions is None:
+            sessions = self.bids_sessions()
+
+        sess_regex, dcm2niix = self._find_seqs()
+        ext = '.nii.gz' if compress else '.nii'
+        gzip = 'y' if compress else 'n'
+
+        # Labels of each sequence, in the order of self.seqs
         func_seqs = ['CAAT', 'CUERUN01', 'CUERUN02', 'NBACK', 'REST']
-        print('Converting to nifti...')
-        for idx, session in enumerate(['ses-01', 'ses-02']):
-            if session not in self.bids_complete and idx+1 <= self.raw_sess:
-                # Setup BIDS sub-directories
-                sess_out = f'{base_out}/{session}'
-                os.mkdir(sess_out)
-                os.mkdir(f'{sess_out}/anat')
-                os.mkdir(f'{sess_out}/func')
-                os.mkdir(f'{sess_out}/dwi')
-                os.mkdir(f'{sess_out}/fmap')
-
-                # Create dcm2niix commands in list of strings
-                for img_type in self.seqs.keys():
-                    if session == 'ses-01':
-                        images = [seq for seq in self.seqs[img_type] if
-                                  str(sess_regex[0]) in seq]
-                    elif session == 'ses-02':
-                        images = [seq for seq in self.seqs[img_type] if
-                                  str(sess_regex[1]) in seq]
+        labels = {'anat': ['T1w'], 'func': func_seqs, 'dwi': ['dwi'],
+                  'fmap': func_seqs + ['dwi']}
+
+        manifest = self._read_manifest()
+
+        # Create convert jobs for each session
+        jobs = []
+        for session in sessions:
+            sess_idx = ['ses-01', 'ses-02'].index(session)
+            sess_out = f'{self.bids_path}/{self.subj_id}/{session}'
+            if len(sess_regex) <= sess_idx:
+                continue
+            # Series of this session
+            self._find_seqs(sess_regex[sess_idx])
+
+            for img_type in img_types:
+                for label, img in zip(labels[img_type], self.seqs[img_type]):
+                    # Missing sequences are empty lists
+                    if not isinstance(img, str) or len(sess_regex) <= \
+                            sess_idx or sess_regex[sess_idx] not in img:
+                        continue
 
+                    acq = None
                     if img_type == 'anat':
-                        cmd = [f'{dcm2niix} -o {sess_out}/anat -f '
-                               f'{self.subj_id}_ses-01_T1w {img}' for img in
-                               images]
+                        f_out = f'{self.subj_id}_{session}_T1w'
                     elif img_type == 'func':
-                        cmd = [f'{dcm2niix} -o {sess_out}/func -f '
-                               f'{self.subj_id}_ses-01_task-{func_seqs[idx]}_bold '
-                               f'{img}' for idx, img in enumerate(images)]
+                        f_out = f'{self.subj_id}_{session}_task-{label}_bold'
                     elif img_type == 'dwi':
-                        cmd = [f'{dcm2niix} -o {sess_out}/dwi -f '
-                               f'{self.subj_id}_ses-01_dwi {img}' for img in
-                               images]
+                        f_out = f'{self.subj_id}_{session}_dwi'
                     elif img_type == 'fmap':
-                        cmd = []
-                        for idx, img in enumerate(images):
-                            if 'DTI' not in img and'dwi' not in img:
-                                cmd.append(f'{dcm2niix} -o {sess_out}/fmap -f '
-                                           f'{self.subj_id}_ses-01_acq-'
-                                           f'{func_seqs[idx]}_dir-AP_epi {img}')
-                            else:
-                                cmd.append(f'{dcm2niix} -o {sess_out}/fmap -f '
-                                           f'{self.subj_id}_ses-01_acq-dwi_'
-                                           f'dir-AP_epi {img}')
-
-                    # Execute conversion commands
-                    for conv in cmd:
-                        output = subprocess.run(conv, shell=True,
-                                                stdout=subprocess.DEVNULL,
-                                                stderr=subprocess.DEVNULL)
-                        output.check_returncode()
-
-                        # Edit fmap jsons to pair with image
-                        if img_type == 'fmap':
-                            # file name and dir path from cmd
-                            f_out = re.sub(" .*", '', re.sub(".*-f ", '', conv))
-                            d_out = re.sub(" .*", '', re.sub(".*-o ", '', conv))
-
-                            img_regex = re.sub("_.*", '', re.sub(".*acq-", '',
-                                                                 f_out))
-                            img_match = glob.glob(f'{self.bids_path}/'
-                                                  f'{self.subj_id}/'
-                                                  f'{session}/*/'
-                                                  f'*{img_regex}*.nii*')
-                            img_match = [img for img in img_match if 'fmap'
-                                         not in img][0]
-
-                            # Load img json into dictionary
-                            with open(f"{d_out}/{f_out}.json", 'r') as f:
-                                img_json = json.load(f)
-
-                            # Clear prexisting key, if one exists
-                            if 'IntendedFor' in list(img_json.keys()):
-                                del img_json['IntendedFor']
-
-                            # Write
-                            img_json['IntendedFor'] = img_match.split('/')[-1]
-                            with open(f'{d_out}/{f_out}.json', 'w') as f:
-                                json.dump(img_json, f, indent='\t')
+                        acq = label
+                        f_out = (f'{self.subj_id}_{session}_acq-{acq}_'
+                                 f'dir-AP_epi')
 
-        print('Conversion complete')
+                    d_out = f'{sess_out}/{img_type}'
+                    d_tmp = f'{d_out}/.{f_out}.tmp'
+                    key = f'{session}/{img_type}/{f_out}'
+                    source = self._source_stat(img)
+                    jobs.append({'session': session,
+                                 'img_type': img_type,
+                                 'acq': acq,
+                                 'd_out': d_out,
+                                 'd_tmp': d_tmp,
+                                 'f_out': f_out,
+                                 'key': key,
+                                 'source': source,
+                                 'cmd': f'{dcm2niix} -z {gzip} -o {d_tmp} '
+                                        f'-f {f_out} {img}',
+                                 'done': self._is_converted(
+                                     manifest.get(key), source, d_out,
+                                     f_out, ext)})
+
+        return jobs
+
+    def convert(self, img_types=None, sessions=None, convert_jobs=1,
+                compress=False):
+        """ Converts raw sequences of some classes and sessions to nifti.
+
+        Series in the manifest whose raw data is unchanged are skipped. Each
+        series is converted into a hidden directory and its files are renamed
+        into place, then recorded in the manifest, so an interrupted
+        conversion is redone on the next call. Fmaps are paired with their
+        images, which must be converted first or in the same call. Series
+        converted with the other compression setting are converted again.
+
+        Arguments
+        ---------
+        img_types : list of str
+            sequence classes to convert: anat, func, dwi and/or fmap,
+            defaults to all
+        sessions : list of str
+            ses-01 and/or ses-02, defaults to all sessions with raw data
+        convert_jobs : int
+            number of dcm2niix conversions to run concurrently
+        compress : bool
+            write .nii.gz images, gzipped by dcm2niix with pigz when it is on
+            the PATH (multi-threaded) or its internal compressor otherwise
+
+        Returns
+        -------
+        out_files : list of str
+            converted nifti images
+        """
+        jobs = self.convert_jobs(img_types, sessions, compress)
+        ext = '.nii.gz' if compress else '.nii'
+        manifest = self._read_manifest()
+
+        # Setup BIDS sub-directories
+        for job in jobs:
+            os.makedirs(job['d_out'], exist_ok=True)
+
+        # Record outputs of earlier versions that match their raw data
+        adopted = {}
+        for job in jobs:
+            if job['done'] and job['key'] not in manifest:
+                outputs = [f"{job['f_out']}{ext}", f"{job['f_out']}.json"]
+                adopted[job['key']] = self._manifest_entry(job, outputs)
+        if len(adopted) > 0:
+            self._update_manifest(adopted)
+
+        # Execute conversion commands, sessions run concurrently
+        errors = []
+        with ThreadPoolExecutor(max_workers=convert_jobs) as pool:
+            futures = {pool.submit(self._convert_series, job,
+                                   manifest.get(job['key'])): job for job in
+                       jobs if not job['done']}
+            for future in as_completed(futures):
+                error, outputs, record = future.result()
+                self.profile.append(record)
+                job = futures[future]
+                job['done'] = error is None
+                if error is not None:
+                    errors.append(error)
+                    continue
+                self._update_manifest({job['key']: self._manifest_entry(
+                    job, outputs)})
+
+        # Edit fmap jsons to pair with image, once the image exists
+        images = None
+        for job in jobs:
+            if job['img_type'] != 'fmap' or not job['done']:
+                continue
+            targets = [tgt for tgt in jobs if tgt['img_type'] != 'fmap' and
+                       tgt['session'] == job['session'] and
+                       job['acq'] in tgt['f_out']]
+            if not all(tgt['done'] for tgt in targets):
+                errors.append(f"Skipped IntendedFor for {job['f_out']}: "
+                              f"target conversion failed.")
+                continue
+            try:
+                # Indexed once, after all conversions
+                if images is None:
+                    images = self.bids_index.files(self.subj_id)
+                self._intended_for(job['session'], job['d_out'],
+                                   job['f_out'], job['acq'], images)
+            except (IOError, IndexError, ValueError) as err:
+                errors.append(f"Failed IntendedFor for {job['f_out']}: {err}")
+
+        if len(errors) > 0:
+            raise RuntimeError(f"Conversion errors for {self.subj_id}:\n" +
+                               "\n".join(errors))
+
+        return [f"{job['d_out']}/{job['f_out']}{ext}" for job in jobs]
+
+    @staticmethod
+    def _source_stat(img):
+        """ Size and modification time of the raw files of a series.
+
+        Arguments
+        ---------
+        img : str
+            raw image, a dicom of a UTD series or a PAR file of a NL series
+
+        Returns
+        -------
+        source : dict
+            path, number of files, total size and latest mtime (ns)
+        """
+        if img.endswith('.PAR'):
+            files = glob.glob(f'{os.path.splitext(img)[0]}.*')
+        else:
+            files = [entry.path for entry in os.scandir(os.path.dirname(img))
+                     if entry.is_file()]
+        stats = [os.stat(f) for f in files]
+        return {'path': img,
+                'files': len(stats),
+                'size': sum(stat.st_size for stat in stats),
+                'mtime': max([stat.st_mtime_ns for stat in stats], default=0)}
+
+    @staticmethod
+    def _is_converted(entry, source, d_out, f_out, ext='.nii'):
+        """ Whether a series has been converted from unchanged raw data,
+            to an image with extension ext.
+
+        Series converted before the manifest existed have no entry and are
+        treated as converted when their nifti and json are present.
+        """
+        if entry is None:
+            return all(os.path.isfile(f'{d_out}/{f_out}{out}') for out in
+                       [ext, '.json'])
+        return entry['source'] == source and \
+            f'{f_out}{ext}' in entry['outputs'] and all(
+                os.path.isfile(f'{d_out}/{out}') for out in entry['outputs'])
+
+    @staticmethod
+    def _manifest_entry(job, outputs):
+        """ Manifest record of a converted series.
+        """
+        return {'source': job['source'],
+                'outputs': sorted(outputs),
+                'converted': datetime.now().isoformat(timespec='seconds')}
+
+    def _read_manifest(self):
+        """ Load the conversion manifest.
+
+        Returns
+        -------
+        manifest : dict
+            session/img_type/f_out keys paired with manifest entries
+        """
+        if not os.path.isfile(self.manifest):
+            return {}
+        with open(self.manifest, 'r') as f:
+            return json.load(f)
+
+    def _update_manifest(self, entries):
+        """ Add entries to the manifest.
+
+        The manifest is shared by conversions of other sequence classes that
+        may run in other processes. It is locked while read and updated, and
+        replaced atomically so a crash never leaves it truncated.
+
+        Arguments
+        ---------
+        entries : dict
+            session/img_type/f_out keys paired with manifest entries
+        """
+        os.makedirs(os.path.dirname(self.manifest), exist_ok=True)
+        with open(f'{self.manifest}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self._read_manifest()
+            manifest.update(entries)
+            with open(f'{self.manifest}.tmp', 'w') as f:
+                json.dump(manifest, f, indent='\t', sort_keys=True)
+            os.replace(f'{self.manifest}.tmp', self.manifest)
+
+    def _convert_series(self, job, entry=None):
+        """ Convert a series into a hidden directory and move it into place.
+
+        Arguments
+        ---------
+        job : dict
+            conversion job, from convert
+        entry : dict
+            previous manifest entry of the series, its outputs are removed
+            if the new conversion does not replace them
+
+        Returns
+        -------
+        error : str or None
+            description of the failure, None if successful
+        outputs : list of str
+            file names moved into d_out
+        record : dict
+            profile of the dcm2niix call
+        """
+        # Clear partial output of an interrupted conversion
+        shutil.rmtree(job['d_tmp'], ignore_errors=True)
+        os.makedirs(job['d_tmp'])
+
+        error, usage = self._convert(job['cmd'])
+        outputs = sorted(os.listdir(job['d_tmp']))
+        if error is None and f"{job['f_out']}.json" not in outputs:
+            error = f"{job['cmd']}\n  no json was written"
+        record = dict(usage, name=job['f_out'], kind='dcm2niix',
+                      status='done' if error is None else 'failed')
+        if error is not None:
+            shutil.rmtree(job['d_tmp'], ignore_errors=True)
+            return error, [], record
+
+        for out in outputs:
+            os.replace(f"{job['d_tmp']}/{out}", f"{job['d_out']}/{out}")
+        os.rmdir(job['d_tmp'])
+
+        if entry is not None:
+            for out in set(entry['outputs']).difference(outputs):
+                if os.path.isfile(f"{job['d_out']}/{out}"):
+                    os.remove(f"{job['d_out']}/{out}")
+        return None, outputs, record
+
+    @staticmethod
+    def _convert(cmd):
+        """ Run a single dcm2niix command.
+
+        Arguments
+        ---------
+        cmd : str
+            dcm2niix command line
+
+        Returns
+        -------
+        error : str or None
+            description of the failure, None if successful
+        usage : dict
+            start/end times, wall and cpu time (s), peak memory (MB) and
+            bytes read/written by the command and its children. Peak memory
+            is that of the largest process, an upper bound for small ones
+            as it includes the memory copied from this process by fork.
+        """
+        start = time.time()
+        try:
+            proc = subprocess.Popen(cmd, shell=True,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+            # Usage of this command alone, others run in parallel threads
+            _, status, rusage = os.wait4(proc.pid, 0)
+        except OSError as err:
+            return f"{cmd}\n  {err}", {'start_ts': start,
+                                       'end_ts': time.time(),
+                                       'wall_s': time.time() - start}
+        end = time.time()
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+            else -os.WTERMSIG(status)
+
+        usage = {'start_ts': start,
+                 'end_ts': end,
+                 'wall_s': end - start,
+                 'cpu_s': rusage.ru_utime + rusage.ru_stime,
+                 'peak_rss_mb': rusage.ru_maxrss / 1024,
+                 'read_bytes': rusage.ru_inblock * 512,
+                 'write_bytes': rusage.ru_oublock * 512}
+        if proc.returncode != 0:
+            return f"{cmd}\n  exited with status {proc.returncode}", usage
+        return None, usage
+
+    def _intended_for(self, session, d_out, f_out, acq, images=None):
+        """ Set the IntendedFor field of a fmap json to its paired image.
+
+        Arguments
+        ---------
+        session : str
+            session of the fmap, either ses-01 or ses-02
+        d_out : str
+            directory of the fmap
+        f_out : str
+            file name of the fmap, without extension
+        acq : str
+            acq label of the fmap, matches the paired image name
+        images : list of dict
+            files of the subject from bids_index, queried if not given
+        """
+        if images is None:
+            images = self.bids_index.files(self.subj_id, session)
+        img_match = [img for img in images if img['session'] == session and
+                     img['datatype'] != 'fmap' and
+                     fnmatch.fnmatchcase(img['name'], f'*{acq}*.nii*') and
+                     img['name'].endswith(('.nii', '.nii.gz'))]
+        # Either extension, the latest if converted both ways
+        img_match = max(img_match, key=lambda img: img['mtime_ns'])
+
+        # Load img json into dictionary
+        with open(f"{d_out}/{f_out}.json", 'r') as f:
+            img_json = json.load(f)
+
+        # Already paired, left as is
+        if img_json.get('IntendedFor') == img_match['name']:
+            return
+
+        # Clear prexisting key, if one exists
+        if 'IntendedFor' in list(img_json.keys()):
+            del img_json['IntendedFor']
+
+        # Write, replacing the json so the index sees the change
+        img_json['IntendedFor'] = img_match['name']
+        with open(f'{d_out}/.{f_out}.json.tmp', 'w') as f:
+            json.dump(img_json, f, indent='\t')
+        os.replace(f'{d_out}/.{f_out}.json.tmp', f'{d_out}/{f_out}.json')
+
+
+def find_t1w(bids_dir, subj_id, ses):
+    """ T1w image of a session, relative to bids_dir.
+
+    Arguments
+    ---------
+    bids_dir : str
+        bids directory
+    subj_id : str
+        subject as in bids_dir ex: sub-1234
+    ses : str
+        session, either ses-01 or ses-02
+
+    Returns
+    -------
+    t1w : str
+        the .nii.gz or .nii image found, .nii if neither exists yet
+    """
+    t1w = f'{subj_id}/{ses}/anat/{subj_id}_{ses}_T1w'
+    found = [img['path'] for img in BidsIndex(bids_dir).files(
+        subj_id, ses, 'anat', f'{subj_id}_{ses}_T1w.nii*')]
+    for ext in ['.nii.gz', '.nii']:
+        if f'{t1w}{ext}' in found:
+            return f'{t1w}{ext}'
+    return f'{t1w}.nii'
+
+
+def find_tasks(bids_dir, subj_id, ses, raw_dir=None):
+    """ Bold tasks of a session.
+
+    Arguments
+    ---------
+    bids_dir : str
+        bids directory
+    subj_id : str
+        subject as in bids_dir ex: sub-1234
+    ses : str
+        session, either ses-01 or ses-02
+    raw_dir : str
+        raw data of the subject, if given the tasks it converts to are
+        returned, whether or not they are in bids_dir yet
+
+    Returns
+    -------
+    tasks : list of str
+        task labels, ex: CAAT
+    """
+    if raw_dir is not None:
+        images = [job['f_out'] for job in Subject(
+            raw_dir, bids_dir).convert_jobs(['func'], [ses])]
+    else:
+        images = [img['name'] for img in BidsIndex(bids_dir).files(
+            subj_id, ses, 'func', '*_task-*_bold.nii*')]
+    tasks = [re.search('_task-([^_]+)_', os.path.basename(img)) for img in
+             images]
+    return sorted(set(task.group(1) for task in tasks if task is not None))
+
+
+def nifti_mvox(path):
+    """ Megavoxels of a NIfTI image, volumes included, from its header.
+
+    Arguments
+    ---------
+    path : str
+        .nii or .nii.gz image, NIfTI-1 or NIfTI-2
+
+    Returns
+    -------
+    mvox : float
+        product of the image dimensions in millions, None if the header
+        can not be read
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    try:
+        with opener(path, 'rb') as f:
+            header = f.read(80)
+    except (IOError, OSError, EOFError):
+        return None
+
+    # The header size gives the version and byte order
+    for order in ['<', '>']:
+        if len(header) < 80:
+            return None
+        size = struct.unpack(f'{order}i', header[:4])[0]
+        if size == 348:
+            dims = struct.unpack(f'{order}8h', header[40:56])
+            break
+        elif size == 540:
+            dims = struct.unpack(f'{order}8q', header[16:80])
+            break
+    else:
+        return None
+
+    if not 0 < dims[0] <= 7:
+        return None
+    mvox = 1
+    for dim in dims[1:dims[0] + 1]:
+        mvox *= max(dim, 1)
+    return mvox / 10**6
+
+
+def find_subjects(subjects):
+    """ List raw subject directories for batch processing.
+
+    Arguments
+    ---------
+    subjects : str
+        either a text file with one raw subject directory per line, or a raw
+        root directory whose sub-directories are subjects
+
+    Returns
+    -------
+    raw_dirs : list of str
+        raw subject directories
+    """
+    if os.path.isdir(subjects):
+        with os.scandir(subjects) as entries:
+            raw_dirs = [entry.path for entry in entries if entry.is_dir() and
+                        not entry.name.startswith('.')]
+    elif os.path.isfile(subjects):
+        with open(subjects, 'r') as f:
+            raw_dirs = [line.strip() for line in f if line.strip() != '' and
+                        not line.startswith('#')]
+    else:
+        raise IOError(f'Subject list or raw directory missing: {subjects}')
 
+    raw_dirs.sort()
+    return raw_dirs
@@ -8,9 +8,14 @@ import json
 from nipype import Workflow
 import nipype.pipeline.engine as pe
 from nipype.interfaces import utility as niu
+from nipype.interfaces.base import isdefined
 from interfaces import (
-    AntsCorticalThickness, FreesurferMB, Mindboggle, Fmriprep, Mriqc
+    AntsCorticalThickness, FreesurferMB, Mindboggle, Fmriprep, Mriqc,
+    MriqcGroup, BidsConvert, Cleanup, SingularityCommandLine,
+    instance_prefix, stop_instances
 )
+from scheduler import node_hours, plan_cpus, set_threads, mem_calc
+from utils import find_t1w, find_tasks
 
 
 def create_workflow(
@@ -23,7 +28,18 @@ def create_workflow(
     fs_simg='/mnt/Filbey/common/Studies/MJXProcessing/singularity/freesurfer_6.0.simg',
     fmri_simg='/mnt/Filbey/common/Studies/MJXProcessing/singularity/fmriprep-20.0.5.simg',
     ncpus=6,
-    run_nodes=['mriqc', 'ants', 'freesurfer', 'mindboggle', 'fmriprep']
+    run_nodes=['mriqc', 'ants', 'freesurfer', 'mindboggle', 'fmriprep'],
+    raw_dir=None,
+    convert_jobs=1,
+    compress=False,
+    split_fmriprep=False,
+    instances=False,
+    work_dir=None,
+    templateflow_dir=None,
+    retention='all',
+    log_max_mb=None,
+    dry_run=False,
+    name='wf_all'
 ):
     """ Create sMRI and fMRI workflow:
         mriqc, ants, freesurfer, mindboggle, fmriprep
@@ -34,8 +50,16 @@ def create_workflow(
         path to bids directory
     subj_id : str
         subject's ursi/id as in bids_dir ex: sub-1234
-    ses : string
-        session number, either ses-01 or ses-02
+    ses : str or list of str
+        session number, either ses-01 or ses-02. Several sessions run side
+        by side, each with its own ants, freesurfer, mindboggle and fmriprep
+        task nodes, suffixed with the session. Their outputs are written to
+        ants/<subj_id>/<ses> and freesurfer/<subj_id>_<ses>. Mriqc and the
+        fmriprep anatomical workflows are shared by the sessions, fmriprep
+        reconstructs the subject's template without freesurfer/<subj_id>,
+        in a node suffixed _recon and planned with recon-all's hours. Its
+        recon-all stands in for the sessions', whose freesurfer nodes then
+        only run when mindboggle needs them.
     proc_dir : str
         path to write processed outputs
     mriqc_simg : str
@@ -45,11 +69,51 @@ def create_workflow(
     fmri_simg : str
         path to fmriprep singularity image
     ncpus : int
-        number of cpus for parallel processing
+        number of cpus for parallel processing, shared by nodes that run
+        at the same time
     run_nodes: list of strings
         specifies which nodes to run.
         'mindboggle' will requires 'ants' and 'freesurfer' to run.
         'fmriprep' will requires 'freesurfer' to run.
+        'freesurfer' runs recon-all as autorecon1, 2 and 3 nodes.
+        Prerequisites completed by a previous run are found on disk and
+        may be left out. Nodes whose results are on disk are skipped.
+    raw_dir : str
+        path to the subject's raw data. If given, BIDS conversion of the
+        session runs inside the workflow, one node per sequence class, and
+        mriqc is split into anatomical and functional nodes.
+    convert_jobs : int
+        number of concurrent dcm2niix conversions per conversion node
+    compress : bool
+        convert to .nii.gz images rather than .nii
+    split_fmriprep : bool
+        run an anatomical fmriprep pass, then one fmriprep node per bold
+        task of each session, reusing its anatomical derivatives. Each task
+        writes to fmriprep/<subj_id>[_<ses>]_task-<task>. Requires
+        fmriprep 20.1 or later.
+    instances : bool
+        run nodes sharing an image and binds in one singularity instance,
+        stopped by run_workflow when the run ends
+    work_dir : str
+        persistent work directory of mriqc and fmriprep, ex: on local
+        scratch, kept between runs so repeat runs reuse intermediate
+        results. Each node works in <work_dir>/<subj_id>/<node name>.
+    templateflow_dir : str
+        pre-populated TemplateFlow cache, mounted read-only into mriqc and
+        fmriprep so templates are not fetched at run time
+    retention : str
+        retention policy of cleanup.RETENTION: all, final or minimal. Other
+        than all, a cleanup node runs once every other node has finished,
+        removing or compressing intermediates and pruning nipype node
+        directories, and reports the bytes reclaimed.
+    log_max_mb : float
+        stream container output to stdout.log and stderr.log in each node's
+        _report directory, rotated at this size, instead of holding it in
+        memory
+    dry_run : bool
+        only plan, nothing is written to bids_dir, proc_dir or work_dir
+    name : str
+        name of the workflow, unique per subject when batched
 
     Returns
     -------
@@ -57,18 +121,28 @@ def create_workflow(
         nipype workflow
     """
     # Make output directories
-    if not os.path.exists(proc_dir):
+    if not os.path.exists(proc_dir) and not dry_run:
         os.mkdir(proc_dir)
-    if not os.path.exists(f"{proc_dir}/workflows"):
+    if not os.path.exists(f"{proc_dir}/workflows") and not dry_run:
         os.mkdir(f"{proc_dir}/workflows")
 
     # Ensure bids compliant
-    if not os.path.exists(f"{bids_dir}/dataset_description.json"):
+    if not os.path.exists(bids_dir) and not dry_run:
+        os.mkdir(bids_dir)
+    if not os.path.exists(f"{bids_dir}/dataset_description.json") and \
+            not dry_run:
         desc = {"Name": "MJX Study", "BIDSVersion": "1.2.2"}
         with open(f'{bids_dir}/dataset_description.json', 'w') as f:
             json.dump(desc, f, indent='\t')
 
-    wf = Workflow(name="wf_all", base_dir=f"{proc_dir}/workflows/{subj_id}")
+    wf = Workflow(name=name, base_dir=f"{proc_dir}/workflows/{subj_id}")
+
+    # Sessions processed side by side, node names and outputs of each
+    #   session are suffixed with it when there are several.
+    sessions = [ses] if isinstance(ses, str) else list(ses)
+    multi = len(sessions) > 1
+
+    def suffix(ses): return f'_{ses}' if multi else ''
 
     # Specify subject/session specific info
     input_node = pe.Node(niu.IdentityInterface(fields=['subj_id', 'ses',
@@ -87,144 +161,501 @@ def create_workflow(
     input_node.inputs.fmri_simg = fmri_simg
     input_node.inputs.ncpus = ncpus
 
-    # Lazy evaluation of run_nodes
-    if 'mindboggle' in run_nodes and 'freesurfer' not in run_nodes:
-        raise ValueError("Mindboggle requires freesurfer and ants.\n"
-                         "If these pre-requistes have been ran:\n"
-                         "1) run mindboggle manually\n"
-                         "2) alter the code here and in interfaces\n" 
-                         "   to be more flexible.")
-    elif 'mindboggle' in run_nodes and 'ants' not in run_nodes:
-        raise ValueError("Mindboggle requires freesurfer and ants.\n"
-                         "If these pre-requistes have been ran:\n"
-                         "1) run mindboggle manually\n"
-                         "2) alter the code here and in interfaces\n" 
-                         "   to be more flexible.")
-    elif 'fmriprep' in run_nodes and 'freesurfer' not in run_nodes:
-        raise ValueError("Fmriprep requires freesurfer to be ran.\n"
-                         "If this pre-requiste has been ran:\n"
-                         "1) run fmriprep manually\n"
-                         "2) alter the code in workflow and\n"
-                         "   interface to be more flexible.")
-
-    # Mriqc
+    # Nodes reading BIDS connect to the source of each sequence class, per
+    #   session, and for subject level nodes, of all sessions.
+    img_types = ['anat', 'func', 'dwi', 'fmap']
+    ses_src = {ses: {img_type: (input_node, 'bids_dir') for img_type in
+                     img_types} for ses in sessions}
+    subj_src = {img_type: (input_node, 'bids_dir') for img_type in img_types}
+
+    # T1w relative to bids_dir, as converted by this run or found on disk
+    def bids_rel(files): return '/'.join(files[0].split('/')[-4:])
+    t1w = {ses: find_t1w(bids_dir, subj_id, ses) for ses in sessions}
+    conv_nodes = {}
+
+    # BIDS conversion, one node per sequence class, so nodes that only need
+    #   the T1w start while func, dwi and fmaps are still converting.
+    if raw_dir is not None:
+        conv_jobs = min(convert_jobs, ncpus)
+        for ses in sessions:
+            conv_nodes[ses] = {}
+            for img_type in img_types:
+                conv_node = pe.Node(BidsConvert(),
+                                    name=f'convert_{img_type}{suffix(ses)}',
+                                    n_procs=conv_jobs)
+                conv_node.inputs.raw_dir = raw_dir
+                conv_node.inputs.img_type = img_type
+                conv_node.inputs.session = ses
+                conv_node.inputs.convert_jobs = conv_jobs
+                conv_node.inputs.compress = compress
+                wf.connect(input_node, 'bids_dir', conv_node, 'bids_dir')
+                conv_nodes[ses][img_type] = conv_node
+                ses_src[ses][img_type] = (conv_node, 'bids_dir')
+
+            # Fmaps are paired with their images, once those are converted
+            conv_targets = pe.Node(niu.Merge(2),
+                                   name=f'convert_targets{suffix(ses)}')
+            wf.connect([(conv_nodes[ses]['func'], conv_targets,
+                         [('out_files', 'in1')]),
+                        (conv_nodes[ses]['dwi'], conv_targets,
+                         [('out_files', 'in2')]),
+                        (conv_targets, conv_nodes[ses]['fmap'],
+                         [('out', 'target_files')])])
+        subj_src = dict(ses_src[sessions[0]])
+
+        # Subject level nodes wait for every session
+        if multi:
+            def first(dirs): return dirs[0]
+            for img_type in img_types:
+                converted = pe.Node(niu.Merge(len(sessions)),
+                                    name=f'converted_{img_type}')
+                for idx, ses in enumerate(sessions):
+                    wf.connect(conv_nodes[ses][img_type], 'bids_dir',
+                               converted, f'in{idx+1}')
+                subj_src[img_type] = (converted, ('out', first))
+
+    # Outputs of each session, relative to proc_dir
+    fs_sd = 'freesurfer'
+    if multi:
+        ants_outs = {ses: f"ants/{subj_id}/{ses}/ants" for ses in sessions}
+        fs_ids = {ses: f"{subj_id}_{ses}" for ses in sessions}
+    else:
+        ants_outs = {sessions[0]: f"ants/{subj_id}/ants"}
+        fs_ids = {sessions[0]: subj_id}
+
+    # Fmriprep of several sessions runs recon-all of the subject, unless
+    #   a past run completed it. The sessions' recon-all is skipped, unless
+    #   mindboggle needs it, so a subject is reconstructed once.
+    fmri_recon = multi and 'fmriprep' in run_nodes and not (
+        os.path.isdir(proc_dir) and FreesurferMB(
+            bind_out=proc_dir, fs_sd=fs_sd, fs_id=subj_id).is_complete())
+    run_fs = 'freesurfer' in run_nodes and (
+        not fmri_recon or 'mindboggle' in run_nodes)
+
+    for ses in sessions:
+        ants_out = ants_outs[ses]
+        fs_id = fs_ids[ses]
+
+        # Prerequisites left out of run_nodes may be complete from a past
+        #   run
+        past_run = os.path.isdir(proc_dir)
+        fs_done = 'freesurfer' not in run_nodes and past_run and \
+            FreesurferMB(bind_out=proc_dir, fs_sd=fs_sd,
+                         fs_id=fs_id).is_complete()
+        ants_done = 'ants' not in run_nodes and past_run and \
+            AntsCorticalThickness(bind_out=proc_dir,
+                                  out=ants_out).is_complete()
+
+        # Lazy evaluation of run_nodes. Fmriprep of several sessions
+        #   reconstructs the subject's template itself.
+        if 'mindboggle' in run_nodes and 'freesurfer' not in run_nodes and \
+                not fs_done:
+            raise ValueError("Mindboggle requires freesurfer and ants.\n"
+                             "No completed freesurfer run was found in\n"
+                             f"{proc_dir}/{fs_sd}/{fs_id}, add freesurfer\n"
+                             "to run_nodes.")
+        elif 'mindboggle' in run_nodes and 'ants' not in run_nodes and \
+                not ants_done:
+            raise ValueError("Mindboggle requires freesurfer and ants.\n"
+                             "No completed ants run was found in\n"
+                             f"{proc_dir}/{ants_out}*, add ants to "
+                             "run_nodes.")
+        elif 'fmriprep' in run_nodes and 'freesurfer' not in run_nodes and \
+                not fs_done and not multi:
+            raise ValueError("Fmriprep requires freesurfer to be ran.\n"
+                             "No completed freesurfer run was found in\n"
+                             f"{proc_dir}/{fs_sd}/{fs_id}, add freesurfer\n"
+                             "to run_nodes.")
+
+    # Mriqc, of all sessions of the subject
     if 'mriqc' in run_nodes:
-        try:
-            os.mkdir(f"{proc_dir}/mriqc")
-        except FileExistsError:
-            pass
-        try:
-            os.mkdir(f"{proc_dir}/mriqc/{subj_id}")
-        except FileExistsError:
-            pass
+        if not dry_run:
+            try:
+                os.mkdir(f"{proc_dir}/mriqc")
+            except FileExistsError:
+                pass
+            try:
+                os.mkdir(f"{proc_dir}/mriqc/{subj_id}")
+            except FileExistsError:
+                pass
+        if raw_dir is None:
+            qc_nodes = [('mriqc', None, 'anat')]
+        else:
+            # Anatomical qc starts as soon as the T1w is converted
+            qc_nodes = [('mriqc_anat', 'T1w', 'anat'),
+                        ('mriqc_func', 'bold', 'func')]
+
+        for qc_name, modality, img_type in qc_nodes:
+            qc_node = pe.Node(Mriqc(), name=qc_name)
+            qc_node.inputs.mode = 'run'
+            qc_node.inputs.env = '--cleanenv'
+            qc_node.inputs.io_partic = True
+            if modality is not None:
+                qc_node.inputs.modalities = modality
+            # Connections into mriqc
+            def cut_sub(subj): return subj[4:]  # modern lamda replacement
+            wf.connect(*subj_src[img_type], qc_node, 'bind_in')
+            wf.connect([(input_node, qc_node, [('proc_dir', 'bind_out'),
+                                               ('qc_simg', 'container'),
+                                               (('subj_id', cut_sub),
+                                                'partic_lab')])])
+
+    # Ants, freesurfer and mindboggle of each session, side by side
+    for ses in sessions:
+        ants_out = ants_outs[ses]
+        fs_id = fs_ids[ses]
+
+        # ANTs segmentation
+        if 'ants' in run_nodes:
+            if not dry_run:
+                os.makedirs(f"{proc_dir}/{os.path.dirname(ants_out)}",
+                            exist_ok=True)
+
+            ants_node = pe.Node(AntsCorticalThickness(),
+                                name=f'ants{suffix(ses)}')
+            ants_node.inputs.mode = 'run'
+            ants_node.inputs.env = '--cleanenv'
+            ants_node.inputs.ants_cmd = 'antsCorticalThickness.sh'
+            ants_node.inputs.dims = 3
+            ants_node.inputs.template = True
+            ants_node.inputs.ss_template = True
+            ants_node.inputs.prob_mask = True
+            ants_node.inputs.extract_mask = True
+            ants_node.inputs.priors = 'priors%d.nii.gz'
+            ants_node.inputs.seed = 0
+            ants_node.inputs.precision = 1
+            ants_node.inputs.out = ants_out
+            # Connections into ants
+            wf.connect(*ses_src[ses]['anat'], ants_node, 'bind_in')
+            wf.connect([(input_node, ants_node, [('proc_dir', 'bind_out'),
+                                                 ('mb_simg', 'container')])])
+            if raw_dir is not None:
+                wf.connect(conv_nodes[ses]['anat'], ('out_files', bids_rel),
+                           ants_node, 'in_img')
+            else:
+                ants_node.inputs.in_img = t1w[ses]
+
+        # Freesurfer
+        if run_fs:
+            if not dry_run:
+                try:
+                    os.mkdir(f"{proc_dir}/freesurfer")
+                except FileExistsError:
+                    pass
+
+            # One node per autorecon stage, a killed run resumes at the last
+            #   finished stage. Stages 2 and 3 run hemispheres in parallel.
+            fs_node = None
+            for stage in ['autorecon1', 'autorecon2', 'autorecon3']:
+                prev_node = fs_node
+                fs_node = pe.Node(FreesurferMB(),
+                                  name=f'freesurfer_{stage}{suffix(ses)}')
+                fs_node.inputs.mode = 'run'
+                fs_node.inputs.env = '--cleanenv'
+                fs_node.inputs.bind_fs_home = '$FREESURFER_HOME'
+                fs_node.inputs.fs_cmd = f'recon-all -{stage} -no-isrunning'
+                fs_node.inputs.stage = stage
+                fs_node.inputs.fs_sd = fs_sd
+                fs_node.inputs.fs_id = fs_id
+                fs_node.inputs.parallel = stage != 'autorecon1'
+                # Connections into freesurfer
+                wf.connect(*ses_src[ses]['anat'], fs_node, 'bind_in')
+                wf.connect([(input_node, fs_node, [('proc_dir', 'bind_out'),
+                                                   ('fs_simg', 'container')])])
+                if prev_node is not None:
+                    wf.connect(prev_node, 'recon_dir', fs_node,
+                               'prev_recon_dir')
+                elif raw_dir is not None:
+                    wf.connect(conv_nodes[ses]['anat'], ('out_files',
+                                                         bids_rel),
+                               fs_node, 'in_img')
+                else:
+                    fs_node.inputs.in_img = t1w[ses]
+
+        # Mindboggle
+        if 'mindboggle' in run_nodes:
+            if not dry_run:
+                try:
+                    os.mkdir(f"{proc_dir}/mindboggled")
+                except FileExistsError:
+                    pass
+
+            mb_node = pe.Node(Mindboggle(), name=f'mindboggle{suffix(ses)}')
+            mb_node.inputs.mode = 'run'
+            mb_node.inputs.env = '--cleanenv'
+            mb_node.inputs.mb_cmd = 'mindboggle'
+            mb_node.inputs.out = 'mindboggled'
+            mb_node.inputs.vis_color = True
+            # Connections into mindboggle
+            wf.connect([(input_node, mb_node, [('proc_dir', 'bind_in'),
+                                               ('mb_simg', 'container')])])
+            # Prerequisites from this run, or found on disk
+            if run_fs:
+                wf.connect([(fs_node, mb_node, [('recon_dir', 'fs_dir')])])
+            else:
+                mb_node.inputs.fs_dir = f"{fs_sd}/{fs_id}"
+            if 'ants' in run_nodes:
+                wf.connect([(ants_node, mb_node, [('seg_file', 'ants_seg')])])
+            else:
+                mb_node.inputs.ants_seg = ants_out
+
+    # Fmriprep. Anatomical workflows are shared by the subject's sessions,
+    #   split runs give each session's tasks a node.
+    if 'fmriprep' in run_nodes:
+        # Named so its hours include recon-all
+        recon = '_recon' if fmri_recon else ''
+        anat_name = f'fmriprep_anat{recon}'
+        if split_fmriprep:
+            # Anatomical pass, then the sessions' tasks side by side
+            passes = [(anat_name, None, None)] + [
+                (f'fmriprep_func_{task}{suffix(ses)}', task, ses) for ses in
+                sessions for task in find_tasks(bids_dir, subj_id, ses,
+                                                raw_dir)
+            ]
+        else:
+            passes = [(f'fmriprep{recon}', None, None)]
+
+        def parent_dir(p): return p.split('/')[0]
+        for node_name, task, ses in passes:
+            fmri_node = pe.Node(Fmriprep(), name=node_name)
+            fmri_node.inputs.mode = 'run'
+            fmri_node.inputs.env = '--cleanenv'
+            fmri_node.inputs.bind_fs_home = '$FREESURFER_HOME'
+            fmri_node.inputs.skip_validation = True
+            fmri_node.inputs.aroma = True
+            fmri_node.inputs.out_space = 'MNI152NLin6Asym T1w'
+            fmri_node.inputs.fs_license = True
+            fmri_node.inputs.io_partic = True
+            # Connections into fmriprep, the anatomical pass only needs T1w
+            img_type = 'anat' if node_name == anat_name else 'fmap'
+            src = subj_src if ses is None else ses_src[ses]
+            wf.connect(*src[img_type], fmri_node, 'bind_in')
+            wf.connect([(input_node, fmri_node, [('proc_dir', 'bind_out'),
+                                                 ('fmri_simg', 'container'),
+                                                 ('subj_id', 'partic_lab')])])
+            if 'freesurfer' in run_nodes and not multi:
+                wf.connect(fs_node, ('recon_dir', parent_dir), fmri_node,
+                           'recon_dir')
+            else:
+                fmri_node.inputs.recon_dir = fs_sd
+
+            if node_name == anat_name:
+                fmri_node.inputs.anat_only = True
+                anat_node = fmri_node
+            elif task is not None:
+                # Tasks write their own reports, logs and dataset
+                #   description, beside the anatomical pass
+                fmri_node.inputs.task_id = task
+                fmri_node.inputs.out_dir = \
+                    f"fmriprep/{subj_id}{suffix(ses)}_task-{task}"
+                if multi:
+                    fmri_node.inputs.session = ses
+                wf.connect(anat_node, ('fmri_dir', parent_dir), fmri_node,
+                           'anat_derivatives')
+
+    # Intermediates are cleaned up once all other nodes have finished
+    if retention != 'all':
+        leaves = [node for node in wf._graph.nodes() if
+                  wf._graph.out_degree(node) == 0]
+        finished = pe.Node(niu.Merge(len(leaves)), name='finished')
+        for idx, node in enumerate(leaves):
+            wf.connect(node, node.outputs.copyable_trait_names()[0],
+                       finished, f'in{idx+1}')
+
+        clean_node = pe.Node(Cleanup(), name='cleanup', overwrite=True)
+        clean_node.inputs.policy = retention
+        clean_node.inputs.subj_id = subj_id
+        if 'ants' in run_nodes:
+            clean_node.inputs.ants_outs = [ants_outs[ses] for ses in
+                                           sessions]
+        if 'freesurfer' in run_nodes or 'fmriprep' in run_nodes:
+            clean_node.inputs.fs_dirs = sorted(set(
+                f"{fs_sd}/{fs_id}" for fs_id in
+                list(fs_ids.values()) + [subj_id]))
+        if work_dir is not None:
+            clean_node.inputs.work_dirs = [f"{work_dir}/{subj_id}"]
+        wf.connect([(input_node, clean_node, [('proc_dir', 'proc_dir')]),
+                    (finished, clean_node, [('out', 'finished')])])
+
+    # Threads per node, favouring the critical path: freesurfer stages,
+    #   fmriprep. Nodes declare them so the plugin can share ncpus.
+    children = {node: list(wf._graph.successors(node)) for node in
+                wf._graph.nodes()}
+    hours = {node: node_hours(node.name) for node in wf._graph.nodes()}
+    for node, threads in plan_cpus(children, hours, ncpus).items():
+        set_threads(node, threads, max_gb=mem_calc(ncpus))
+
+    for node in wf._graph.nodes():
+        if isinstance(node.interface, SingularityCommandLine):
+            if instances:
+                node.inputs.instance_prefix = instance_prefix()
+            if log_max_mb is not None:
+                node.inputs.log_max_mb = log_max_mb
+
+    # Work directories and templates of mriqc and fmriprep, kept between runs
+    if work_dir is not None and not dry_run:
+        os.makedirs(work_dir, exist_ok=True)
+    for node in wf._graph.nodes():
+        if isinstance(node.interface, (Mriqc, Fmriprep)):
+            if work_dir is not None:
+                node.inputs.bind_work = work_dir
+                node.inputs.work_dir = f"{subj_id}/{node.name}"
+            if templateflow_dir is not None:
+                node.inputs.bind_templateflow = templateflow_dir
+
+    return wf
+
+
+def run_workflow(wf, plugin='CriticalPath', plugin_args=None, profile=True):
+    """ Run a workflow, writing the cpu split of each node with the run.
+
+    With profile, the wall time, cpu time, peak memory and I/O of each node
+    and of the processes it ran are written to profile_timeline.json/.csv,
+    and the critical path and idle cores to profile_summary.json, next to
+    the workflow's cpu_allocation.json. Singularity instances started by
+    the run's nodes are stopped when it ends.
+
+    Parameters
+    ----------
+    wf : nipype.pipeline.engine.workflows.Workflow
+        nipype workflow
+    plugin : str
+        nipype plugin name, or CriticalPath to size node threads by their
+        remaining path through the graph as cpus free up
+    plugin_args : dict
+        arguments passed to the plugin
+    profile : bool
+        record a profile of the run
+    """
+    plugin_args = {} if plugin_args is None else dict(plugin_args)
+    out_dir = f"{wf.base_dir}/{wf.name}"
+
+    callback = None
+    if profile:
+        from profiler import ProfileCallback
+        callback = ProfileCallback()
+        plugin_args.setdefault('status_callback', callback)
+
+    graph = None
+    try:
+        if plugin == 'CriticalPath':
+            from plugin import CriticalPathPlugin
+            plugin_args.setdefault('allocation_file',
+                                   f"{out_dir}/cpu_allocation.json")
+            graph = wf.run(plugin=CriticalPathPlugin(plugin_args=plugin_args))
+        else:
+            graph = wf.run(plugin=plugin, plugin_args=plugin_args)
+    finally:
+        if any(isinstance(node.interface, SingularityCommandLine) and
+               isdefined(node.inputs.instance_prefix) for node in
+               wf._get_all_nodes()):
+            stop_instances(instance_prefix())
+        if callback is not None:
+            children = None
+            if graph is not None:
+                children = {node.fullname: [child.fullname for child in
+                                            graph.successors(node)] for
+                            node in graph.nodes()}
+            summary = callback.write(out_dir, plugin_args.get(
+                'n_procs', os.cpu_count()), children)
+            print(f"Critical path: {' > '.join(summary['critical_path'])} "
+                  f"({summary['critical_path_s']/3600:.2f} h), idle cores: "
+                  f"{summary['idle_core_s']/3600:.2f} core-h")
+
+
+def create_batch_workflow(
+    subj_ids,
+    ses,
+    bids_dir,
+    proc_dir,
+    qc_simg='/mnt/Filbey/common/Studies/MJXProcessing/singularity/mriqc0.15.2rc1.simg',
+    cohort_mriqc=False,
+    **kwargs
+):
+    """ Combine the workflows of many subjects into a single graph, so a
+        cohort is scheduled in one process under one cpu/memory budget.
+
+    Parameters
+    ----------
+    subj_ids : list of str
+        subjects' ursi/id as in bids_dir ex: sub-1234
+    ses : str or list of str
+        session number, either ses-01 or ses-02, or sessions processed side
+        by side
+    bids_dir : str
+        path to bids directory
+    proc_dir : str
+        path to write processed outputs
+    qc_simg : str
+        path to mriqc singularity image
+    cohort_mriqc : bool
+        run mriqc once for all subjects missing reports, rather than once
+        per subject, sharing a work directory, then aggregate the image
+        quality metrics of all participants at the group level
+    kwargs : dict
+        other containers, ncpus, run_nodes, compress, instances, work_dir,
+        templateflow_dir, retention, log_max_mb and dry_run, passed to
+        create_workflow
+
+    Returns
+    -------
+    wf : nipype.pipeline.engine.workflows.Workflow
+        nipype workflow with one sub-workflow per subject
+    """
+    run_nodes = kwargs.get('run_nodes', ['mriqc', 'ants', 'freesurfer',
+                                         'mindboggle', 'fmriprep'])
+    cohort_mriqc = cohort_mriqc and 'mriqc' in run_nodes
+    if cohort_mriqc:
+        kwargs['run_nodes'] = [node for node in run_nodes if node != 'mriqc']
+
+    sub_wfs = []
+    for subj_id in subj_ids:
+        sub_wf = create_workflow(subj_id, ses, bids_dir, proc_dir,
+                                 qc_simg=qc_simg,
+                                 name=f"wf_{subj_id.replace('-', '_')}",
+                                 **kwargs)
+        sub_wfs.append(sub_wf)
+
+    wf = Workflow(name="wf_batch", base_dir=f"{proc_dir}/workflows")
+    wf.add_nodes(sub_wfs)
+
+    if cohort_mriqc:
+        if not kwargs.get('dry_run', False):
+            os.makedirs(f"{proc_dir}/mriqc", exist_ok=True)
+        work_dir = f"workflows/{wf.name}/mriqc_work"
+
         qc_node = pe.Node(Mriqc(), name='mriqc')
         qc_node.inputs.mode = 'run'
         qc_node.inputs.env = '--cleanenv'
         qc_node.inputs.io_partic = True
-        # Connections into mriqc
-        def half(ncpus): return int(ncpus/2)  # modern lamda replacement
-        def mem_calc(ncpus): return int(ncpus*2)  # alters ncpus for other args
-        def cut_sub(subj): return subj[4:]
-        wf.connect([(input_node, qc_node, [('bids_dir', 'bind_in'),
-                                           ('proc_dir', 'bind_out'),
-                                           ('qc_simg', 'container'),
-                                           (('subj_id', cut_sub), 'partic_lab'),
-                                           ('ncpus', 'ncpus'),
-                                           (('ncpus', half), 'ants_threads'),
-                                           (('ncpus', mem_calc), 'mem')])])
-
-    # ANTs segmentation
-    if 'ants' in run_nodes:
-        try:
-            os.mkdir(f"{proc_dir}/ants")
-        except FileExistsError:
-            pass
-
-        try:
-            os.mkdir(f"{proc_dir}/ants/{subj_id}")
-        except FileExistsError:
-            pass
-
-        ants_node = pe.Node(AntsCorticalThickness(), name='ants')
-        ants_node.inputs.mode = 'run'
-        ants_node.inputs.env = '--cleanenv'
-        ants_node.inputs.ants_cmd = 'antsCorticalThickness.sh'
-        ants_node.inputs.dims = 3
-        ants_node.inputs.template = True
-        ants_node.inputs.ss_template = True
-        ants_node.inputs.prob_mask = True
-        ants_node.inputs.extract_mask = True
-        ants_node.inputs.priors = 'priors%d.nii.gz'
-        ants_node.inputs.seed = 0
-        ants_node.inputs.precision = 1
-        ants_node.inputs.in_img = f"{subj_id}/{ses}/anat/{subj_id}_{ses}_T1w.nii"
-        ants_node.inputs.out = f"ants/{subj_id}/ants"
-        # Connections into ants
-        wf.connect([(input_node, ants_node, [('bids_dir', 'bind_in'),
-                                             ('proc_dir', 'bind_out'),
-                                             ('mb_simg', 'container')])])
-
-    # Freesurfer
-    if 'freesurfer' in run_nodes:
-        try:
-            os.mkdir(f"{proc_dir}/freesurfer")
-        except FileExistsError:
-            pass
-
-        fs_node = pe.Node(FreesurferMB(), name='freesurfer')
-        fs_node.inputs.mode = 'run'
-        fs_node.inputs.env = '--cleanenv'
-        fs_node.inputs.bind_fs_home = '$FREESURFER_HOME'
-        fs_node.inputs.fs_cmd = 'recon-all -all'
-        fs_node.inputs.fs_sd = 'freesurfer'
-        fs_node.inputs.in_img = f"{subj_id}/{ses}/anat/{subj_id}_{ses}_T1w.nii"
-        fs_node.inputs.parallel = True
-        # Connections into freesurfer
-        wf.connect([(input_node, fs_node, [('bids_dir', 'bind_in'),
-                                           ('proc_dir', 'bind_out'),
-                                           ('fs_simg', 'container'),
-                                           ('subj_id', 'fs_id'),
-                                           ('ncpus', 'fs_mp')])])
-
-    # Mindboggle
-    if 'mindboggle' in run_nodes:
-        try:
-            os.mkdir(f"{proc_dir}/mindboggled")
-        except FileExistsError:
-            pass
-
-        mb_node = pe.Node(Mindboggle(), name='mindboggle')
-        mb_node.inputs.mode = 'run'
-        mb_node.inputs.env = '--cleanenv'
-        mb_node.inputs.mb_cmd = 'mindboggle'
-        mb_node.inputs.out = 'mindboggled'
-        mb_node.inputs.vis_color = True
-        # Connections into mindboggle
-        wf.connect([(input_node, mb_node, [('proc_dir', 'bind_in'),
-                                           ('mb_simg', 'container'),
-                                           ('ncpus', 'ncpus')])])
-        wf.connect([(fs_node, mb_node, [('recon_dir', 'fs_dir')])])
-        wf.connect([(ants_node, mb_node, [('seg_file', 'ants_seg')])])
-
-    # Fmriprep
-    if 'fmriprep' in run_nodes:
-        fmri_node = pe.Node(Fmriprep(), name='fmriprep')
-        fmri_node.inputs.mode = 'run'
-        fmri_node.inputs.env = '--cleanenv'
-        fmri_node.inputs.bind_fs_home = '$FREESURFER_HOME'
-        fmri_node.inputs.skip_validation = True
-        fmri_node.inputs.aroma = True
-        fmri_node.inputs.out_space = 'MNI152NLin6Asym T1w'
-        fmri_node.inputs.fs_license = True
-        fmri_node.inputs.io_partic = True
-        # Connections into fmriprep
-        wf.connect([(input_node, fmri_node, [('bids_dir', 'bind_in'),
-                                             ('proc_dir', 'bind_out'),
-                                             ('fmri_simg', 'container'),
-                                             ('subj_id', 'partic_lab'),
-                                             ('ncpus', 'nthreads')])])
+        qc_node.inputs.bind_in = bids_dir
+        qc_node.inputs.bind_out = proc_dir
+        qc_node.inputs.container = qc_simg
+        qc_node.inputs.partic_lab = [subj_id[4:] for subj_id in subj_ids]
+        qc_node.inputs.work_dir = work_dir
+        set_threads(qc_node, kwargs.get('ncpus', 6),
+                    max_gb=mem_calc(kwargs.get('ncpus', 6)))
 
-        def parent_dir(p): return p.split('/')[0]
-        wf.connect(fs_node, ('recon_dir', parent_dir), fmri_node, 'recon_dir')
+        group_node = pe.Node(MriqcGroup(), name='mriqc_group')
+        group_node.inputs.mode = 'run'
+        group_node.inputs.env = '--cleanenv'
+        group_node.inputs.io_group = True
+        group_node.inputs.bind_in = bids_dir
+        group_node.inputs.bind_out = proc_dir
+        group_node.inputs.container = qc_simg
+        group_node.inputs.work_dir = work_dir
+        wf.connect(qc_node, 'qc_dir', group_node, 'qc_dir')
+
+        if kwargs.get('instances', False):
+            for node in [qc_node, group_node]:
+                node.inputs.instance_prefix = instance_prefix()
+        for node in [qc_node, group_node]:
+            if kwargs.get('log_max_mb') is not None:
+                node.inputs.log_max_mb = kwargs['log_max_mb']
+            if kwargs.get('work_dir') is not None:
+                node.inputs.bind_work = kwargs['work_dir']
+                node.inputs.work_dir = f"{wf.name}/mriqc"
+            if kwargs.get('templateflow_dir') is not None:
+                node.inputs.bind_templateflow = kwargs['templateflow_dir']
 
     return wf
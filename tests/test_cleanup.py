@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+from mjxproc.cleanup import ants_intermediates, clean_subject
+import os
+import gzip
+
+
+def make_ants(proc_dir):
+    # Outputs of antsCorticalThickness.sh with intermediates kept (-k 1)
+    ants_dir = proc_dir / 'ants' / 'sub-1'
+    ants_dir.mkdir(parents=True)
+    for name in ['CorticalThickness', 'BrainExtractionMask',
+                 'BrainSegmentationPosteriors1', 'SubjectToTemplate1Warp',
+                 'N4Corrected0', 'N4Truncated0', 'BrainExtractionBrain']:
+        with gzip.open(ants_dir / f'ants{name}.nii.gz', 'wb') as f:
+            f.write(os.urandom(4096))
+    for name in ['ACTStage6Complete.txt', 'brainvols.csv',
+                 'SubjectToTemplate0GenericAffine.mat',
+                 'BrainExtractionPrior0GenericAffine.mat',
+                 'BrainSegmentationConvergence.txt']:
+        (ants_dir / f'ants{name}').write_text('x')
+    return ants_dir
+
+
+def test_ants_intermediates(tmp_path):
+    ants_dir = make_ants(tmp_path)
+    paths = ants_intermediates(f'{ants_dir}/ants')
+    assert [os.path.basename(path) for path in paths] == \
+        ['antsBrainExtractionBrain.nii.gz',
+         'antsBrainExtractionPrior0GenericAffine.mat',
+         'antsBrainSegmentationConvergence.txt', 'antsN4Corrected0.nii.gz',
+         'antsN4Truncated0.nii.gz']
+
+
+def test_clean_subject(tmp_path):
+    ants_dir = make_ants(tmp_path)
+    fs_tmp = tmp_path / 'freesurfer' / 'sub-1' / 'tmp'
+    fs_tmp.mkdir(parents=True)
+    (fs_tmp / 'scratch.mgz').write_bytes(bytes(100))
+    wf_dir = tmp_path / 'workflows' / 'sub-1' / 'wf_all'
+    for node in ['ants_ses-01', 'cleanup']:
+        (wf_dir / node / '_report').mkdir(parents=True)
+        (wf_dir / node / 'result.pklz').write_bytes(bytes(10))
+    for log in ['stdout.log', 'stdout.log.1', 'stderr.log']:
+        (wf_dir / 'ants_ses-01' / '_report' / log).write_text('log')
+    (wf_dir / 'profile_summary.json').write_text('{}')
+
+    # Nothing is touched when everything is kept
+    kwargs = dict(ants_outs=['ants/sub-1/ants'], fs_dirs=['freesurfer/sub-1'],
+                  wf_dir=str(wf_dir), keep_nodes=['cleanup'])
+    reclaimed = clean_subject('all', str(tmp_path), **kwargs)
+    assert reclaimed['total'] == 0 and fs_tmp.is_dir()
+
+    # Gzipped intermediate images removed, final derivatives, small
+    #   intermediates, reports and node logs kept
+    images = [ants_dir / f'ants{name}.nii.gz' for name in
+              ['N4Corrected0', 'N4Truncated0', 'BrainExtractionBrain']]
+    n_bytes = sum(image.stat().st_size for image in images)
+    reclaimed = clean_subject('final', str(tmp_path), **kwargs)
+    assert not any(image.exists() for image in images)
+    assert (ants_dir / 'antsCorticalThickness.nii.gz').is_file()
+    assert (ants_dir / 'antsBrainSegmentationConvergence.txt').is_file()
+    assert not fs_tmp.exists()
+    assert sorted(os.listdir(wf_dir)) == \
+        ['cleanup', 'node_logs', 'profile_summary.json']
+    assert sorted(os.listdir(wf_dir / 'node_logs' / 'ants_ses-01')) == \
+        ['stderr.log', 'stdout.log', 'stdout.log.1']
+    assert reclaimed['ants'] == n_bytes
+    assert reclaimed['freesurfer'] == 100 and reclaimed['workflows'] == 10
+    assert reclaimed['total'] == sum(
+        reclaimed[key] for key in ['ants', 'freesurfer', 'work', 'workflows'])
+
+    # Logs survive later prunes
+    reclaimed = clean_subject('final', str(tmp_path), **kwargs)
+    assert reclaimed['total'] == 0
+    assert (wf_dir / 'node_logs' / 'ants_ses-01' / 'stdout.log').is_file()
+
+    # Intermediates removed
+    reclaimed = clean_subject('minimal', str(tmp_path),
+                              ants_outs=['ants/sub-1/ants'])
+    assert reclaimed['ants'] == 2
+    assert sorted(os.listdir(ants_dir)) == \
+        ['antsACTStage6Complete.txt', 'antsBrainExtractionMask.nii.gz',
+         'antsBrainSegmentationPosteriors1.nii.gz',
+         'antsCorticalThickness.nii.gz',
+         'antsSubjectToTemplate0GenericAffine.mat',
+         'antsSubjectToTemplate1Warp.nii.gz', 'antsbrainvols.csv']
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import os
+import os.path as op
+import sys
+import subprocess
+import pytest
+
+MJXPROC = op.join(op.dirname(op.abspath(__file__)), '..', 'mjxproc')
+
+
+@pytest.mark.parametrize("argv", [['--help'], ['convert', '--help']])
+def test_lazy_imports(argv):
+    code = (f"import sys; sys.path.insert(0, {MJXPROC!r}); "
+            f"import mjxproc_run\n"
+            f"try:\n    mjxproc_run.main({argv!r})\n"
+            f"except SystemExit:\n    pass\n"
+            f"print('nipype' in sys.modules, file=sys.stderr)")
+    proc = subprocess.run([sys.executable, '-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    assert 'usage: mjxproc' in proc.stdout
+    assert proc.stderr.strip().splitlines()[-1] == 'False'
+
+
+def _tree(root):
+    """ Paths, sizes and mtimes of everything under a directory.
+    """
+    tree = {}
+    for path, dirs, files in os.walk(root):
+        for name in dirs + files:
+            stat = os.stat(op.join(path, name))
+            tree[op.join(path, name)] = (stat.st_size, stat.st_mtime_ns)
+    return tree
+
+
+def _dry_run_argv(tmp_path, command):
+    """ Dry run of one subject, BIDS and PROC directories do not exist.
+    """
+    raw_dir = tmp_path / 'raw' / 'M1234'
+    for seq in ['MPR', 'CAAT', 'CAAT_TOP_UP']:
+        series = raw_dir / 'MJX_Study20190101at120000' / f'{seq}_20190101'
+        series.mkdir(parents=True)
+        (series / 'IM0001.dcm').touch()
+    images = []
+    for simg in ['qc', 'mb', 'fs', 'fmri']:
+        (tmp_path / f'{simg}.simg').touch()
+        images += [f'-{simg}_simg', str(tmp_path / f'{simg}.simg')]
+    bids_dir = str(tmp_path / 'BIDS')
+    proc_dir = str(tmp_path / 'PROC')
+
+    if command == 'run':
+        argv = ['run', 'sub-M1234', 'ses-01', str(raw_dir)]
+    else:
+        (tmp_path / 'subjects.txt').write_text(f'{raw_dir}\n')
+        argv = ['batch', str(tmp_path / 'subjects.txt')]
+    return argv + [bids_dir, proc_dir, '--dry-run'] + images
+
+
+def _dry_run(argv, cwd=None):
+    code = (f"import sys; sys.path.insert(0, {MJXPROC!r}); "
+            f"import mjxproc_run; mjxproc_run.main({argv!r})")
+    return subprocess.run([sys.executable, '-c', code], cwd=cwd,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+@pytest.mark.parametrize("command", ['run', 'batch'])
+def test_dry_run_writes_nothing(tmp_path, command):
+    argv = _dry_run_argv(tmp_path, command)
+    before = _tree(str(tmp_path))
+    proc = _dry_run(argv)
+    assert proc.returncode == 0, proc.stderr
+    assert "Critical path" in proc.stdout
+    assert _tree(str(tmp_path)) == before
+
+
+@pytest.mark.parametrize("run_nodes", [[], ['-run_nodes', 'ants']])
+@pytest.mark.parametrize("command", ['run', 'batch'])
+def test_dry_run_fresh_proc_dir(tmp_path, command, run_nodes):
+    proc = _dry_run(_dry_run_argv(tmp_path, command) + run_nodes)
+    assert proc.returncode == 0, proc.stderr
+    assert not (tmp_path / 'PROC').exists()
+    assert "$ singularity run " in proc.stdout
+    assert "existing directory" not in proc.stdout
+
+
+@pytest.mark.parametrize("command", ['run', 'batch'])
+def test_dry_run_relative_paths(tmp_path, command):
+    argv = [op.relpath(arg, str(tmp_path)) if arg.startswith(str(tmp_path))
+            else arg for arg in _dry_run_argv(tmp_path, command)]
+    if command == 'batch':
+        (tmp_path / 'subjects.txt').write_text('raw/M1234\n')
+    proc = _dry_run(argv, cwd=str(tmp_path))
+    assert proc.returncode == 0, proc.stderr
+    assert f"-B {tmp_path / 'PROC'}:/PROC " in proc.stdout
+    assert f" {tmp_path / 'fmri.simg'} " in proc.stdout
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+from mjxproc.scheduler import (
+    NODE_HOURS, DEFAULT_MVOX, critical_path, node_hours, path_weights,
+    plan_cpus, split_cpus, mem_calc, mem_model, available_gb
+)
+import pytest
+
+# Graph built by create_workflow with all run_nodes
+CHILDREN = {'input_node': ['mriqc', 'ants', 'freesurfer_autorecon1',
+                           'freesurfer_autorecon2', 'freesurfer_autorecon3',
+                           'mindboggle', 'fmriprep'],
+            'mriqc': [], 'ants': ['mindboggle'],
+            'freesurfer_autorecon1': ['freesurfer_autorecon2'],
+            'freesurfer_autorecon2': ['freesurfer_autorecon3'],
+            'freesurfer_autorecon3': ['mindboggle', 'fmriprep'],
+            'mindboggle': [], 'fmriprep': []}
+HOURS = dict(NODE_HOURS, input_node=0)
+FS_STAGES = ['freesurfer_autorecon1', 'freesurfer_autorecon2',
+             'freesurfer_autorecon3']
+
+
+def test_critical_path():
+    weights = path_weights(CHILDREN, HOURS)
+    assert weights['freesurfer_autorecon1'] == \
+        sum(HOURS[stage] for stage in FS_STAGES) + HOURS['fmriprep']
+    assert critical_path(CHILDREN, HOURS) == ['input_node'] + FS_STAGES + \
+        ['fmriprep']
+
+
+@pytest.mark.parametrize("ncpus", [1, 3, 6, 12, 32])
+def test_split_cpus(ncpus):
+    cpus = split_cpus(ncpus, [14, 4.5, 1])
+    assert min(cpus) >= 1
+    assert sum(cpus) == max(ncpus, 3)
+    assert cpus[0] >= cpus[1] >= cpus[2]
+
+
+def test_plan_cpus():
+    cpus = plan_cpus(CHILDREN, HOURS, 12)
+    assert 'input_node' not in cpus
+    assert cpus['mriqc'] + cpus['ants'] + cpus['freesurfer_autorecon1'] == 12
+    assert cpus['freesurfer_autorecon1'] > cpus['ants'] > cpus['mriqc']
+    # Hemisphere-parallel stages are given the cpus to themselves
+    assert cpus['freesurfer_autorecon2'] == 12
+    assert cpus['freesurfer_autorecon3'] == 12
+    assert cpus['mindboggle'] + cpus['fmriprep'] == 12
+    assert cpus['fmriprep'] > cpus['mindboggle']
+
+
+def test_node_hours():
+    assert node_hours('fmriprep') == NODE_HOURS['fmriprep']
+    assert node_hours('fmriprep_func_CAAT') == NODE_HOURS['fmriprep_func']
+    assert node_hours('fmriprep_func_CAAT_ses-02') == \
+        NODE_HOURS['fmriprep_func']
+    assert node_hours('freesurfer_autorecon2_ses-01') == \
+        NODE_HOURS['freesurfer_autorecon2']
+    assert node_hours('mriqc_group') == NODE_HOURS['mriqc_group']
+    # Fmriprep running recon-all itself
+    assert node_hours('fmriprep_recon') == NODE_HOURS['fmriprep'] + 8
+    assert node_hours('fmriprep_anat_recon') == \
+        NODE_HOURS['fmriprep_anat'] + 8
+    assert node_hours('convert_anat') == 0
+
+
+def test_mem_model():
+    # Threads and images grow the estimate, unconverted images use defaults
+    assert mem_model('Fmriprep', 8, {'anat': 10}) > \
+        mem_model('Fmriprep', 4, {'anat': 10})
+    assert mem_model('Fmriprep', 4, {'anat': 10, 'func': 50}) > \
+        mem_model('Fmriprep', 4, {'anat': 10})
+    assert mem_model('Mriqc', 2, {'anat': None}) == \
+        mem_model('Mriqc', 2, {'anat': DEFAULT_MVOX['anat']})
+    # Nodes without a model keep 2GB per cpu
+    assert mem_model('IdentityInterface', 3) == mem_calc(3)
+
+
+def test_available_gb(tmp_path):
+    meminfo = tmp_path / 'meminfo'
+    meminfo.write_text('MemTotal:       8388608 kB\n'
+                       'MemAvailable:   4194304 kB\n')
+    assert available_gb(str(meminfo)) == 4
+    assert available_gb(str(tmp_path / 'missing')) is None
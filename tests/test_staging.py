@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+from mjxproc.staging import ImageCache, sync_tree
+import os
+import time
+
+
+def test_image_cache_lru(tmp_path):
+    images = []
+    for name in ['a', 'b', 'c']:
+        image = tmp_path / f'{name}.simg'
+        image.write_bytes(bytes(1024))
+        images.append(str(image))
+
+    # Room for two images
+    cache = ImageCache(str(tmp_path / 'cache'), max_gb=2048 / 2**30)
+    cached_a = cache.stage(images[0])
+    cached_b = cache.stage(images[1])
+    assert os.path.isfile(cached_a) and cached_a != images[0]
+
+    # Images in use are never evicted
+    cache.stage(images[2])
+    assert all(os.path.isfile(cached) for cached in [cached_a, cached_b])
+
+    # The least recently used image goes first
+    cache.release()
+    time.sleep(0.01)
+    cache.stage(images[0])
+    cache.release()
+    cache.stage(images[2])
+    assert os.path.isfile(cached_a)
+    assert not os.path.isfile(cached_b)
+
+
+def test_sync_tree(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'scripts').mkdir(parents=True)
+    (src / 'scripts' / 'recon-all.done').write_text('done')
+    os.symlink('scripts', src / 'link')
+
+    dst = tmp_path / 'dst'
+    assert sync_tree(str(src), str(dst)) == 2
+    assert (dst / 'scripts' / 'recon-all.done').read_text() == 'done'
+    assert os.readlink(dst / 'link') == 'scripts'
+
+    # Unchanged files are not copied again
+    assert sync_tree(str(src), str(dst)) == 0
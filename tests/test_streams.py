@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+from mjxproc.streams import RotatingLog, run_logged
+import os
+
+
+def test_rotating_log(tmp_path):
+    path = str(tmp_path / 'stdout.log')
+    (tmp_path / 'stdout.log.3').write_text('stale')
+
+    log = RotatingLog(path, max_bytes=100, backups=2, tail=3)
+    for idx in range(50):
+        log.write(f'line {idx:04d}\n'.encode())
+    log.close()
+
+    # Capped logs, the oldest rotations dropped
+    assert sorted(os.listdir(tmp_path)) == \
+        ['stdout.log', 'stdout.log.1', 'stdout.log.2']
+    assert all(os.path.getsize(f'{path}{ext}') <= 100 for ext in
+               ['', '.1', '.2'])
+    with open(path, 'r') as f:
+        assert f.read().endswith('line 0049\n')
+    assert log.text() == 'line 0047\nline 0048\nline 0049\n'
+
+
+def test_run_logged(tmp_path):
+    cmd = 'for i in $(seq 1 500); do echo out $i; echo err $i >&2; done; ' \
+          'exit 3'
+    returncode, stdout, stderr = run_logged(cmd, str(tmp_path),
+                                            max_bytes=1024, tail=2)
+    assert returncode == 3
+    assert stdout == 'out 499\nout 500\n'
+    assert stderr == 'err 499\nerr 500\n'
+    assert os.path.getsize(tmp_path / 'stdout.log') <= 1024
+    assert sorted(os.listdir(tmp_path)) == \
+        ['stderr.log', 'stderr.log.1', 'stderr.log.2', 'stdout.log',
+         'stdout.log.1', 'stdout.log.2']
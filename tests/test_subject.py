@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 
-from mjxproc.utils import Subject
+from mjxproc.utils import (
+    Subject, BidsIndex, find_t1w, find_tasks, nifti_mvox
+)
+import os
 import os.path as op
+import json
+import gzip
+import time
+import struct
 import shutil
 import pytest
 
@@ -40,3 +47,227 @@ def test_to_nii(site):
                          f'sub-{ursi}_ses-01_dwi.{ftype}')
 
     shutil.rmtree(f'{base_dir}/BIDS_test')
+
+
+def _make_raw(raw_dir, site):
+    """ Create an empty raw data tree with the layout of a site.
+    """
+    if site == 'UTD':
+        for date in ['20190101', '20200101']:
+            for seq in ['MPR', 'CAAT', 'CAAT_TOP_UP']:
+                series = raw_dir / f'MJX_Study{date}at120000' / f'{seq}_{date}'
+                series.mkdir(parents=True)
+                (series / 'IM0001.dcm').touch()
+    elif site == 'NL':
+        for ses in ['ses-01', 'ses-02']:
+            (raw_dir / ses).mkdir(parents=True)
+            for seq in ['T1w', 'task-CAAT', 'topup_CAAT']:
+                (raw_dir / ses / f'{ses}_{seq}.PAR').touch()
+                (raw_dir / ses / f'{ses}_{seq}.REC').touch()
+
+
+@pytest.mark.parametrize("site", ['UTD', 'NL'])
+def test_raw_index(tmp_path, site):
+    raw_dir = tmp_path / ('M1234' if site == 'UTD' else 'sub-1234')
+    _make_raw(raw_dir, site)
+
+    subj = Subject(str(raw_dir), str(tmp_path / 'BIDS'))
+
+    assert subj.site == site
+    assert subj.raw_sess == 2
+    assert len(subj.raw_index) == 6
+    assert len([entry for entry in subj.raw_index if entry['topup']]) == 2
+
+    if site == 'UTD':
+        assert [date for _, date in subj.raw_sessions] == [20190101, 20200101]
+        assert subj._seq_glob('CAAT', topup=False).endswith(
+            'MJX_Study20190101at120000/CAAT_20190101/IM0001.dcm')
+        assert 'TOP_UP' in subj._seq_glob('CAAT', topup=True)
+    elif site == 'NL':
+        assert subj._seq_glob('T1w', topup=False).endswith(
+            'ses-01/ses-01_T1w.PAR')
+        assert 'topup' in subj._seq_glob('CAAT', topup=True)
+
+
+def test_convert_manifest(tmp_path, monkeypatch):
+    raw_dir = tmp_path / 'sub-1234'
+    _make_raw(raw_dir, 'NL')
+
+    calls = []
+
+    def convert(cmd):
+        d_out, f_out = cmd.split(' -o ')[1].split(' -f ')
+        f_out = f_out.split(' ')[0]
+        for ext in ['.nii', '.json']:
+            with open(f'{d_out}/{f_out}{ext}', 'w') as f:
+                f.write('{}')
+        calls.append(f_out)
+        return None, {'start_ts': 0, 'end_ts': 0}
+
+    monkeypatch.setattr(Subject, '_convert', staticmethod(convert))
+
+    Subject(str(raw_dir), str(tmp_path / 'BIDS')).to_bids()
+    assert 'sub-1234_ses-01_T1w' in calls
+    assert op.isfile(tmp_path / 'BIDS' / 'sub-1234' / '.manifest.json')
+
+    # Nothing is redone on a rerun
+    calls.clear()
+    Subject(str(raw_dir), str(tmp_path / 'BIDS')).to_bids()
+    assert calls == []
+
+    # Changed raw data is converted again
+    (raw_dir / 'ses-01' / 'ses-01_T1w.REC').write_text('data')
+    Subject(str(raw_dir), str(tmp_path / 'BIDS')).to_bids()
+    assert calls == ['sub-1234_ses-01_T1w']
+
+
+def test_convert_new_session(tmp_path, monkeypatch):
+    raw_dir = tmp_path / 'M1234'
+    _make_raw(raw_dir, 'UTD')
+    later = tmp_path / 'MJX_Study20200101at120000'
+    shutil.move(str(raw_dir / later.name), str(later))
+
+    calls = []
+
+    def convert(cmd):
+        d_out, f_out = cmd.split(' -o ')[1].split(' -f ')
+        f_out, source = f_out.split(' ')[0], f_out.split(' ')[-1]
+        for ext in ['.nii', '.json']:
+            with open(f'{d_out}/{f_out}{ext}', 'w') as f:
+                f.write('{}')
+        calls.append((f_out, source))
+        return None, {'start_ts': 0, 'end_ts': 0}
+
+    monkeypatch.setattr(Subject, '_convert', staticmethod(convert))
+
+    Subject(str(raw_dir), str(tmp_path / 'BIDS')).to_bids()
+    assert all('20190101' in source for _, source in calls)
+    manifest = tmp_path / 'BIDS' / 'sub-M1234' / '.manifest.json'
+    with open(manifest, 'r') as f:
+        ses01 = {key: entry for key, entry in json.load(f).items() if
+                 key.startswith('ses-01')}
+
+    # A later delivery converts as ses-02, ses-01 is left as it is
+    calls.clear()
+    shutil.move(str(later), str(raw_dir / later.name))
+    Subject(str(raw_dir), str(tmp_path / 'BIDS')).to_bids()
+    assert len(calls) > 0
+    assert all('_ses-02_' in f_out and '20200101' in source for
+               f_out, source in calls)
+    with open(manifest, 'r') as f:
+        manifest = json.load(f)
+    assert {key: manifest[key] for key in ses01} == ses01
+
+
+def test_convert_compress(tmp_path, monkeypatch):
+    raw_dir = tmp_path / 'sub-1234'
+    _make_raw(raw_dir, 'NL')
+
+    def convert(cmd):
+        d_out, f_out = cmd.split(' -o ')[1].split(' -f ')
+        f_out = f_out.split(' ')[0]
+        ext = '.nii.gz' if ' -z y ' in cmd else '.nii'
+        for out in [ext, '.json']:
+            with open(f'{d_out}/{f_out}{out}', 'w') as f:
+                f.write('{}')
+        return None, {'start_ts': 0, 'end_ts': 0}
+
+    monkeypatch.setattr(Subject, '_convert', staticmethod(convert))
+
+    ses_dir = tmp_path / 'BIDS' / 'sub-1234' / 'ses-01'
+    Subject(str(raw_dir), str(tmp_path / 'BIDS')).to_bids()
+    assert op.isfile(ses_dir / 'anat' / 'sub-1234_ses-01_T1w.nii')
+
+    # Compressed images replace uncompressed ones
+    out_files = Subject(str(raw_dir), str(tmp_path / 'BIDS')).convert(
+        compress=True)
+    assert str(ses_dir / 'anat' / 'sub-1234_ses-01_T1w.nii.gz') in out_files
+    assert not op.isfile(ses_dir / 'anat' / 'sub-1234_ses-01_T1w.nii')
+    assert find_t1w(str(tmp_path / 'BIDS'), 'sub-1234', 'ses-01') == \
+        'sub-1234/ses-01/anat/sub-1234_ses-01_T1w.nii.gz'
+
+    # Fmaps are paired with the compressed image
+    with open(ses_dir / 'fmap' / 'sub-1234_ses-01_acq-CAAT_dir-AP_epi.json',
+              'r') as f:
+        assert json.load(f)['IntendedFor'] == \
+            'sub-1234_ses-01_task-CAAT_bold.nii.gz'
+
+
+def test_find_tasks(tmp_path):
+    raw_dir = tmp_path / 'sub-1234'
+    _make_raw(raw_dir, 'NL')
+
+    # Tasks raw data converts to, before and after conversion
+    assert find_tasks(str(tmp_path / 'BIDS'), 'sub-1234', 'ses-01',
+                      str(raw_dir)) == ['CAAT']
+    assert find_tasks(str(tmp_path / 'BIDS'), 'sub-1234', 'ses-01') == []
+    func_dir = tmp_path / 'BIDS' / 'sub-1234' / 'ses-01' / 'func'
+    func_dir.mkdir(parents=True)
+    for task in ['REST', 'CAAT']:
+        (func_dir / f'sub-1234_ses-01_task-{task}_bold.nii.gz').touch()
+    assert find_tasks(str(tmp_path / 'BIDS'), 'sub-1234', 'ses-01') == \
+        ['CAAT', 'REST']
+
+
+@pytest.mark.parametrize("ext", ['.nii', '.nii.gz'])
+def test_nifti_mvox(tmp_path, ext):
+    # NIfTI-1 header of a 64x64x40 image with 300 volumes
+    header = struct.pack('<i', 348) + bytes(36) + \
+        struct.pack('<8h', 4, 64, 64, 40, 300, 1, 1, 1) + bytes(292)
+    path = str(tmp_path / f'sub-1234_ses-01_task-REST_bold{ext}')
+    with (gzip.open if ext == '.nii.gz' else open)(path, 'wb') as f:
+        f.write(header)
+    assert nifti_mvox(path) == 64 * 64 * 40 * 300 / 10**6
+
+    # Empty or missing images
+    (tmp_path / 'empty.nii').touch()
+    assert nifti_mvox(str(tmp_path / 'empty.nii')) is None
+    assert nifti_mvox(str(tmp_path / 'missing.nii')) is None
+
+
+@pytest.mark.parametrize("site", ['UTD', 'NL'])
+def test_convert_jobs_sessions(tmp_path, site):
+    raw_dir = tmp_path / ('M1234' if site == 'UTD' else 'sub-1234')
+    _make_raw(raw_dir, site)
+
+    # Each session converts its own series
+    subj = Subject(str(raw_dir), str(tmp_path / 'BIDS'))
+    jobs = subj.convert_jobs(['anat'], ['ses-01', 'ses-02'])
+    assert [job['session'] for job in jobs] == ['ses-01', 'ses-02']
+    assert len(set(job['cmd'].split(' ')[-1] for job in jobs)) == 2
+
+
+def test_bids_index(tmp_path, monkeypatch):
+    bids_dir = tmp_path / 'BIDS'
+    anat = bids_dir / 'sub-1234' / 'ses-01' / 'anat'
+    anat.mkdir(parents=True)
+    (anat / 'sub-1234_ses-01_T1w.nii').touch()
+    (anat / 'sub-1234_ses-01_T1w.json').write_text('{"EchoTime": 0.003}')
+    # Directories last changed a while ago
+    for path in [anat, anat.parent, anat.parent.parent]:
+        os.utime(path, (time.time() - 60, time.time() - 60))
+
+    index = BidsIndex(str(bids_dir))
+    assert index.sessions('sub-1234') == ['ses-01']
+    assert [img['name'] for img in index.files(
+        'sub-1234', 'ses-01', 'anat', '*.nii*')] == ['sub-1234_ses-01_T1w.nii']
+    assert index.sidecar('sub-1234/ses-01/anat/sub-1234_ses-01_T1w.nii') == \
+        {'EchoTime': 0.003}
+
+    # Unchanged directories are not scanned again
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir',
+                        lambda path: scans.append(path) or scandir(path))
+    assert find_t1w(str(bids_dir), 'sub-1234', 'ses-01') == \
+        'sub-1234/ses-01/anat/sub-1234_ses-01_T1w.nii'
+    assert scans == []
+
+    # Only changed directories are, new and removed files are found
+    func = anat.parent / 'func'
+    func.mkdir()
+    (func / 'sub-1234_ses-01_task-CAAT_bold.nii.gz').touch()
+    assert find_tasks(str(bids_dir), 'sub-1234', 'ses-01') == ['CAAT']
+    assert sorted(scans) == [str(anat.parent), str(func)]
+    (anat / 'sub-1234_ses-01_T1w.json').unlink()
+    assert index.sidecar('sub-1234/ses-01/anat/sub-1234_ses-01_T1w.nii') == {}
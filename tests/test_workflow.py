@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os.path as op
+import sys
+import json
+import subprocess
+import pytest
+
+MJXPROC = op.join(op.dirname(op.abspath(__file__)), '..', 'mjxproc')
+
+
+def _nodes(tmp_path, sessions, **kwargs):
+    """ Nodes of a subject's workflow, with their parents, the inputs they
+        are connected to and their output directory.
+    """
+    images = {f'{simg}_simg': str(tmp_path / f'{simg}.simg') for simg in
+              ['qc', 'mb', 'fs', 'fmri']}
+    for path in images.values():
+        open(path, 'w').close()
+    code = (f"import sys, json; sys.path.insert(0, {MJXPROC!r})\n"
+            f"from workflow import create_workflow\n"
+            f"wf = create_workflow('sub-1', {sessions!r}, "
+            f"{str(tmp_path / 'BIDS')!r}, {str(tmp_path / 'PROC')!r}, "
+            f"**{dict(images, **kwargs)!r})\n"
+            f"nodes = {{}}\n"
+            f"for node in wf._graph.nodes():\n"
+            f"    parents = {{}}\n"
+            f"    for parent in wf._graph.predecessors(node):\n"
+            f"        for _, dest in wf._graph.get_edge_data(\n"
+            f"                parent, node)['connect']:\n"
+            f"            parents[dest] = parent.name\n"
+            f"    out_dir = getattr(node.inputs, 'out_dir', None)\n"
+            f"    out_dir = out_dir if isinstance(out_dir, str) else None\n"
+            f"    nodes[node.name] = {{'parents': parents, "
+            f"'out_dir': out_dir}}\n"
+            f"print(json.dumps(nodes))")
+    proc = subprocess.run([sys.executable, '-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    assert proc.returncode == 0, proc.stderr
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("sessions", [['ses-01'], ['ses-01', 'ses-02']])
+def test_split_fmriprep(tmp_path, sessions):
+    for ses in sessions:
+        for img in [f'anat/sub-1_{ses}_T1w.nii.gz',
+                    f'func/sub-1_{ses}_task-CAAT_bold.nii.gz',
+                    f'func/sub-1_{ses}_task-REST_bold.nii.gz']:
+            path = tmp_path / 'BIDS' / 'sub-1' / ses / img
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+    (tmp_path / 'PROC').mkdir()
+
+    nodes = _nodes(tmp_path, sessions, run_nodes=['freesurfer', 'fmriprep'],
+                   split_fmriprep=True)
+    multi = len(sessions) > 1
+    anat = 'fmriprep_anat_recon' if multi else 'fmriprep_anat'
+    tasks = {f"fmriprep_func_{task}{'_' + ses if multi else ''}":
+             f"fmriprep/sub-1{'_' + ses if multi else ''}_task-{task}"
+             for ses in sessions for task in ['CAAT', 'REST']}
+
+    assert set(tasks).issubset(nodes)
+    assert [name for name in nodes if name.startswith('fmriprep')
+            and name not in tasks] == [anat]
+    assert nodes[anat]['out_dir'] is None
+    for name, out_dir in tasks.items():
+        assert nodes[name]['out_dir'] == out_dir
+        assert nodes[name]['parents']['anat_derivatives'] == anat
+        assert nodes[name]['parents']['partic_lab'] == 'input_node'
+    assert len(set(tasks.values())) == len(tasks)